@@ -0,0 +1,291 @@
+import numpy as np
+import pytest
+import scipy.sparse
+
+import wot.ot
+
+
+def random_points_and_growth(n=40, m=50, d=5, seed=0):
+    rng = np.random.RandomState(seed)
+    x = rng.randn(n, d)
+    y = rng.randn(m, d) + 0.3
+    G = np.exp(rng.randn(n) * 0.2)
+    return x, y, G
+
+
+def random_cost_and_growth(n=40, m=50, d=5, seed=0):
+    x, y, G = random_points_and_growth(n, m, d, seed)
+    return wot.ot.OTModel.compute_default_cost_matrix(x, y), G
+
+
+def default_solver_params():
+    return dict(lambda1=1, lambda2=50, epsilon=0.05, batch_size=5, tolerance=1e-8, tau=10000, epsilon0=1,
+                max_iter=1e7, scaling_iter=3000, inner_iter_max=50, extra_iter=1000)
+
+
+@pytest.mark.parametrize('solver', [wot.ot.optimal_transport_duality_gap, wot.ot.transport_stablev2])
+def test_single_precision_solver(solver):
+    C, G = random_cost_and_growth()
+    expected = solver(C=C, G=G, **default_solver_params())
+    result = solver(C=C, G=G, dtype='float32', **default_solver_params())
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=1e-2, atol=1e-3 * expected.max())
+
+
+def test_streaming_solver_matches_dense_solver():
+    rng = np.random.RandomState(1)
+    x = rng.randn(30, 4)
+    y = rng.randn(45, 4) + 0.3
+    G = np.exp(rng.randn(30) * 0.2)
+    C = wot.ot.OTModel.compute_default_cost_matrix(x, y)
+    params = default_solver_params()
+    expected = wot.ot.optimal_transport_duality_gap(C, G, **params)
+    result = wot.ot.optimal_transport_streaming(x, y, G, block_size=7, **params)
+    np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-5 * expected.max())
+
+    out = np.zeros_like(expected)
+    assert wot.ot.optimal_transport_streaming(x, y, G, block_size=8, out=out, **params) is out
+    np.testing.assert_allclose(out, result)
+
+
+def test_sparse_solver_with_full_support_matches_dense_solver():
+    x, y, G = random_points_and_growth()
+    C = wot.ot.OTModel.compute_default_cost_matrix(x, y)
+    expected = wot.ot.optimal_transport_duality_gap(C, G, **default_solver_params())
+    result = wot.ot.optimal_transport_sparse(x, y, G, kernel_threshold=1e-300, block_size=7,
+                                             **default_solver_params())
+    assert scipy.sparse.isspmatrix_csr(result)
+    assert result.nnz == C.size
+    np.testing.assert_allclose(result.toarray(), expected, rtol=1e-6, atol=1e-10)
+
+
+@pytest.mark.parametrize('truncation', [dict(kernel_threshold=1e-4), dict(kernel_knn=5)])
+def test_sparse_solver_truncation(truncation):
+    x, y, G = random_points_and_growth()
+    result = wot.ot.optimal_transport_sparse(x, y, G, block_size=7, **truncation, **default_solver_params())
+    assert result.nnz < 40 * 50
+    # every destination cell keeps at least one source cell
+    assert (result.getnnz(axis=0) > 0).all()
+    if 'kernel_knn' in truncation:
+        assert (result.getnnz(axis=1) >= 5).all()
+    nearest = np.argmin(wot.ot.OTModel.compute_default_cost_matrix(x, y), axis=0)
+    assert (result[nearest, np.arange(50)] > 0).all()
+
+
+def test_sparse_solver_does_not_allocate_the_cost_matrix():
+    import tracemalloc
+    x, y, G = random_points_and_growth(400, 500)
+    # The default cost scale is estimated on a fixed-size sample of pairs
+    tracemalloc.start()
+    try:
+        wot.ot.optimal_transport_sparse(x, y, G, kernel_knn=5, block_size=20, cost_scale=10,
+                                        **default_solver_params())
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak_bytes < 400 * 500 * 8 / 4
+
+
+def test_growth_iterations_do_not_add_to_the_peak_memory():
+    import tracemalloc
+    C, G = random_cost_and_growth(400, 500)
+    peak_bytes = []
+    for growth_iters in (1, 3):
+        tracemalloc.start()
+        try:
+            wot.ot.compute_transport_matrix(wot.ot.optimal_transport_duality_gap, C=C, G=G, growth_iters=growth_iters,
+                                            **default_solver_params())
+            peak_bytes.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    assert peak_bytes[1] < peak_bytes[0] + C.nbytes / 4
+
+
+def test_multiscale_solver_with_one_cell_per_cluster_matches_dense_solver():
+    rng = np.random.RandomState(2)
+    x = rng.randn(25, 3)
+    y = rng.randn(30, 3) + 0.3
+    G = np.exp(rng.randn(25) * 0.2)
+    C = wot.ot.OTModel.compute_default_cost_matrix(x, y)
+    params = default_solver_params()
+    expected = wot.ot.optimal_transport_duality_gap(C, G, **params)
+    result = wot.ot.optimal_transport_multiscale(x, y, G, n_clusters=100, coarse_threshold=0, **params)
+    np.testing.assert_allclose(result.toarray(), expected, rtol=1e-3, atol=1e-5 * expected.max())
+
+
+def test_multiscale_solver_refines_coarse_blocks():
+    rng = np.random.RandomState(3)
+    centers = rng.randn(4, 3) * 5
+    x = np.vstack([c + rng.randn(20, 3) * 0.2 for c in centers])
+    y = np.vstack([c + 0.1 + rng.randn(25, 3) * 0.2 for c in centers])
+    G = np.ones(len(x))
+    result = wot.ot.optimal_transport_multiscale(x, y, G, n_clusters=4, **default_solver_params())
+    assert result.shape == (80, 100)
+    assert result.nnz < 80 * 100
+    # mass goes from each group of source cells to the matching group of destination cells
+    blocks = np.add.reduceat(np.add.reduceat(result.toarray(), np.arange(0, 80, 20), axis=0),
+                             np.arange(0, 100, 25), axis=1)
+    assert (np.argmax(blocks, axis=1) == np.arange(4)).all()
+
+
+def test_lowrank_solver_with_full_rank_matches_dense_solver():
+    rng = np.random.RandomState(2)
+    x = rng.randn(30, 4)
+    y = rng.randn(45, 4) + 0.3
+    G = np.exp(rng.randn(30) * 0.2)
+    C = wot.ot.OTModel.compute_default_cost_matrix(x, y)
+    params = dict(default_solver_params(), epsilon=1)
+    expected = wot.ot.optimal_transport_duality_gap(C, G, **params)
+    result = wot.ot.optimal_transport_lowrank(x, y, G, rank=75, **params)
+    assert isinstance(result, wot.ot.FactoredTransportMap)
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result.toarray(), expected, rtol=1e-6, atol=1e-10)
+    np.testing.assert_allclose(result.sum(axis=1), expected.sum(axis=1), rtol=1e-6)
+    p, q = rng.rand(3, 30), rng.rand(45, 3)
+    np.testing.assert_allclose(p @ result, p @ expected, rtol=1e-6)
+    np.testing.assert_allclose(result @ q, expected @ q, rtol=1e-6)
+
+
+def test_lowrank_solver_refuses_inaccurate_kernels():
+    x, y, G = random_points_and_growth(200, 250)
+    with pytest.raises(ValueError, match='relative error'):
+        wot.ot.optimal_transport_lowrank(x, y, G, rank=100, **default_solver_params())
+    with pytest.raises(ValueError, match='relative error'):
+        wot.ot.optimal_transport_lowrank(x, y, G, **default_solver_params())
+
+    # By default, landmarks are added until the kernel is accurate
+    params = dict(default_solver_params(), epsilon=1)
+    expected = wot.ot.optimal_transport_duality_gap(wot.ot.OTModel.compute_default_cost_matrix(x, y), G, **params)
+    result = wot.ot.optimal_transport_lowrank(x, y, G, **params).toarray()
+    assert np.linalg.norm(result - expected) < 0.05 * np.linalg.norm(expected)
+    assert result.min() > -0.05 * result.max()
+
+
+@pytest.mark.parametrize('solver', [wot.ot.optimal_transport_duality_gap, wot.ot.optimal_transport_sparse])
+def test_warm_start_from_converged_potentials(solver):
+    x, y, G = random_points_and_growth()
+    inputs = dict(X=x, Y=y) if solver is wot.ot.optimal_transport_sparse else dict(
+        C=wot.ot.OTModel.compute_default_cost_matrix(x, y))
+    expected, potentials = solver(G=G, return_potentials=True, **inputs, **default_solver_params())
+    assert potentials['u'].shape == (40,) and potentials['v'].shape == (50,)
+    result = solver(G=G, potentials=potentials, **inputs, **dict(default_solver_params(), max_iter=10))
+    result, expected = [x.toarray() if scipy.sparse.issparse(x) else x for x in (result, expected)]
+    np.testing.assert_allclose(result, expected, rtol=1e-3, atol=1e-6 * expected.max())
+
+
+def test_warm_start_growth_iterations():
+    C, G = random_cost_and_growth()
+    params = dict(default_solver_params(), growth_iters=3)
+    expected, expected_growth = wot.ot.compute_transport_matrix(wot.ot.optimal_transport_duality_gap,
+                                                                C=C, G=G, **params)
+    result, learned_growth, potentials = wot.ot.compute_transport_matrix(
+        wot.ot.optimal_transport_duality_gap, C=C, G=G, warm_start=True, return_potentials=True, **params)
+    assert len(learned_growth) == 3
+    assert potentials['epsilon'] == pytest.approx(0.05)
+    np.testing.assert_allclose(result, expected, rtol=1e-3, atol=1e-6 * expected.max())
+    np.testing.assert_allclose(learned_growth[2], expected_growth[2], rtol=1e-3)
+
+
+@pytest.mark.parametrize('acceleration', [dict(acceleration='overrelaxation'),
+                                          dict(acceleration='overrelaxation', omega=1.5),
+                                          dict(acceleration='anderson', anderson_depth=3)])
+def test_accelerated_duality_gap_solver(acceleration):
+    C, G = random_cost_and_growth()
+    expected = wot.ot.optimal_transport_duality_gap(C, G, **default_solver_params())
+    result = wot.ot.optimal_transport_duality_gap(C, G, **acceleration, **default_solver_params())
+    np.testing.assert_allclose(result, expected, rtol=1e-3, atol=1e-6 * expected.max())
+
+
+def test_unknown_acceleration():
+    C, G = random_cost_and_growth()
+    with pytest.raises(ValueError):
+        wot.ot.optimal_transport_duality_gap(C, G, acceleration='nesterov', **default_solver_params())
+
+
+def test_batch_solver_matches_serial_solver():
+    problems = [random_cost_and_growth(n, m, seed=seed) for seed, (n, m) in enumerate([(40, 50), (12, 30), (25, 7)])]
+    C, G = [problem[0] for problem in problems], [problem[1] for problem in problems]
+    traces = [wot.ot.SolverTrace() for _ in problems]
+    results = wot.ot.optimal_transport_duality_gap_batch(C, G, trace=traces, **default_solver_params())
+    assert len(results) == 3
+    for c, g, result, trace in zip(C, G, results, traces):
+        expected_trace = wot.ot.SolverTrace()
+        expected = wot.ot.optimal_transport_duality_gap(c, g, trace=expected_trace, **default_solver_params())
+        assert result.shape == c.shape
+        np.testing.assert_allclose(result, expected, rtol=1e-8, atol=1e-14)
+        assert trace.converged
+        assert [stage['iterations'] for stage in trace.stages] == \
+               [stage['iterations'] for stage in expected_trace.stages]
+        assert trace.summary()['absorptions'] == expected_trace.summary()['absorptions']
+        np.testing.assert_allclose(trace.summary()['duality_gap'], expected_trace.summary()['duality_gap'],
+                                   rtol=1e-6)
+
+
+@pytest.mark.parametrize('solver', [wot.ot.optimal_transport_duality_gap, wot.ot.transport_stablev2])
+def test_solver_trace(solver):
+    C, G = random_cost_and_growth()
+    trace = wot.ot.SolverTrace()
+    result = solver(C=C, G=G, trace=trace, **default_solver_params())
+    np.testing.assert_array_equal(result, solver(C=C, G=G, **default_solver_params()))
+    summary = trace.summary()
+    assert summary['iterations'] == sum(stage['iterations'] for stage in trace.stages) > 0
+    assert summary['converged']
+    assert summary['duality_gap'] < 1e-6
+    assert summary['peak_kernel_bytes'] == C.nbytes
+    assert trace.stages[-1]['epsilon'] == pytest.approx(0.05)
+
+
+@pytest.mark.parametrize('solver', [wot.ot.optimal_transport_duality_gap, wot.ot.transport_stablev2])
+def test_solver_stops_at_iter_budget(solver):
+    C, G = random_cost_and_growth()
+    trace = wot.ot.SolverTrace()
+    result = solver(C=C, G=G, trace=trace, iter_budget=30, **default_solver_params())
+    assert trace.iterations == 30
+    assert trace.budget_exhausted and not trace.converged
+    assert trace.summary()['duality_gap'] is not None
+    assert np.isfinite(result).all()
+
+
+def test_solver_stops_at_time_budget():
+    C, G = random_cost_and_growth()
+    trace = wot.ot.SolverTrace()
+    wot.ot.optimal_transport_duality_gap(C, G, trace=trace, time_budget=0, **default_solver_params())
+    assert trace.iterations == 1
+    assert trace.budget_exhausted
+    assert trace.stages[-1]['duality_gaps']
+
+
+@pytest.mark.parametrize('shape', [(40, 50), (20, 200)])
+def test_greedy_solver_matches_dense_solver(shape):
+    C, G = random_cost_and_growth(*shape)
+    expected = wot.ot.optimal_transport_duality_gap(C, G, **default_solver_params())
+    trace = wot.ot.SolverTrace()
+    result = wot.ot.optimal_transport_greedy(C, G, trace=trace, **default_solver_params())
+    assert trace.converged
+    np.testing.assert_allclose(result, expected, rtol=1e-3, atol=1e-4 * expected.max())
+
+
+def test_greedy_solver_warm_start():
+    C, G = random_cost_and_growth()
+    expected, potentials = wot.ot.optimal_transport_greedy(C, G, return_potentials=True, **default_solver_params())
+    trace = wot.ot.SolverTrace()
+    result = wot.ot.optimal_transport_greedy(C, G, potentials=potentials, trace=trace, **default_solver_params())
+    assert len(trace.stages) == 1
+    np.testing.assert_allclose(result, expected, rtol=1e-3, atol=1e-4 * expected.max())
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_sqeuclidean_cost_matrix(dtype):
+    rng = np.random.RandomState(0)
+    x, y = rng.randn(300, 8) + 100, rng.randn(250, 8) + 100.5
+    expected = ((x[:, np.newaxis, :] - y[np.newaxis, :, :]) ** 2).sum(axis=2)
+    out = np.empty((300, 250), dtype=dtype)
+    result = wot.ot.sqeuclidean_cost_matrix(x, y, dtype=dtype, normalize=False, out=out, block_size=7)
+    assert result is out
+    np.testing.assert_allclose(result, expected, rtol=1e-4 if dtype == np.float32 else 1e-10)
+    normalized = wot.ot.sqeuclidean_cost_matrix(x, y, median_sample_size=None)
+    np.testing.assert_allclose(normalized, expected / np.median(expected), rtol=1e-10)
+    sampled = wot.ot.sqeuclidean_cost_matrix(x, y, median_sample_size=10000)
+    np.testing.assert_allclose(np.median(sampled), 1, rtol=0.02)
+    with pytest.raises(ValueError):
+        wot.ot.sqeuclidean_cost_matrix(x, y, out=np.empty((250, 300)))
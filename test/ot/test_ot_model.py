@@ -0,0 +1,582 @@
+import json
+import os
+
+import anndata
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+
+import wot.ot
+import wot.tmap
+
+
+def random_ot_dataset(ncells_per_day=(30, 40, 35), ngenes=20, covariates=None, seed=0):
+    rng = np.random.RandomState(seed)
+    days = np.concatenate([np.full(n, float(day)) for day, n in enumerate(ncells_per_day)])
+    x = rng.poisson(2, size=(len(days), ngenes)).astype(np.float64) + days[:, np.newaxis] * 0.5
+    obs = pd.DataFrame(index=['cell_{}'.format(i) for i in range(len(days))], data={'day': days})
+    if covariates is not None:
+        obs['covariate'] = rng.choice(covariates, size=len(days))
+    obs['cell_growth_rate'] = np.exp(rng.randn(len(days)) * 0.1)
+    return anndata.AnnData(x, obs, pd.DataFrame(index=['gene_{}'.format(j) for j in range(ngenes)]))
+
+
+def test_streaming_solver_in_ot_model():
+    ds = random_ot_dataset()
+    expected = wot.ot.OTModel(ds, local_pca=5).compute_transport_map(0, 1)
+    result = wot.ot.OTModel(ds, local_pca=5, solver='streaming').compute_transport_map(0, 1)
+    assert result.shape == expected.shape
+    assert (result.obs.index == expected.obs.index).all()
+    np.testing.assert_allclose(result.X, expected.X, rtol=0.05, atol=1e-3 * expected.X.max())
+
+
+def test_streaming_solver_writes_transport_maps_to_memmap(tmp_path):
+    ds = random_ot_dataset()
+    expected = wot.ot.OTModel(ds, local_pca=5, solver='streaming').compute_transport_map(0, 1)
+    ot_model = wot.ot.OTModel(ds, local_pca=5, solver='streaming', memmap_dir=str(tmp_path), growth_iters=2)
+    result = ot_model.compute_transport_map(0, 1)
+    assert isinstance(result.X.base, np.memmap)
+    assert os.listdir(str(tmp_path)) == []
+    np.testing.assert_allclose(result.obs['g0'], expected.obs['g0'])
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'))
+    written = anndata.read_h5ad(str(tmp_path / 'tmaps_0.0_1.0.h5ad'))
+    np.testing.assert_allclose(written.X, ot_model.compute_transport_map(0, 1).X)
+
+
+def test_sparse_solver_in_ot_model():
+    ds = random_ot_dataset()
+    ot_model = wot.ot.OTModel(ds, local_pca=5, solver='sparse', kernel_knn=10, growth_iters=2)
+    tmaps = {(0, 1): ot_model.compute_transport_map(0, 1), (1, 2): ot_model.compute_transport_map(1, 2)}
+    assert scipy.sparse.issparse(tmaps[(0, 1)].X)
+    assert list(tmaps[(0, 1)].obs.columns) == ['g0', 'g1', 'g2']
+
+    tmap_model = wot.tmap.TransportMapModel(tmaps, ds.obs[['day']])
+    population = tmap_model.population_from_ids(ds.obs.index[:5], at_time=0)[0]
+    descendants = tmap_model.push_forward(population, to_time=2)
+    assert descendants.p.shape == (35,)
+    np.testing.assert_allclose(descendants.p.sum(), 1)
+    assert scipy.sparse.issparse(tmap_model.get_coupling(0, 2).X)
+
+
+def test_multiscale_solver_in_ot_model():
+    ds = random_ot_dataset()
+    tmap = wot.ot.OTModel(ds, local_pca=5, solver='multiscale', n_clusters=5).compute_transport_map(0, 1)
+    assert scipy.sparse.issparse(tmap.X)
+    assert tmap.shape == (30, 40)
+
+
+def test_lowrank_solver_in_ot_model():
+    ds = random_ot_dataset()
+    ot_model = wot.ot.OTModel(ds, local_pca=5, solver='lowrank', rank=40, epsilon=1, growth_iters=2)
+    tmap_0 = ot_model.compute_transport_map(0, 1)
+    tmap_1 = ot_model.compute_transport_map(1, 2)
+    assert 'tmap_left' in tmap_0.obsm.keys()
+    coupling = wot.tmap.coupling_matrix(tmap_0)
+    assert isinstance(coupling, wot.ot.FactoredTransportMap)
+    dense = coupling.toarray()
+    np.testing.assert_allclose(tmap_0.obs['g2'], dense.sum(axis=1), rtol=1e-6)
+
+    glued = wot.tmap.glue_transport_maps(tmap_0, tmap_1)
+    np.testing.assert_allclose(wot.tmap.coupling_matrix(glued).toarray(),
+                               dense @ wot.tmap.coupling_matrix(tmap_1).toarray(), rtol=1e-6)
+
+    tmap_model = wot.tmap.TransportMapModel({(0, 1): tmap_0, (1, 2): tmap_1}, ds.obs[['day']])
+    populations = tmap_model.population_from_ids(ds.obs.index[:5], at_time=0)
+    pushed = tmap_model.push_forward(*populations)
+    expected = np.zeros(30)
+    expected[:5] = 1
+    expected = expected / expected.sum() @ dense
+    np.testing.assert_allclose(pushed.p, expected / expected.sum(), rtol=1e-6)
+
+
+def test_factored_transport_maps_are_only_written_in_h5ad(tmp_path):
+    ot_model = wot.ot.OTModel(random_ot_dataset(), local_pca=5, solver='lowrank', rank=40, epsilon=1)
+    with pytest.raises(ValueError, match='h5ad'):
+        ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'), output_file_format='loom')
+    assert os.listdir(str(tmp_path)) == []
+    with pytest.raises(ValueError, match='h5ad'):
+        wot.io.write_dataset(ot_model.compute_transport_map(0, 1), str(tmp_path / 'tmap'), output_format='loom')
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'))
+    tmap = anndata.read_h5ad(str(tmp_path / 'tmaps_0.0_1.0.h5ad'))
+    assert wot.tmap.coupling_matrix(tmap).sum() > 0
+
+
+def test_cache_potentials_in_ot_model():
+    ds = random_ot_dataset()
+    ot_model = wot.ot.OTModel(ds, local_pca=5, growth_iters=2, cache_potentials=True)
+    expected = ot_model.compute_transport_map(0, 1)
+    assert set(ot_model.potentials.keys()) == {(0, 1, None)}
+    ot_model.ot_config['max_iter'] = 100
+    result = ot_model.compute_transport_map(0, 1)
+    np.testing.assert_allclose(result.X, expected.X, rtol=1e-3, atol=1e-4 * expected.X.max())
+
+
+def test_covariate_transport_maps_are_batched(tmp_path):
+    ds = random_ot_dataset(covariates=['a', 'b', 'c'])
+    ot_model = wot.ot.OTModel(ds, local_pca=5)
+    tmaps = ot_model.compute_covariate_transport_maps(0, 1)
+    assert len(tmaps) == 9
+    for covariate, tmap in tmaps.items():
+        assert ot_model.traces[(0, 1, covariate)].converged
+        assert tmap.uns['solver_trace']['iterations'] == ot_model.traces[(0, 1, covariate)].iterations
+        expected = ot_model.compute_transport_map(0, 1, covariate=covariate)
+        assert tmap.uns['solver_trace']['iterations'] == expected.uns['solver_trace']['iterations']
+        assert (tmap.obs.index == expected.obs.index).all()
+        assert (tmap.var.index == expected.var.index).all()
+        np.testing.assert_allclose(tmap.X, expected.X, rtol=1e-8, atol=1e-14)
+
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'), with_covariates=True)
+    assert (tmp_path / 'tmaps_0.0_1.0_cva_cvb.h5ad').exists()
+    assert len(list(tmp_path.glob('*.h5ad'))) == 18
+
+
+@pytest.mark.parametrize('options', [{'acceleration': 'overrelaxation'}, {'omega': 1.5}, {'iter_budget': 20},
+                                     {'growth_iters': 2}, {'cache_potentials': True}])
+def test_covariate_transport_maps_honor_serial_solver_options(options):
+    ds = random_ot_dataset(covariates=['a', 'b'])
+    ot_model = wot.ot.OTModel(ds, local_pca=5, **options)
+    tmaps = ot_model.compute_covariate_transport_maps(0, 1)
+    for covariate, tmap in tmaps.items():
+        trace = ot_model.traces[(0, 1, covariate)]
+        assert trace.budget_exhausted == ('iter_budget' in options)
+        if 'iter_budget' in options:
+            assert trace.iterations <= options['iter_budget']
+        if 'cache_potentials' in options:
+            assert (0, 1, covariate) in ot_model.potentials
+        expected = ot_model.compute_transport_map(0, 1, covariate=covariate)
+        np.testing.assert_allclose(tmap.X, expected.X, rtol=1e-6, atol=1e-12)
+        assert tmap.uns['solver_trace']['iterations'] == trace.iterations
+
+
+def test_solver_traces_are_written_with_transport_maps(tmp_path):
+    ds = random_ot_dataset()
+    ot_model = wot.ot.OTModel(ds, local_pca=5, growth_iters=2)
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'))
+    with open(str(tmp_path / 'tmaps_trace.json')) as f:
+        traces = json.load(f)
+    assert [(trace['t0'], trace['t1']) for trace in traces] == [(0, 1), (1, 2)]
+    assert {stage['growth_iter'] for stage in traces[0]['stage_trace']} == {0, 1}
+    assert traces[0]['iterations'] == ot_model.traces[(0, 1, None)].iterations
+    tmap = anndata.read_h5ad(str(tmp_path / 'tmaps_0.0_1.0.h5ad'))
+    assert tmap.uns['solver_trace']['iterations'] == traces[0]['iterations']
+
+
+def test_transport_maps_out_of_budget_are_rescheduled(tmp_path):
+    ds = random_ot_dataset()
+    ot_model = wot.ot.OTModel(ds, local_pca=5, iter_budget=10)
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'flagged'))
+    tmap = anndata.read_h5ad(str(tmp_path / 'flagged_0.0_1.0.h5ad'))
+    assert tmap.uns['solver_trace']['budget_exhausted']
+    assert tmap.uns['solver_trace']['iterations'] == 10
+
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'rescheduled'), on_budget_exhausted='reschedule')
+    tmap = anndata.read_h5ad(str(tmp_path / 'rescheduled_0.0_1.0.h5ad'))
+    assert not tmap.uns['solver_trace']['budget_exhausted']
+    assert tmap.uns['solver_trace']['converged']
+    expected = wot.ot.OTModel(ds, local_pca=5).compute_transport_map(0, 1)
+    np.testing.assert_allclose(tmap.X, expected.X)
+
+
+@pytest.mark.parametrize('output_file_format', ['h5ad', 'loom'])
+def test_transport_maps_out_of_budget_are_not_up_to_date(tmp_path, output_file_format):
+    ds = random_ot_dataset()
+    ot_model = wot.ot.OTModel(ds, local_pca=5, iter_budget=10)
+    tmap_out = str(tmp_path / 'tmaps')
+    ot_model.compute_all_transport_maps(tmap_out=tmap_out, output_file_format=output_file_format)
+    path = wot.io.check_file_extension(tmap_out + '_0.0_1.0', output_file_format)
+    assert not ot_model._is_up_to_date(path, ot_model.transport_map_input_hash(0, 1))
+
+    ot_model.traces.clear()
+    ot_model.compute_all_transport_maps(tmap_out=tmap_out, output_file_format=output_file_format, overwrite=False)
+    assert (0, 1, None) in ot_model.traces
+
+    ot_model.ot_config['iter_budget'] = None
+    ot_model.compute_all_transport_maps(tmap_out=tmap_out, output_file_format=output_file_format,
+                                        on_budget_exhausted='reschedule')
+    assert ot_model._is_up_to_date(path, ot_model.transport_map_input_hash(0, 1))
+    ot_model.traces.clear()
+    ot_model.compute_all_transport_maps(tmap_out=tmap_out, output_file_format=output_file_format, overwrite=False)
+    assert ot_model.traces == {}
+
+
+def test_budgets_are_refused_by_solvers_that_ignore_them():
+    ds = random_ot_dataset()
+    for solver in ('streaming', 'sparse', 'multiscale', 'lowrank'):
+        with pytest.raises(ValueError):
+            wot.ot.OTModel(ds, local_pca=5, solver=solver, iter_budget=10)
+        with pytest.raises(ValueError):
+            wot.ot.OTModel(ds, local_pca=5, solver=solver, time_budget=1)
+        wot.ot.OTModel(ds, local_pca=5, solver=solver, time_budget=None, iter_budget=None)
+    tmap = wot.ot.OTModel(ds, local_pca=5, solver='greedy', iter_budget=10).compute_transport_map(0, 1)
+    assert tmap.uns['solver_status'] == 'budget_exhausted'
+
+
+def test_budget_applies_to_all_growth_iterations():
+    ds = random_ot_dataset()
+    ot_model = wot.ot.OTModel(ds, local_pca=5, growth_iters=3)
+    iterations = ot_model.compute_transport_map(0, 1).uns['solver_trace']['iterations']
+    ot_model.ot_config['iter_budget'] = iterations // 2
+    tmap = ot_model.compute_transport_map(0, 1)
+    trace = ot_model.traces[(0, 1, None)]
+    assert trace.budget_exhausted
+    assert trace.iterations <= iterations // 2
+    assert tmap.uns['solver_status'] == 'budget_exhausted'
+
+
+def test_greedy_solver_in_ot_model():
+    ds = random_ot_dataset()
+    expected = wot.ot.OTModel(ds, local_pca=5).compute_transport_map(0, 1)
+    result = wot.ot.OTModel(ds, local_pca=5, solver='greedy', growth_iters=2).compute_transport_map(0, 1)
+    assert list(result.obs.columns) == ['g0', 'g1', 'g2']
+    np.testing.assert_allclose(result.obs['g0'], expected.obs['g0'])
+    assert result.uns['solver_trace']['converged']
+
+
+def test_registered_solver_in_ot_model():
+    calls = []
+
+    def uniform_solver(C, G, **params):
+        calls.append(sorted(params))
+        return scipy.sparse.coo_matrix(np.full(C.shape, params['epsilon']))
+
+    ds = random_ot_dataset()
+    wot.ot.register_solver('uniform', uniform_solver, config_keys=['epsilon', 'tau'], coupling='sparse')
+    try:
+        assert 'uniform' in wot.ot.solver_names()
+        tmap = wot.ot.OTModel(ds, local_pca=5, solver='uniform').compute_transport_map(0, 1)
+    finally:
+        wot.ot.solver_registry._solvers.pop('uniform')
+    assert calls == [['epsilon', 'tau']]
+    assert scipy.sparse.isspmatrix_csr(tmap.X)
+    np.testing.assert_allclose(tmap.obs['g1'], 0.05 * ds[ds.obs['day'] == 1].shape[0])
+    with pytest.raises(ValueError):
+        wot.ot.OTModel(ds, solver='uniform')
+
+
+def test_transport_maps_computed_in_parallel(tmp_path, monkeypatch):
+    import concurrent.futures
+    import threading
+
+    # Worker processes must not be forked while the transport map writer thread runs
+    threads_at_fork = []
+
+    class RecordingExecutor(concurrent.futures.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            threads_at_fork.extend(thread.name for thread in threading.enumerate())
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', RecordingExecutor)
+    ds = random_ot_dataset(ncells_per_day=(30, 40, 35, 20))
+    ds.X = scipy.sparse.csr_matrix(ds.X)
+    ot_model = wot.ot.OTModel(ds, local_pca=5, growth_iters=2)
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'serial'))
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'parallel'), n_jobs=2)
+    assert len(threads_at_fork) > 0
+    assert 'wot-tmap-writer' not in threads_at_fork
+    for t0, t1 in [(0, 1), (1, 2), (2, 3)]:
+        expected = anndata.read_h5ad(str(tmp_path / 'serial_{:.1f}_{:.1f}.h5ad'.format(t0, t1)))
+        result = anndata.read_h5ad(str(tmp_path / 'parallel_{:.1f}_{:.1f}.h5ad'.format(t0, t1)))
+        np.testing.assert_allclose(result.X, expected.X)
+    pd.testing.assert_frame_equal(pd.read_csv(str(tmp_path / 'parallel_g.txt'), sep='\t'),
+                                  pd.read_csv(str(tmp_path / 'serial_g.txt'), sep='\t'))
+    with open(str(tmp_path / 'parallel_trace.json')) as f:
+        assert len(json.load(f)) == 3
+
+
+@pytest.mark.parametrize('output_file_format', ['h5ad', 'loom'])
+def test_unchanged_transport_maps_are_not_recomputed(tmp_path, output_file_format):
+    ds = random_ot_dataset()
+    tmap_out = str(tmp_path / 'tmaps')
+    wot.ot.OTModel(ds, local_pca=5).compute_all_transport_maps(tmap_out=tmap_out,
+                                                              output_file_format=output_file_format)
+    paths = {day_pair: str(tmp_path / 'tmaps_{:.1f}_{:.1f}.{}'.format(*day_pair, output_file_format))
+             for day_pair in [(0, 1), (1, 2)]}
+    mtimes = {day_pair: os.stat(path).st_mtime_ns for day_pair, path in paths.items()}
+
+    wot.ot.OTModel(ds, local_pca=5).compute_all_transport_maps(tmap_out=tmap_out, overwrite=False,
+                                                              output_file_format=output_file_format)
+    assert {day_pair: os.stat(path).st_mtime_ns for day_pair, path in paths.items()} == mtimes
+
+    config = pd.DataFrame({'t0': [0.0, 1.0], 't1': [1.0, 2.0], 'epsilon': [0.05, 0.1]})
+    wot.ot.OTModel(ds, local_pca=5, config=config).compute_all_transport_maps(tmap_out=tmap_out, overwrite=False,
+                                                                             output_file_format=output_file_format)
+    assert os.stat(paths[(0, 1)]).st_mtime_ns == mtimes[(0, 1)]
+    assert os.stat(paths[(1, 2)]).st_mtime_ns != mtimes[(1, 2)]
+
+
+def test_input_hash_only_covers_settings_that_change_the_transport_map(tmp_path):
+    ds = random_ot_dataset()
+    expected = wot.ot.OTModel(ds, local_pca=5).transport_map_input_hash(0, 1)
+    for options in [{'cost_cache_size': 2 ** 20}, {'memmap_dir': str(tmp_path)}, {'cache_potentials': True},
+                    {'iter_budget': 1000}, {'kernel_knn': 5},
+                    {'acceleration': None, 'omega': None, 'time_budget': None, 'kernel_knn': None}]:
+        assert wot.ot.OTModel(ds, local_pca=5, **options).transport_map_input_hash(0, 1) == expected
+    for options in [{'epsilon': 0.1}, {'tolerance': 1e-6}, {'local_pca': 4}, {'pca_mode': 'global'},
+                    {'growth_iters': 2}, {'solver': 'fixed_iters'}]:
+        assert wot.ot.OTModel(ds, local_pca=options.pop('local_pca', 5), **options).transport_map_input_hash(0, 1) \
+               != expected
+
+
+def test_cell_indices():
+    ds = random_ot_dataset(covariates=['a', 'b'])
+    ot_model = wot.ot.OTModel(ds, local_pca=5)
+    np.testing.assert_array_equal(ot_model.cell_indices(1), np.where(ds.obs['day'] == 1)[0])
+    np.testing.assert_array_equal(ot_model.cell_indices(2, 'b'),
+                                  np.where((ds.obs['day'] == 2) & (ds.obs['covariate'] == 'b'))[0])
+    assert len(ot_model.cell_indices(5)) == 0
+    assert len(ot_model.cell_indices(1, 'c')) == 0
+
+
+def test_prefetched_transport_maps_are_written_in_background(tmp_path):
+    ds = random_ot_dataset(ncells_per_day=(30, 40, 35, 20))
+    ot_model = wot.ot.OTModel(ds, local_pca=5)
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'serial'), write_queue_size=0)
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'prefetched'), prefetch=True)
+    for t0, t1 in [(0, 1), (1, 2), (2, 3)]:
+        expected = anndata.read_h5ad(str(tmp_path / 'serial_{:.1f}_{:.1f}.h5ad'.format(t0, t1)))
+        result = anndata.read_h5ad(str(tmp_path / 'prefetched_{:.1f}_{:.1f}.h5ad'.format(t0, t1)))
+        np.testing.assert_array_equal(result.X, expected.X)
+
+
+def test_transport_map_write_errors_are_raised(tmp_path, monkeypatch):
+    def write_dataset(*args, **kwargs):
+        raise IOError('disk full')
+
+    monkeypatch.setattr(wot.io, 'write_dataset', write_dataset)
+    with pytest.raises(IOError, match='disk full'):
+        wot.ot.OTModel(random_ot_dataset(), local_pca=5).compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'))
+
+
+def test_sparse_local_pca_matches_dense_local_pca():
+    rng = np.random.RandomState(0)
+    x = rng.poisson(np.exp(rng.randn(70, 3).dot(rng.randn(3, 200)) - 1)).astype(np.float64)
+    m1, m2 = scipy.sparse.csr_matrix(x[:30]), scipy.sparse.csr_matrix(x[30:])
+    dense_1, dense_2, dense_pca, dense_mean = wot.ot.compute_pca(x[:30], x[30:], 5)
+    sparse_1, sparse_2, sparse_pca, sparse_mean = wot.ot.compute_pca(m1, m2, 5)
+    assert sparse_1.shape == (30, 5) and sparse_2.shape == (40, 5)
+    np.testing.assert_allclose(sparse_mean, dense_mean)
+    np.testing.assert_allclose(sparse_pca.singular_values_, dense_pca.singular_values_, rtol=1e-3)
+    expected = wot.ot.OTModel.compute_default_cost_matrix(dense_1, dense_2, np.diag(dense_pca.singular_values_))
+    result = wot.ot.OTModel.compute_default_cost_matrix(sparse_1, sparse_2, np.diag(sparse_pca.singular_values_))
+    np.testing.assert_allclose(result, expected, atol=1e-3 * expected.max())
+
+
+def test_global_pca_matches_local_pca_of_a_single_day_pair():
+    ds = random_ot_dataset(ncells_per_day=(30, 40))
+    ds.X = scipy.sparse.csr_matrix(ds.X)
+    expected = wot.ot.OTModel(ds, local_pca=5).compute_transport_map(0, 1)
+    ot_model = wot.ot.OTModel(ds.copy(), local_pca=5, pca_mode='global')
+    result = ot_model.compute_transport_map(0, 1)
+    assert ot_model.matrix.obsm[wot.ot.OTModel.GLOBAL_PCA_KEY].shape == (70, 5)
+    np.testing.assert_allclose(result.X, expected.X, rtol=1e-3, atol=1e-6 * expected.X.max())
+
+
+def test_global_pca_is_fitted_once(tmp_path, monkeypatch):
+    calls = []
+    compute_pca_embedding = wot.ot.compute_pca_embedding
+
+    def counting_compute_pca_embedding(*args, **kwargs):
+        calls.append(args)
+        return compute_pca_embedding(*args, **kwargs)
+
+    monkeypatch.setattr(wot.ot, 'compute_pca_embedding', counting_compute_pca_embedding)
+    ds = random_ot_dataset(ncells_per_day=(30, 40, 35, 20))
+    ot_model = wot.ot.OTModel(ds, local_pca=5, pca_mode='global', pca_sample=60)
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'))
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'), overwrite=False)
+    assert len(calls) == 1
+    assert len(calls[0][2]) == 60
+
+
+def test_pca_embedding_projects_cells_outside_of_the_fit():
+    rng = np.random.RandomState(0)
+    x = scipy.sparse.csr_matrix(rng.poisson(np.exp(rng.randn(70, 3).dot(rng.randn(3, 50)) - 1)).astype(np.float64))
+    expected = wot.ot.compute_pca_embedding(x, 5)
+    np.testing.assert_allclose(wot.ot.compute_pca_embedding(x, 5, np.arange(70)), expected, atol=1e-8)
+    np.testing.assert_allclose(wot.ot.compute_pca_embedding(x.toarray(), 5), expected, atol=1e-8)
+
+
+def test_covariate_pairs_share_the_day_pair_cost(monkeypatch):
+    calls = []
+    compute_pca = wot.ot.compute_pca
+
+    def counting_compute_pca(*args, **kwargs):
+        calls.append(args)
+        return compute_pca(*args, **kwargs)
+
+    monkeypatch.setattr(wot.ot, 'compute_pca', counting_compute_pca)
+    ds = random_ot_dataset(covariates=['a', 'b'])
+    ot_model = wot.ot.OTModel(ds, local_pca=5, share_covariate_cost=True)
+    full = ot_model.compute_transport_map(0, 1)
+    tmaps = ot_model.compute_covariate_transport_maps(0, 1)
+    assert len(calls) == 1
+    assert len(ot_model.cost_cache) == 1
+    problem = ot_model._prepare_transport_problem({**ot_model.ot_config, 't0': 0, 't1': 1})
+    C = problem[0]['C']
+    for (cv0, cv1), tmap in tmaps.items():
+        rows = np.where(ds.obs['covariate'][ds.obs['day'] == 0] == cv0)[0]
+        cols = np.where(ds.obs['covariate'][ds.obs['day'] == 1] == cv1)[0]
+        problem = ot_model._prepare_transport_problem({**ot_model.ot_config, 't0': 0, 't1': 1, 'covariate': (cv0, cv1)})
+        np.testing.assert_array_equal(problem[0]['C'], C[np.ix_(rows, cols)])
+        assert (tmap.obs.index == full.obs.index[rows]).all()
+        assert (tmap.var.index == full.var.index[cols]).all()
+
+
+def test_lru_cache_is_bounded():
+    cache = wot.ot.ot_model._LRUCache(100)
+    cache.put('a', 1, 40)
+    cache.put('b', 2, 40)
+    assert cache.get('a') == 1
+    cache.put('c', 3, 40)
+    assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+    cache.put('d', 4, 101)
+    assert cache.get('d') is None and cache.nbytes == 80
+
+
+def test_ncells_downsampling_is_stratified_and_seeded():
+    ds = random_ot_dataset(covariates=['a', 'b'])
+    ot_model = wot.ot.OTModel(ds, local_pca=5, ncells=10, random_state=1)
+    counts = ot_model.matrix.obs.groupby(['day', 'covariate']).size()
+    expected = np.minimum(ds.obs.groupby(['day', 'covariate']).size(), 10)
+    pd.testing.assert_series_equal(counts, expected)
+    same = wot.ot.OTModel(ds, local_pca=5, ncells=10, random_state=1)
+    assert (same.matrix.obs.index == ot_model.matrix.obs.index).all()
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_ncounts_downsampling(sparse):
+    ds = random_ot_dataset(ngenes=200)
+    ds.X = np.rint(ds.X)
+    if sparse:
+        ds.X = scipy.sparse.csr_matrix(ds.X)
+    totals = np.asarray(ds.X.sum(axis=1)).ravel()
+    ot_model = wot.ot.OTModel(ds, local_pca=5, ncounts=300, random_state=0)
+    X = ot_model.matrix.X
+    assert scipy.sparse.issparse(X) == sparse
+    X = X.toarray() if sparse else X
+    result = X.sum(axis=1)
+    np.testing.assert_allclose(result.mean(), 300, rtol=0.02)
+    assert (X <= (ds.X.toarray() if sparse else ds.X)).all()
+    assert totals.min() > 300
+    np.testing.assert_array_equal(np.asarray(ds.X.sum(axis=1)).ravel(), totals)
+    same = wot.ot.OTModel(ds, local_pca=5, ncounts=300, random_state=0).matrix.X
+    np.testing.assert_array_equal(same.toarray() if sparse else same, X)
+
+
+def test_shards_partition_the_day_pairs(tmp_path):
+    ds = random_ot_dataset(ncells_per_day=(30, 40, 35, 20, 25))
+    ot_model = wot.ot.OTModel(ds, local_pca=5)
+    for i in range(3):
+        ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'), shard='{}/3'.format(i))
+    assert sorted(os.listdir(str(tmp_path))) == ['tmaps_0.0_1.0.h5ad', 'tmaps_1.0_2.0.h5ad', 'tmaps_2.0_3.0.h5ad',
+                                                 'tmaps_3.0_4.0.h5ad', 'tmaps_shard0_trace.json',
+                                                 'tmaps_shard1_trace.json', 'tmaps_shard2_trace.json']
+    # The two most costly day pairs, (1, 2) and (0, 1), are in different shards
+    assert [ot_model._shard_day_pairs([(0, 1), (1, 2), (2, 3), (3, 4)], i, 3) for i in range(3)] == [
+        [(1, 2)], [(0, 1)], [(2, 3), (3, 4)]]
+    with pytest.raises(ValueError):
+        ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'), shard='3/3')
+
+
+def test_work_queue_skips_claimed_day_pairs(tmp_path):
+    import subprocess
+    import sys
+
+    ds = random_ot_dataset(ncells_per_day=(30, 40, 35, 20))
+    ot_model = wot.ot.OTModel(ds, local_pca=5)
+    lock_path = str(tmp_path / '.tmaps_1.0_2.0.lock')
+    holder = subprocess.Popen([sys.executable, '-c', 'import fcntl, sys; f = open(sys.argv[1], "a"); '
+                                                     'fcntl.lockf(f, fcntl.LOCK_EX); print(flush=True); '
+                                                     'sys.stdin.read()', lock_path],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        holder.stdout.readline()
+        ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'), work_queue=True)
+        assert sorted(f for f in os.listdir(str(tmp_path)) if f.endswith('.h5ad')) == [
+            'tmaps_0.0_1.0.h5ad', 'tmaps_2.0_3.0.h5ad']
+    finally:
+        holder.stdin.close()
+        holder.wait()
+    # A restarted worker only computes the day pair that was not written
+    ot_model.traces = {}
+    ot_model.compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'), work_queue=True)
+    assert sorted(ot_model.traces) == [(1, 2, None)]
+    assert sorted(f for f in os.listdir(str(tmp_path)) if f.endswith('.h5ad')) == [
+        'tmaps_0.0_1.0.h5ad', 'tmaps_1.0_2.0.h5ad', 'tmaps_2.0_3.0.h5ad']
+
+
+def test_partially_written_transport_maps_are_removed(tmp_path, monkeypatch):
+    def write_dataset(ds, path, output_format):
+        open(path, 'w').close()
+        raise IOError('disk full')
+
+    monkeypatch.setattr(wot.io, 'write_dataset', write_dataset)
+    with pytest.raises(IOError, match='disk full'):
+        wot.ot.OTModel(random_ot_dataset(), local_pca=5).compute_all_transport_maps(tmap_out=str(tmp_path / 'tmaps'))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_plan_transport_maps():
+    ds = random_ot_dataset(covariates=['a', 'b'])
+    ot_model = wot.ot.OTModel(ds, local_pca=5, dtype='float32')
+    plan = ot_model.plan_transport_maps(calibrate=False, memory_limit=23000)
+    assert list(plan[['t0', 't1', 'n', 'm']].itertuples(index=False, name=None)) == [(0, 1, 30, 40), (1, 2, 40, 35)]
+    assert (plan['cost_bytes'] == plan['n'] * plan['m'] * 4).all()
+    assert (plan['pca_bytes'] == 2 * (plan['n'] + plan['m']) * 20 * 8).all()
+    assert (plan['peak_bytes'] == np.maximum(plan['pca_bytes'], 2 * plan['cost_bytes'])).all()
+    assert list(plan['big_memory']) == [False, True]
+    assert plan['seconds'].isnull().all()
+    plan = wot.ot.OTModel(ds, local_pca=0, dtype='float32').plan_transport_maps(calibrate=False)
+    assert (plan['peak_bytes'] == 2 * plan['cost_bytes']).all()
+
+    covariate_plan = ot_model.plan_transport_maps(with_covariates=True, calibrate=False)
+    assert len(covariate_plan) == 8
+    assert covariate_plan.groupby(['t0', 't1'])['n'].sum().tolist() == [60, 80]
+
+
+def test_calibrated_plan_grows_with_the_problem_size():
+    ds = random_ot_dataset(ncells_per_day=(30, 300, 200))
+    plan = wot.ot.OTModel(ds, local_pca=5, tolerance=1e-4).plan_transport_maps()
+    assert (plan['seconds'] > 0).all() and (plan['peak_bytes'] > 0).all()
+    assert plan['seconds'][1] > plan['seconds'][0]
+    assert plan['peak_bytes'][1] > plan['peak_bytes'][0]
+
+
+def test_calibration_samples_cells_of_one_day_pair(monkeypatch):
+    ds = random_ot_dataset(ncells_per_day=(30, 300, 200))
+    ot_model = wot.ot.OTModel(ds, local_pca=5, tolerance=1e-4)
+    sampled_days = []
+    cost_coordinates = ot_model._cost_coordinates
+
+    def recording_cost_coordinates(p0_indices, p1_indices, *args):
+        sampled_days.append((set(ds.obs['day'].values[p0_indices]), set(ds.obs['day'].values[p1_indices])))
+        return cost_coordinates(p0_indices, p1_indices, *args)
+
+    monkeypatch.setattr(ot_model, '_cost_coordinates', recording_cost_coordinates)
+    plan = ot_model.plan_transport_maps()
+    assert sampled_days == [({1.0}, {2.0})] * 2
+    assert (plan['status'] == 'ok').all()
+
+
+def test_plan_reports_solvers_refusing_the_calibration():
+    ds = random_ot_dataset()
+    ot_model = wot.ot.OTModel(ds, local_pca=5, solver='lowrank')
+    plan = ot_model.plan_transport_maps()
+    assert plan['status'].str.startswith('solver cannot run with this configuration').all()
+    assert plan['seconds'].isnull().all()
+    assert (plan['peak_bytes'] == plan['pca_bytes']).all()
+
+
+@pytest.mark.parametrize('solver', wot.ot.solver_names())
+def test_validation_summary_with_each_solver(solver):
+    ds = random_ot_dataset(covariates=['a', 'b'])
+    # the low-rank kernel is only accurate for a large epsilon
+    ot_model = wot.ot.OTModel(ds, local_pca=5, solver=solver, covariate_field='covariate',
+                              epsilon=5 if solver == 'lowrank' else 0.05)
+    summary = wot.ot.compute_validation_summary(ot_model, day_triplets=[(0, 1, 2)], interp_size=100,
+                                                compute_full_distances=True)
+    for full in (True, False):
+        distances = summary[(summary['name'] == 'I') & (summary['full'] == full)]['distance']
+        assert len(distances) > 0
+        assert np.isfinite(distances).all()
@@ -3,6 +3,7 @@
 
 import argparse
 import logging
+import sys
 
 import wot.commands
 import wot.io
@@ -12,11 +13,32 @@ import wot.ot
 def create_parser():
     parser = argparse.ArgumentParser(description='Compute transport maps between pairs of time points')
     wot.commands.add_ot_parameters_arguments(parser)
-    parser.add_argument('--format', help='Output file format', default='h5ad', choices=['h5ad', 'loom'])
+    parser.add_argument('--format', help='Output file format. The factored transport maps of the lowrank solver '
+                                         'are only written in h5ad format', default='h5ad', choices=['h5ad', 'loom'])
     parser.add_argument('--no_overwrite', help='Do not overwrite existing transport maps if they exist',
                         action='store_true')
     parser.add_argument('--out', default='./tmaps',
                         help='Prefix for output file names')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='Number of day pairs to compute in parallel, in separate processes. -1 to use all '
+                             'processors')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='Compute the cost matrix of the next day pair while solving the current one. '
+                             'Uses memory for two cost matrices')
+    parser.add_argument('--reschedule_exhausted', action='store_true',
+                        help='Recompute without budget the transport maps whose solver exhausted its time_budget or '
+                             'iter_budget, once all other transport maps are computed')
+    parser.add_argument('--shard', metavar='i/N',
+                        help='Only compute the i-th of N shards of the day pairs (0 <= i < N), e.g. on the i-th of N '
+                             'nodes. Shards are assigned deterministically, balancing their estimated cost')
+    parser.add_argument('--work_queue', action='store_true',
+                        help='Share the day pairs with the other workers writing to the same output directory, by '
+                             'claiming them with lock files. Restarting workers resumes where they stopped')
+    parser.add_argument('--plan', action='store_true',
+                        help='Print the cell counts, estimated memory and time of each transport map, calibrated on '
+                             'a small benchmark of the solver, instead of computing them')
+    parser.add_argument('--memory_limit', type=float,
+                        help='With --plan, flag the transport maps whose estimated peak memory is above this many GB')
     return parser
 
 
@@ -26,5 +48,13 @@ def main(args):
         logger.setLevel(logging.DEBUG)
         logger.addHandler(logging.StreamHandler())
     ot_model = wot.commands.initialize_ot_model_from_args(args)
+    if args.plan:
+        plan = ot_model.plan_transport_maps(memory_limit=None if args.memory_limit is None else int(
+            args.memory_limit * 2 ** 30))
+        plan.to_csv(sys.stdout, sep='\t', index=False)
+        return
     ot_model.compute_all_transport_maps(overwrite=not args.no_overwrite, output_file_format=args.format,
-                                        tmap_out=args.out)
+                                        tmap_out=args.out,
+                                        on_budget_exhausted='reschedule' if args.reschedule_exhausted else 'flag',
+                                        n_jobs=args.n_jobs, prefetch=args.prefetch, shard=args.shard,
+                                        work_queue=args.work_queue)
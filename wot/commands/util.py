@@ -100,11 +100,16 @@ def initialize_ot_model_from_args(args):
                                       cell_days=args.cell_days,
                                       solver=args.solver,
                                       local_pca=args.local_pca,
+                                      pca_mode=args.pca_mode,
+                                      pca_sample=args.pca_sample,
+                                      share_covariate_cost=args.share_covariate_cost,
+                                      cost_cache_size=args.cost_cache_size,
                                       growth_rate_field=args.growth_rate_field,
                                       day_field=args.day_field,
                                       covariate_field=args.covariate_field if hasattr(args,
                                                                                       'covariate_field') else None,
                                       growth_iters=args.growth_iters,
+                                      warm_start=not args.no_warm_start,
                                       epsilon=args.epsilon,
                                       lambda1=args.lambda1,
                                       lambda2=args.lambda2,
@@ -120,10 +125,24 @@ def initialize_ot_model_from_args(args):
                                       inner_iter_max=args.inner_iter_max,
                                       ncells=args.ncells,
                                       ncounts=args.ncounts,
+                                      random_state=args.random_state,
                                       transpose=args.transpose,
                                       max_iter=args.max_iter,
                                       batch_size=args.batch_size,
                                       tolerance=args.tolerance,
+                                      dtype=args.dtype,
+                                      greedy_ratio=args.greedy_ratio,
+                                      kernel_threshold=args.kernel_threshold,
+                                      kernel_knn=args.kernel_knn,
+                                      n_clusters=args.n_clusters,
+                                      rank=args.rank,
+                                      max_kernel_error=args.max_kernel_error,
+                                      memmap_dir=args.memmap_dir,
+                                      acceleration=args.acceleration,
+                                      omega=args.omega,
+                                      anderson_depth=args.anderson_depth,
+                                      time_budget=args.time_budget,
+                                      iter_budget=args.iter_budget,
                                       covariate=args.covariate if hasattr(args, 'covariate') else None
                                       )
 
@@ -140,8 +159,20 @@ def add_ot_parameters_arguments(parser):
     parser.add_argument('--local_pca', type=int, default=30,
                         help='Convert day pairs matrix to local PCA coordinates.'
                              'Set to 0 to disable')
+    parser.add_argument('--pca_mode', choices=['local', 'global'], default='local',
+                        help='Fit the PCA on the cells of each day pair (local), or once on all cells (global)')
+    parser.add_argument('--pca_sample', type=int,
+                        help='Number of randomly sampled cells to fit the global PCA on. All cells by default')
+    parser.add_argument('--share_covariate_cost', action='store_true',
+                        help='Compute the PCA and cost matrix of each day pair once, and use blocks of it for all '
+                             'covariate pairs')
+    parser.add_argument('--cost_cache_size', type=int, default=2 ** 30,
+                        help='Maximum size in bytes of the day pair cost matrices kept with --share_covariate_cost')
     parser.add_argument('--growth_iters', type=int, default=1,
                         help='Number of growth iterations for learning the growth rate.')
+    parser.add_argument('--no_warm_start', action='store_true',
+                        help='Solve each growth iteration from scratch instead of resuming from the dual potentials '
+                             'of the previous one')
 
     parser.add_argument('--gene_filter',
                         help='File with one gene id per line to use for computing'
@@ -176,10 +207,49 @@ def add_ot_parameters_arguments(parser):
     parser.add_argument('--tau', type=float, default=10000, help='For OT solver')
     parser.add_argument('--ncells', type=int, help='Number of cells to downsample from each timepoint and covariate')
     parser.add_argument('--ncounts', help='Sample ncounts from each cell', type=int)
+    parser.add_argument('--random_state', type=int, help='Seed of the --ncells and --ncounts downsampling')
     # parser.add_argument('--sampling_bias', help='File with "id" and "pp" to correct sampling bias.')
 
-    parser.add_argument('--solver', choices=['duality_gap', 'fixed_iters'],
+    parser.add_argument('--solver', choices=wot.ot.solver_names(),
                         help='The solver to use to compute transport matrices', default='duality_gap')
+    parser.add_argument('--greedy_ratio', type=float, default=0.5,
+                        help='For the greedy solver, update the rows or columns whose marginal violation is at least '
+                             'this fraction of the largest one')
+    parser.add_argument('--kernel_threshold', type=float, default=1e-8,
+                        help='For the sparse solver, drop kernel entries below this fraction of the largest entry '
+                             'of their row')
+    parser.add_argument('--kernel_knn', type=int,
+                        help='For the sparse solver, keep the kernel_knn nearest cells of each cell instead')
+    parser.add_argument('--n_clusters', type=int,
+                        help='For the multiscale solver, number of metacells per timepoint')
+    parser.add_argument('--rank', type=int,
+                        help='For the lowrank solver, number of landmark cells of the kernel approximation. By default, '
+                             'the smallest number, doubling from 100, whose kernel error is below --max_kernel_error')
+    parser.add_argument('--max_kernel_error', type=float, default=0.05,
+                        help='For the lowrank solver, largest accepted relative error of the kernel approximation. '
+                             'Small values of epsilon need more landmarks than cells: use another solver')
+    parser.add_argument('--memmap_dir',
+                        help='For the streaming solver, hold each transport map in a temporary file in this directory '
+                             'while it is computed and written, instead of in memory')
+    parser.add_argument('--acceleration', choices=['overrelaxation', 'anderson'],
+                        help='For the duality_gap solver, acceleration of the scaling iterations')
+    parser.add_argument('--omega', type=float,
+                        help='Overrelaxation parameter in [1, 2). Estimated from the convergence rate by default')
+    parser.add_argument('--anderson_depth', type=int, default=5,
+                        help='Number of previous iterates used by Anderson acceleration')
+    budget_solvers = ', '.join(name for name in wot.ot.solver_names()
+                               if wot.ot.get_solver(name).consumes('time_budget'))
+    parser.add_argument('--time_budget', type=float,
+                        help='Wall time in seconds after which the solver stops and returns the current transport '
+                             'map, recording the duality gap reached. The budget applies to each transport map, over '
+                             'all growth iterations. Supported by the {} solvers'.format(budget_solvers))
+    parser.add_argument('--iter_budget', type=int,
+                        help='Total number of scaling iterations, over all epsilon stages and growth iterations, '
+                             'after which the solver stops and returns the current transport map. Supported by the '
+                             '{} solvers'.format(budget_solvers))
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64',
+                        help='Floating point precision of the cost matrix, solver iterations and transport maps. '
+                             'float32 halves memory usage')
     parser.add_argument('--cell_days_field', help='Field name in cell_days file that contains cell days',
                         default='day', dest='day_field')
     parser.add_argument('--cell_growth_rates_field',
@@ -548,6 +548,9 @@ def write_parquet(ds, path,
 
 def write_dataset(ds, path, output_format='txt'):
     path = check_file_extension(path, output_format)
+    if output_format != 'h5ad' and 'tmap_left' in ds.obsm.keys():
+        # Factored transport maps are only stored in obsm and varm, their X is empty
+        raise ValueError('Factored transport maps can only be written in h5ad format, not {}'.format(output_format))
     if output_format == 'parquet':
         write_parquet(ds, path)
     elif output_format == 'txt' or output_format == 'gct' or output_format == 'csv':
@@ -640,6 +643,10 @@ def write_dataset(ds, path, output_format='txt'):
 
         wot.io.save_loom_attrs(f, False, ds.obs, ds.shape[0])
         wot.io.save_loom_attrs(f, True, ds.var, ds.shape[1])
+        # string annotations, such as the input hash of transport maps, are kept as global attributes
+        for key, value in ds.uns.items():
+            if isinstance(value, str):
+                f.attrs[key] = value
 
         f.close()
 
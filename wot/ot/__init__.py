@@ -2,5 +2,7 @@
 from .initializer import *
 from .optimal_transport import *
 from .optimal_transport_validation import *
+from .solver_trace import *
+from .solver_registry import *
 from .ot_model import *
 from .util import *
@@ -1,45 +1,88 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import time
 
+import anndata
 import numpy as np
+import scipy.sparse
+
+from .solver_trace import SolverTrace
 
 logger = logging.getLogger('wot')
 
 
-def compute_transport_matrix(solver, **params):
+def compute_transport_matrix(solver, return_potentials=False, **params):
     """
     Compute the optimal transport with stabilized numerics.
     Args:
     G: Growth (absolute)
-    solver: transport_stablev2 or optimal_transport_duality_gap
+    solver: transport_stablev2, optimal_transport_duality_gap, optimal_transport_greedy, optimal_transport_streaming
+        or optimal_transport_sparse
     growth_iters:
+    warm_start: resume each growth iteration from the dual potentials of the previous one.
+        The solver must accept the potentials and return_potentials arguments.
+    potentials: dual potentials to start the first growth iteration from, when warm_start is set
+    return_potentials: also return the final dual potentials, or None if warm_start is not set
+    trace: wot.ot.SolverTrace passed to the solver, recording the stages of all growth iterations
+    time_budget, iter_budget: budget of the whole transport map, shared by all growth iterations. Once it is
+        exhausted, the remaining growth iterations are skipped and the current transport map is returned,
+        with budget_exhausted set in trace.
   """
 
     import gc
     G = params['G']
-    growth_iters = params['growth_iters']
+    growth_iters = params.pop('growth_iters', 1)
+    warm_start = params.pop('warm_start', False)
+    potentials = params.pop('potentials', None)
+    time_budget = params.get('time_budget')
+    iter_budget = params.get('iter_budget')
+    if (time_budget is not None or iter_budget is not None) and params.get('trace') is None:
+        # The trace counts the iterations used by the previous growth iterations
+        params['trace'] = SolverTrace()
+    trace = params.get('trace')
+    deadline = None if time_budget is None else time.time() + time_budget
+    start_iterations = trace.iterations if trace is not None else 0
     learned_growth = []
     for i in range(growth_iters):
+        if i > 0 and trace is not None and trace.budget_exhausted:
+            break
+        if iter_budget is not None:
+            params['iter_budget'] = iter_budget - (trace.iterations - start_iterations)
+        if i > 0 and (iter_budget is not None and params['iter_budget'] <= 0
+                      or deadline is not None and time.time() >= deadline):
+            trace.budget_exhausted = True
+            break
+        if deadline is not None:
+            params['time_budget'] = max(0, deadline - time.time())
+        if trace is not None:
+            trace.growth_iter = i
         if i == 0:
             row_sums = G
         else:
-            row_sums = tmap.sum(axis=1)  # / tmap.shape[1]
+            row_sums = np.asarray(tmap.sum(axis=1)).ravel()  # / tmap.shape[1]
+            # Free the previous transport map before solving again, so that the peak memory is that of one solve
+            tmap = None
         params['G'] = row_sums
         learned_growth.append(row_sums)
-        tmap = solver(**params)
+        if warm_start:
+            tmap, potentials = solver(potentials=potentials, return_potentials=True, **params)
+        else:
+            tmap = solver(**params)
         gc.collect()
 
+    if return_potentials:
+        return tmap, learned_growth, potentials if warm_start else None
     return tmap, learned_growth
 
 
 # @ Lénaïc Chizat 2015 - optimal transport
-def fdiv(l, x, p, dx):
-    return l * np.sum(dx * (x * (np.log(x / p)) - x + p))
+def fdiv(l, x, p, dx, axis=None):
+    return l * np.sum(dx * (x * (np.log(x / p)) - x + p), axis=axis, dtype=np.float64)
 
 
-def fdivstar(l, u, p, dx):
-    return l * np.sum((p * dx) * (np.exp(u / l) - 1))
+def fdivstar(l, u, p, dx, axis=None):
+    return l * np.sum((p * dx) * (np.exp(u / l) - 1), axis=axis, dtype=np.float64)
 
 
 def primal(C, K, R, dx, dy, p, q, a, b, epsilon, lambda1, lambda2):
@@ -49,8 +92,8 @@ def primal(C, K, R, dx, dy, p, q, a, b, epsilon, lambda1, lambda2):
     F2 = lambda x, y: fdiv(lambda2, x, q, y)
     with np.errstate(divide='ignore'):
         return F1(np.dot(R, dy), dx) + F2(np.dot(R.T, dx), dy) \
-               + (epsilon * np.sum(R * np.nan_to_num(np.log(R)) - R + K) \
-                  + np.sum(R * C)) / (I * J)
+               + (epsilon * np.sum(R * np.nan_to_num(np.log(R)) - R + K, dtype=np.float64) \
+                  + np.sum(R * C, dtype=np.float64)) / (I * J)
 
 
 def dual(C, K, R, dx, dy, p, q, a, b, epsilon, lambda1, lambda2):
@@ -59,13 +102,141 @@ def dual(C, K, R, dx, dy, p, q, a, b, epsilon, lambda1, lambda2):
     F1c = lambda u, v: fdivstar(lambda1, u, p, v)
     F2c = lambda u, v: fdivstar(lambda2, u, q, v)
     return - F1c(- epsilon * np.log(a), dx) - F2c(- epsilon * np.log(b), dy) \
-           - epsilon * np.sum(R - K) / (I * J)
+           - epsilon * np.sum(R - K, dtype=np.float64) / (I * J)
 
 
 # end @ Lénaïc Chizat
 
+def _epsilon_schedule(epsilon, epsilon0, epsilon_scalings=5):
+    """Exponentially decreasing values of epsilon for each stage of the scaling iterations"""
+    if epsilon_scalings == 0:
+        return [epsilon0 * epsilon]
+    scale_factor = float(np.exp(- np.log(epsilon) / epsilon_scalings))
+    epsilon_i = epsilon0 * scale_factor
+    schedule = []
+    for e in range(epsilon_scalings + 1):
+        epsilon_i = epsilon_i / scale_factor
+        schedule.append(epsilon_i)
+    return schedule
+
+
+def _warm_start_schedule(epsilon, epsilon0, potentials, epsilon_scalings=5):
+    """The epsilon schedule, reduced to its final stage when resuming from previous dual potentials"""
+    epsilon_schedule = _epsilon_schedule(epsilon, epsilon0, epsilon_scalings)
+    return epsilon_schedule if potentials is None else epsilon_schedule[-1:]
+
+
+def _initial_potential(potentials, key, size, dtype):
+    """A copy of the dual potential potentials[key] to start the scaling iterations from, or zeros"""
+    if potentials is None:
+        return np.zeros(size, dtype=dtype)
+    potential = np.array(potentials[key], dtype=dtype)
+    if potential.shape != (size,):
+        raise ValueError("Dual potential '{}' has shape {}, expected ({},)".format(key, potential.shape, size))
+    return potential
+
+
+def _dual_potentials(u, a, v, b, epsilon):
+    """The full dual potentials u + epsilon * log(a) and v + epsilon * log(b), to warm-start another solve"""
+    with np.errstate(divide='ignore'):
+        return {'u': u + epsilon * np.log(a), 'v': v + epsilon * np.log(b), 'epsilon': epsilon}
+
+
+def _min_tolerance(dtype):
+    """Smallest relative duality gap that the scaling iterations can reach in the given precision"""
+    return 100 * np.finfo(dtype).eps if np.dtype(dtype) != np.float64 else 0
+
+
+def _update_kernel(K, C, u, v, epsilon):
+    """Computes the stabilized kernel exp((u_i - C_ij + v_j) / epsilon) in place into K"""
+    if u is None:
+        np.negative(C, out=K)
+    else:
+        np.subtract(u[:, np.newaxis], C, out=K)
+        K += v
+    K /= epsilon
+    np.exp(K, out=K)
+    return K
+
+
+def _absorb(u, a, epsilon):
+    """Absorbs the scaling variable a into the dual potential u, in place"""
+    u += epsilon * np.log(a)
+    a.fill(1)
+
+
+def _scaling_exponent(u, denominator, out):
+    """Computes exp(-u / denominator), the contribution of the absorbed potential to the scaling updates"""
+    np.divide(u, -denominator, out=out)
+    return np.exp(out, out=out)
+
+
+def _scaling_update(K, b, dy, p, alpha, exp_u, b_dy, K_b, out):
+    """Unbalanced scaling update a = (p / K.(b * dy)) ** alpha * exp(-u / (lambda + epsilon)), without allocation"""
+    np.multiply(b, dy, out=b_dy)
+    np.dot(K, b_dy, out=K_b)
+    np.divide(p, K_b, out=out)
+    np.power(out, alpha, out=out)
+    out *= exp_u
+    return out
+
+
+def _relax(x, old_x, omega):
+    """Overrelaxed scaling update x <- old_x ** (1 - omega) * x ** omega, in place"""
+    np.power(x, omega, out=x)
+    x *= old_x ** (1 - omega)
+    return x
+
+
+def _log_residual(x, old_x):
+    """Norm of log(x) - log(old_x), the change of the log-potentials at the last iteration"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return float(np.linalg.norm(np.log(x.astype(np.float64) / old_x)))
+
+
+class _AndersonMixing:
+    """
+    Type-II Anderson acceleration of a fixed point iteration x <- F(x) over the last `depth` iterates.
+
+    The history is dropped whenever the residual F(x) - x grows, so that the next step is a plain fixed point step.
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.reset()
+
+    def reset(self):
+        self.x, self.f = [], []
+
+    def record(self, x, fx):
+        """Records the iterate x and its image F(x)"""
+        self.x.append(x)
+        self.f.append(fx)
+        if len(self.x) > self.depth + 1:
+            del self.x[0], self.f[0]
+
+    def extrapolate(self):
+        """The extrapolated next iterate, or None to take a plain step"""
+        if len(self.x) < 2:
+            return None
+        g = [f - x for x, f in zip(self.x, self.f)]
+        if not np.linalg.norm(g[-1]) < np.linalg.norm(g[-2]):
+            del self.x[:-1], self.f[:-1]
+            return None
+        delta_g = np.column_stack([g[k + 1] - g[k] for k in range(len(g) - 1)])
+        delta_f = np.column_stack([self.f[k + 1] - self.f[k] for k in range(len(g) - 1)])
+        gamma = np.linalg.lstsq(delta_g, g[-1], rcond=1e-10)[0]
+        x = self.f[-1] - delta_f.dot(gamma)
+        if not np.all(np.isfinite(x)):
+            self.reset()
+            return None
+        return x
+
+
 def optimal_transport_duality_gap(C, G, lambda1, lambda2, epsilon, batch_size, tolerance, tau,
-                                  epsilon0, max_iter, **ignored):
+                                  epsilon0, max_iter, dtype=np.float64, potentials=None, return_potentials=False,
+                                  acceleration=None, omega=None, anderson_depth=5, trace=None, time_budget=None,
+                                  iter_budget=None, **ignored):
     """
     Compute the optimal transport with stabilized numerics, with the guarantee that the duality gap is at most `tolerance`
 
@@ -91,81 +262,389 @@ def optimal_transport_duality_gap(C, G, lambda1, lambda2, epsilon, batch_size, t
         Starting value for exponentially-decreasing epsilon
     max_iter : int, optional
         Maximum number of iterations. Print a warning and return if it is reached, even without convergence.
+    dtype : str or numpy.dtype, optional
+        Floating point type of the kernel, the scaling iterations and the returned transport map.
+        Use float32 to halve memory usage. The duality gap is always accumulated in float64.
+    time_budget : float, optional
+        Wall time, in seconds, after which to stop iterating and return the current transport map.
+    iter_budget : int, optional
+        Total number of scaling iterations, over all epsilon stages, after which to stop iterating and return
+        the current transport map. When a budget is exhausted, the duality gap reached at the current epsilon
+        is recorded in `trace`, whose budget_exhausted attribute is set.
+    potentials : dict, optional
+        Dual potentials 'u' and 'v' returned by a previous solve, e.g. at a previous growth iteration.
+        The scaling iterations start from them at the final value of epsilon, skipping epsilon scaling.
+    return_potentials : bool, optional
+        Also return the final dual potentials, as a dict with keys 'u', 'v' and 'epsilon'.
+    acceleration : {None, 'overrelaxation', 'anderson'}, optional
+        Acceleration of the scaling iterations.
+        'overrelaxation' replaces each scaling update a' by a ** (1 - omega) * a' ** omega, and falls back to
+        a smaller omega for the rest of the epsilon stage whenever the change of the scaling variables grows.
+        'anderson' extrapolates the log of the scaling variable b from its last `anderson_depth` iterates,
+        and takes a plain step whenever the fixed point residual grows.
+    omega : float, optional
+        Overrelaxation parameter, in [1, 2). Estimated from the convergence rate of plain iterations by default.
+    anderson_depth : int, optional
+        Number of previous iterates used by Anderson acceleration.
+    trace : wot.ot.SolverTrace, optional
+        Records the convergence of each epsilon stage.
 
     Returns
     -------
     transport_map : 2-D ndarray
         The entropy-regularized unbalanced transport map
+    potentials : dict
+        The final dual potentials. Only returned if return_potentials is True.
     """
-    C = np.asarray(C, dtype=np.float64)
-    epsilon_scalings = 5
-    scale_factor = np.exp(- np.log(epsilon) / epsilon_scalings)
+    if acceleration not in (None, 'overrelaxation', 'anderson'):
+        raise ValueError("Unknown acceleration '{}'".format(acceleration))
+    if omega is not None and not 1 <= omega < 2:
+        raise ValueError("omega must be in [1, 2)")
+    start_time = time.time()
+    dtype = np.dtype(dtype)
+    C = np.asarray(C, dtype=dtype)
+    epsilon_schedule = _warm_start_schedule(epsilon, epsilon0, potentials)
+    tolerance = max(tolerance, _min_tolerance(dtype))
 
     I, J = C.shape
-    dx, dy = np.ones(I) / I, np.ones(J) / J
+    dx, dy = np.ones(I, dtype=dtype) / I, np.ones(J, dtype=dtype) / J
 
-    p = G
-    q = np.ones(C.shape[1]) * np.average(G)
+    p = np.asarray(G, dtype=dtype)
+    q = np.full(C.shape[1], np.average(G), dtype=dtype)
 
-    u, v = np.zeros(I), np.zeros(J)
-    a, b = np.ones(I), np.ones(J)
+    u, v = _initial_potential(potentials, 'u', I, dtype), _initial_potential(potentials, 'v', J, dtype)
+    a, b = np.ones(I, dtype=dtype), np.ones(J, dtype=dtype)
+    old_a, old_b = np.ones(I, dtype=dtype), np.ones(J, dtype=dtype)
+    # Work buffers, allocated once and updated in place by the scaling iterations
+    K = np.empty_like(C)
+    K_b, K_a = np.empty(I, dtype=dtype), np.empty(J, dtype=dtype)
+    b_dy, a_dx = np.empty(J, dtype=dtype), np.empty(I, dtype=dtype)
+    exp_u_a, exp_v_b = np.empty(I, dtype=dtype), np.empty(J, dtype=dtype)
+    trace = SolverTrace() if trace is None else trace
+    trace.record_kernel(K)
+    kernel_mass = None
+    overrelaxation = acceleration == 'overrelaxation'
+    anderson = _AndersonMixing(anderson_depth) if acceleration == 'anderson' else None
 
-    epsilon_i = epsilon0 * scale_factor
+    iteration_limit = max_iter if iter_budget is None else min(max_iter, iter_budget)
+    deadline = None if time_budget is None else start_time + time_budget
+
+    def marginal_duality_gap(update_K_a):
+        # The duality gap only depends on the marginals of the coupling R = diag(a) K diag(b).
+        # K_a already holds K.T.(a * dx) from the last update of b, unless the kernel was just updated.
+        np.multiply(b, dy, out=b_dy)
+        np.dot(K, b_dy, out=K_b)
+        if update_K_a:
+            np.multiply(a, dx, out=a_dx)
+            np.dot(K.T, a_dx, out=K_a)
+        with np.errstate(divide='ignore'):
+            f = u + epsilon_i * np.log(a.astype(np.float64))
+            g = v + epsilon_i * np.log(b.astype(np.float64))
+        return _marginal_duality_gap(a * K_b, b * K_a, f, g, p, q, dx, dy, kernel_mass, epsilon_i, lambda1, lambda2)
+
+    epsilon_i = epsilon_schedule[0]
     current_iter = 0
 
-    for e in range(epsilon_scalings + 1):
+    for e in range(len(epsilon_schedule)):
+        final_stage = e == len(epsilon_schedule) - 1
         duality_gap = np.inf
-        u = u + epsilon_i * np.log(a)
-        v = v + epsilon_i * np.log(b)  # absorb
-        epsilon_i = epsilon_i / scale_factor
-        _K = np.exp(-C / epsilon_i)
+        _absorb(u, a, epsilon_i)
+        _absorb(v, b, epsilon_i)
+        epsilon_i = epsilon_schedule[e]
+        trace.start_stage(epsilon_i)
+        stage_start_iter = current_iter
+        if final_stage:
+            kernel_mass = _kernel_mass(C, epsilon_i, dx, dy)
         alpha1 = lambda1 / (lambda1 + epsilon_i)
         alpha2 = lambda2 / (lambda2 + epsilon_i)
-        K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
-        a, b = np.ones(I), np.ones(J)
-        old_a, old_b = a, b
-        threshold = tolerance if e == epsilon_scalings else 1e-6
+        _update_kernel(K, C, u, v, epsilon_i)
+        _scaling_exponent(u, lambda1 + epsilon_i, out=exp_u_a)
+        _scaling_exponent(v, lambda2 + epsilon_i, out=exp_v_b)
+        threshold = tolerance if final_stage else max(1e-6, _min_tolerance(dtype))
+        omega_i, omega_max = (1, 1.9) if omega is None else (omega, omega)
+        residual = batch_residual = np.inf
+        if anderson is not None:
+            anderson.reset()
 
         while duality_gap > threshold:
-            for i in range(batch_size if e == epsilon_scalings else 5):
+            for i in range(batch_size if final_stage else 5):
                 current_iter += 1
-                old_a, old_b = a, b
-                a = (p / (K.dot(np.multiply(b, dy)))) ** alpha1 * np.exp(-u / (lambda1 + epsilon_i))
-                b = (q / (K.T.dot(np.multiply(a, dx)))) ** alpha2 * np.exp(-v / (lambda2 + epsilon_i))
+                absorbed = False
+                if anderson is not None:
+                    log_b = anderson.extrapolate()
+                    if log_b is not None:
+                        np.exp(np.minimum(log_b, np.log(tau)), out=b, casting='unsafe')
+                np.copyto(old_a, a)
+                np.copyto(old_b, b)
+                _scaling_update(K, b, dy, p, alpha1, exp_u_a, b_dy, K_b, out=a)
+                if omega_i != 1:
+                    _relax(a, old_a, omega_i)
+                _scaling_update(K.T, a, dx, q, alpha2, exp_v_b, a_dx, K_a, out=b)
+                if omega_i != 1:
+                    _relax(b, old_b, omega_i)
+                if overrelaxation:
+                    previous_residual, residual = residual, _log_residual(b, old_b)
+                if anderson is not None:
+                    with np.errstate(divide='ignore'):
+                        anderson.record(np.log(old_b.astype(np.float64)), np.log(b.astype(np.float64)))
 
                 # stabilization
-                if (max(max(abs(a)), max(abs(b))) > tau):
-                    u = u + epsilon_i * np.log(a)
-                    v = v + epsilon_i * np.log(b)  # absorb
-                    K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
-                    a, b = np.ones(I), np.ones(J)
+                if a.max() > tau or b.max() > tau:
+                    _absorb(u, a, epsilon_i)
+                    _absorb(v, b, epsilon_i)
+                    _update_kernel(K, C, u, v, epsilon_i)
+                    _scaling_exponent(u, lambda1 + epsilon_i, out=exp_u_a)
+                    _scaling_exponent(v, lambda2 + epsilon_i, out=exp_v_b)
+                    absorbed = True
+                    trace.record_absorption()
+                    if anderson is not None:
+                        anderson.reset()
 
-                if current_iter >= max_iter:
-                    logger.warning("Reached max_iter with duality gap still above threshold. Returning")
-                    return (K.T * a).T * b
+                if current_iter >= iteration_limit or (deadline is not None and time.time() >= deadline):
+                    if current_iter >= max_iter:
+                        logger.warning("Reached max_iter with duality gap still above threshold. Returning")
+                    else:
+                        logger.warning("Solver budget exhausted with duality gap still above threshold. Returning")
+                    if not final_stage:
+                        kernel_mass = _kernel_mass(C, epsilon_i, dx, dy)
+                    trace.record_duality_gap(marginal_duality_gap(True))
+                    trace.budget_exhausted = current_iter < max_iter
+                    trace.end_stage(current_iter - stage_start_iter, converged=False)
+                    _log_iterations(current_iter, start_time)
+                    K *= a[:, np.newaxis]
+                    K *= b
+                    K /= J
+                    if return_potentials:
+                        return K, _dual_potentials(u, a, v, b, epsilon_i)
+                    return K
 
-            # The real dual variables. a and b are only the stabilized variables
-            _a = a * np.exp(u / epsilon_i)
-            _b = b * np.exp(v / epsilon_i)
+            if overrelaxation:
+                if not residual <= batch_residual and omega_i > 1:
+                    # Safeguard: the overrelaxed iterations stopped converging, fall back to a smaller omega
+                    omega_max = (1 + omega_i) / 2
+                    omega_i = omega_max if omega_max > 1.05 else 1
+                    logger.debug('Overrelaxation diverging, falling back to omega={:.3f}'.format(omega_i))
+                elif omega is None and omega_i == 1 and 0 < residual < previous_residual:
+                    # The convergence rate of the plain iterations gives the optimal overrelaxation parameter
+                    omega_i = min(omega_max, 2 / (1 + np.sqrt(1 - residual / previous_residual)))
+                batch_residual = residual
 
             # Skip duality gap computation for the first epsilon scalings, use dual variables evolution instead
-            if e == epsilon_scalings:
-                R = (K.T * a).T * b
-                pri = primal(C, _K, R, dx, dy, p, q, _a, _b, epsilon_i, lambda1, lambda2)
-                dua = dual(C, _K, R, dx, dy, p, q, _a, _b, epsilon_i, lambda1, lambda2)
-                duality_gap = (pri - dua) / abs(pri)
+            if final_stage:
+                duality_gap = marginal_duality_gap(absorbed)
             else:
+                # The real dual variables. a and b are only the stabilized variables
+                # Computed in float64, as exp(u / epsilon) easily overflows in single precision
+                exp_u = np.exp(u.astype(np.float64) / epsilon_i)
+                exp_v = np.exp(v.astype(np.float64) / epsilon_i)
+                _a = a * exp_u
+                _b = b * exp_v
                 duality_gap = max(
-                    np.linalg.norm(_a - old_a * np.exp(u / epsilon_i)) / (1 + np.linalg.norm(_a)),
-                    np.linalg.norm(_b - old_b * np.exp(v / epsilon_i)) / (1 + np.linalg.norm(_b)))
+                    np.linalg.norm(_a - old_a * exp_u) / (1 + np.linalg.norm(_a)),
+                    np.linalg.norm(_b - old_b * exp_v) / (1 + np.linalg.norm(_b)))
+            trace.record_duality_gap(duality_gap)
+        trace.end_stage(current_iter - stage_start_iter)
 
     if np.isnan(duality_gap):
         raise RuntimeError("Overflow encountered in duality gap computation, please report this incident")
-    return R / C.shape[1]
+    _log_iterations(current_iter, start_time)
+    # The kernel is not needed anymore, build the transport map in its buffer
+    K *= a[:, np.newaxis]
+    K *= b
+    K /= J
+    if return_potentials:
+        return K, _dual_potentials(u, a, v, b, epsilon_i)
+    return K
+
+
+def optimal_transport_duality_gap_batch(C, G, lambda1, lambda2, epsilon, batch_size, tolerance, tau, epsilon0,
+                                        max_iter, dtype=np.float64, trace=None, **ignored):
+    """
+    Compute several independent transport maps together, such as all covariate-restricted maps of a day pair.
+
+    The problems are padded to a common shape and stacked, so that each scaling iteration updates all of them
+    with a few vectorized operations instead of one Python loop per problem. Each problem keeps its own
+    stabilization and convergence state, and stops being updated once its duality gap is below `tolerance`,
+    so that the results match those of optimal_transport_duality_gap. Once some problems are done, the kernel
+    products of the others are computed one problem at a time. Memory usage is that of the padded stack,
+    problems of very different sizes are better solved in separate batches.
+
+    Parameters
+    ----------
+    C : list of 2-D ndarray
+        The cost matrix of each problem.
+    G : list of 1-D array_like
+        Growth value for the input cells of each problem.
+    lambda1, lambda2, epsilon, batch_size, tolerance, tau, epsilon0, max_iter, dtype
+        As in optimal_transport_duality_gap, shared by all problems.
+    trace : list of wot.ot.SolverTrace, optional
+        One trace per problem, recording its scaling iterations as optimal_transport_duality_gap does.
+        The kernel buffers recorded are those of the whole padded stack.
+
+    Returns
+    -------
+    transport_maps : list of 2-D ndarray
+        The entropy-regularized unbalanced transport map of each problem
+    """
+    if len(C) != len(G):
+        raise ValueError("Expected as many growth vectors as cost matrices, got {} and {}".format(len(G), len(C)))
+    if trace is not None and len(trace) != len(C):
+        raise ValueError("Expected as many traces as cost matrices, got {} and {}".format(len(trace), len(C)))
+    start_time = time.time()
+    dtype = np.dtype(dtype)
+    epsilon_schedule = _epsilon_schedule(epsilon, epsilon0)
+    tolerance = max(tolerance, _min_tolerance(dtype))
+    shapes = [np.shape(c) for c in C]
+    B = len(C)
+    I, J = max(shape[0] for shape in shapes), max(shape[1] for shape in shapes)
+
+    # Padding costs are infinite, so that padding kernel entries are zero whatever the dual potentials
+    cost = np.full((B, I, J), np.inf, dtype=dtype)
+    dx, dy = np.zeros((B, I), dtype=dtype), np.zeros((B, J), dtype=dtype)
+    p, q = np.zeros((B, I), dtype=dtype), np.zeros((B, J), dtype=dtype)
+    for k, (c, g) in enumerate(zip(C, G)):
+        n, m = shapes[k]
+        cost[k, :n, :m] = c
+        dx[k, :n], dy[k, :m] = 1 / n, 1 / m
+        p[k, :n], q[k, :m] = g, np.average(g)
+    row_padding, col_padding = dx == 0, dy == 0
+
+    u, v = np.zeros((B, I), dtype=dtype), np.zeros((B, J), dtype=dtype)
+    a, b = np.ones((B, I), dtype=dtype), np.ones((B, J), dtype=dtype)
+    K = np.empty_like(cost)
+    K_T = K.transpose(0, 2, 1)
+    exp_u_a, exp_v_b = np.ones((B, I), dtype=dtype), np.ones((B, J), dtype=dtype)
+    result = [None] * B
+    n_iter = np.zeros(B, dtype=int)
+    converging = np.ones(B, dtype=bool)
+    trace = [SolverTrace() for _ in range(B)] if trace is None else trace
+    for t in trace:
+        t.record_kernel(cost, K)
+
+    def absorb(k, epsilon_i):
+        # Padding scaling variables are zero, leave their potentials untouched
+        u[k] += epsilon_i * np.log(np.where(row_padding[k], 1, a[k]))
+        v[k] += epsilon_i * np.log(np.where(col_padding[k], 1, b[k]))
+        a[k], b[k] = 1, 1
+
+    def update_kernel(k, epsilon_i):
+        K[k] = np.exp((u[k][:, :, np.newaxis] - cost[k] + v[k][:, np.newaxis, :]) / epsilon_i)
+        exp_u_a[k] = np.exp(-u[k] / (lambda1 + epsilon_i))
+        exp_v_b[k] = np.exp(-v[k] / (lambda2 + epsilon_i))
+
+    def kernel_products(K, x, dx, padding, active):
+        # K.(x * dx) for the active problems, set to 1 in the padding so that scaling variables are zero there.
+        # Indexing K with a mask would copy the kernels: once some problems are done, the products of the others
+        # are computed one problem at a time.
+        if active.all():
+            Kx = np.matmul(K, (x * dx)[:, :, np.newaxis])[:, :, 0]
+        else:
+            Kx = np.stack([K[k].dot(x[k] * dx[k]) for k in np.where(active)[0]])
+        Kx[padding[active]] = 1
+        return Kx
+
+    def transport_map(k):
+        n, m = shapes[k]
+        return (K[k, :n, :m] * a[k, :n, np.newaxis] * b[k, :m]) / m
+
+    epsilon_i = epsilon_schedule[0]
+    for e in range(len(epsilon_schedule)):
+        final_stage = e == len(epsilon_schedule) - 1
+        absorb(converging, epsilon_i)
+        epsilon_i = epsilon_schedule[e]
+        alpha1 = lambda1 / (lambda1 + epsilon_i)
+        alpha2 = lambda2 / (lambda2 + epsilon_i)
+        update_kernel(converging, epsilon_i)
+        for k in np.where(converging)[0]:
+            trace[k].start_stage(epsilon_i)
+        stage_start_iter = n_iter.copy()
+        threshold = tolerance if final_stage else max(1e-6, _min_tolerance(dtype))
+        if final_stage:
+            kernel_mass = np.array([_kernel_mass(c, epsilon_i, dx[k, :shapes[k][0]], dy[k, :shapes[k][1]])
+                                    for k, c in enumerate(C)])
+        active = converging.copy()
+
+        while active.any():
+            for i in range(batch_size if final_stage else 5):
+                if not active.any():
+                    break
+                n_iter[active] += 1
+                old_a, old_b = a.copy(), b.copy()
+                a[active] = (p[active] / kernel_products(K, b, dy, row_padding, active)) ** alpha1 * exp_u_a[active]
+                b[active] = (q[active] / kernel_products(K_T, a, dx, col_padding, active)) ** alpha2 * exp_v_b[active]
+
+                # stabilization, only for the problems whose scaling variables grew too large
+                stabilize = active & ((a.max(axis=1) > tau) | (b.max(axis=1) > tau))
+                if stabilize.any():
+                    absorb(stabilize, epsilon_i)
+                    update_kernel(stabilize, epsilon_i)
+                    for k in np.where(stabilize)[0]:
+                        trace[k].record_absorption()
+
+                for k in np.where(active & (n_iter >= max_iter))[0]:
+                    logger.warning("Reached max_iter with duality gap still above threshold. Returning")
+                    result[k] = transport_map(k)
+                    active[k] = converging[k] = False
+                    trace[k].end_stage(n_iter[k] - stage_start_iter[k], converged=False)
+
+            if not active.any():
+                break
+            if final_stage:
+                # In the padding, marginals and growth are set to 1 and potentials to 0, so that it adds nothing
+                rows, cols = row_padding[active], col_padding[active]
+                with np.errstate(divide='ignore'):
+                    f = np.where(rows, 0, u[active] + epsilon_i * np.log(a[active].astype(np.float64)))
+                    g = np.where(cols, 0, v[active] + epsilon_i * np.log(b[active].astype(np.float64)))
+                row_marginal = np.where(rows, 1, a[active] * kernel_products(K, b, dy, row_padding, active))
+                col_marginal = np.where(cols, 1, b[active] * kernel_products(K_T, a, dx, col_padding, active))
+                duality_gap = np.full(B, np.inf)
+                duality_gap[active] = _marginal_duality_gap(row_marginal, col_marginal, f, g,
+                                                            np.where(rows, 1, p[active]), np.where(cols, 1, q[active]),
+                                                            dx[active], dy[active], kernel_mass[active], epsilon_i,
+                                                            lambda1, lambda2)
+                if np.isnan(duality_gap[active]).any():
+                    raise RuntimeError("Overflow encountered in duality gap computation, please report this incident")
+            else:
+                exp_u = np.exp(u.astype(np.float64) / epsilon_i)
+                exp_v = np.exp(v.astype(np.float64) / epsilon_i)
+                _a, _b = a * exp_u, b * exp_v
+                duality_gap = np.maximum(
+                    np.linalg.norm(_a - old_a * exp_u, axis=1) / (1 + np.linalg.norm(_a, axis=1)),
+                    np.linalg.norm(_b - old_b * exp_v, axis=1) / (1 + np.linalg.norm(_b, axis=1)))
+            for k in np.where(active)[0]:
+                trace[k].record_duality_gap(duality_gap[k])
+                if not duality_gap[k] > threshold:
+                    trace[k].end_stage(n_iter[k] - stage_start_iter[k])
+            active &= duality_gap > threshold
+
+    for k in np.where(converging)[0]:
+        result[k] = transport_map(k)
+    logger.info('{} problems solved in {} scaling iterations, {:.2f}s'.format(B, n_iter.max(),
+                                                                               time.time() - start_time))
+    return result
+
+
+def _kernel_mass(C, epsilon, dx, dy, block_size=None):
+    """Sum of dx_i * dy_j * exp(-C_ij / epsilon), accumulated in float64 over tiles of rows of C"""
+    I, J = C.shape
+    if block_size is None:
+        block_size = max(1, 2 ** 22 // J)
+    dx, dy = dx.astype(np.float64), dy.astype(np.float64)
+    mass = 0.0
+    for s in range(0, I, block_size):
+        tile = np.divide(C[s:s + block_size], -epsilon)
+        np.exp(tile, out=tile)
+        mass += np.dot(dx[s:s + block_size], tile.dot(dy))
+    return float(mass)
+
+
+def _log_iterations(n_iter, start_time):
+    logger.info('{} scaling iterations in {:.2f}s'.format(n_iter, time.time() - start_time))
 
 
 def transport_stablev2(C, lambda1, lambda2, epsilon, scaling_iter, G, tau, epsilon0, extra_iter, inner_iter_max,
-                       **ignored):
+                       dtype=np.float64, potentials=None, return_potentials=False, trace=None, time_budget=None,
+                       iter_budget=None, **ignored):
     """
     Compute the optimal transport with stabilized numerics.
     Args:
@@ -176,61 +655,1122 @@ def transport_stablev2(C, lambda1, lambda2, epsilon, scaling_iter, G, tau, epsil
         epsilon: entropy parameter
         scaling_iter: number of scaling iterations
         G: growth value for input cells
+        dtype: floating point type of the kernel, the scaling iterations and the returned transport map
+        potentials: dual potentials 'u' and 'v' of a previous solve, to start from at the final epsilon
+        return_potentials: also return the final dual potentials
+        trace: wot.ot.SolverTrace recording each epsilon stage, and the duality gap of the result
+        time_budget: wall time in seconds after which to stop iterating and return the current transport map
+        iter_budget: total number of scaling iterations, including extra_iter, after which to stop iterating
     """
+    deadline = None if time_budget is None else time.time() + time_budget
+    iteration_limit = scaling_iter + extra_iter if iter_budget is None else min(scaling_iter + extra_iter,
+                                                                                iter_budget)
 
-    warm_start = tau is not None
+    epsilon_scaling = tau is not None and potentials is None
     epsilon_final = epsilon
 
     def get_reg(n):  # exponential decreasing
-        return (epsilon0 - epsilon_final) * np.exp(-n) + epsilon_final
+        return float((epsilon0 - epsilon_final) * np.exp(-n) + epsilon_final)
 
-    epsilon_i = epsilon0 if warm_start else epsilon
-    dx = np.ones(C.shape[0]) / C.shape[0]
-    dy = np.ones(C.shape[1]) / C.shape[1]
+    epsilon_i = epsilon0 if epsilon_scaling else epsilon
+    dtype = np.dtype(dtype)
+    C = np.asarray(C, dtype=dtype)
+    dx = np.ones(C.shape[0], dtype=dtype) / C.shape[0]
+    dy = np.ones(C.shape[1], dtype=dtype) / C.shape[1]
 
-    p = G
-    q = np.ones(C.shape[1]) * np.average(G)
+    p = np.asarray(G, dtype=dtype)
+    q = np.full(C.shape[1], np.average(G), dtype=dtype)
 
-    u = np.zeros(len(p))
-    v = np.zeros(len(q))
-    b = np.ones(len(q))
-    K = np.exp(-C / epsilon_i)
+    u = _initial_potential(potentials, 'u', len(p), dtype)
+    v = _initial_potential(potentials, 'v', len(q), dtype)
+    a = np.ones(len(p), dtype=dtype)
+    b = np.ones(len(q), dtype=dtype)
+    K_b, K_a = np.empty(len(p), dtype=dtype), np.empty(len(q), dtype=dtype)
+    b_dy, a_dx = np.empty(len(q), dtype=dtype), np.empty(len(p), dtype=dtype)
+    exp_u_a, exp_v_b = np.ones(len(p), dtype=dtype), np.ones(len(q), dtype=dtype)
+    if potentials is None:
+        K = _update_kernel(np.empty_like(C), C, None, None, epsilon_i)
+    else:
+        K = _update_kernel(np.empty_like(C), C, u, v, epsilon_i)
+        _scaling_exponent(u, lambda1 + epsilon_i, out=exp_u_a)
+        _scaling_exponent(v, lambda2 + epsilon_i, out=exp_v_b)
+    # The duality gap of the result is only computed on request, it costs a pass over C
+    measure_duality_gap = trace is not None
+    trace = SolverTrace() if trace is None else trace
+    trace.record_kernel(K)
+    trace.start_stage(epsilon_i)
 
     alpha1 = lambda1 / (lambda1 + epsilon_i)
     alpha2 = lambda2 / (lambda2 + epsilon_i)
     epsilon_index = 0
     iterations_since_epsilon_adjusted = 0
 
+    def out_of_budget(current_iter):
+        if current_iter < iteration_limit and (deadline is None or time.time() < deadline):
+            return False
+        logger.warning("Solver budget exhausted before the end of the scaling iterations. Returning")
+        trace.budget_exhausted = True
+        return True
+
+    current_iter = 0
     for i in range(scaling_iter):
+        if out_of_budget(current_iter):
+            break
+        current_iter += 1
         # scaling iteration
-        a = (p / (K.dot(np.multiply(b, dy)))) ** alpha1 * np.exp(-u / (lambda1 + epsilon_i))
-        b = (q / (K.T.dot(np.multiply(a, dx)))) ** alpha2 * np.exp(-v / (lambda2 + epsilon_i))
+        _scaling_update(K, b, dy, p, alpha1, exp_u_a, b_dy, K_b, out=a)
+        _scaling_update(K.T, a, dx, q, alpha2, exp_v_b, a_dx, K_a, out=b)
 
         # stabilization
         iterations_since_epsilon_adjusted += 1
-        if (max(max(abs(a)), max(abs(b))) > tau):
-            u = u + epsilon_i * np.log(a)
-            v = v + epsilon_i * np.log(b)  # absorb
-            K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
-            a = np.ones(len(p))
-            b = np.ones(len(q))
-
-        if (warm_start and iterations_since_epsilon_adjusted == inner_iter_max):
+        if a.max() > tau or b.max() > tau:
+            _absorb(u, a, epsilon_i)
+            _absorb(v, b, epsilon_i)
+            _update_kernel(K, C, u, v, epsilon_i)
+            _scaling_exponent(u, lambda1 + epsilon_i, out=exp_u_a)
+            _scaling_exponent(v, lambda2 + epsilon_i, out=exp_v_b)
+            trace.record_absorption()
+
+        if (epsilon_scaling and iterations_since_epsilon_adjusted == inner_iter_max):
+            trace.end_stage(iterations_since_epsilon_adjusted)
             epsilon_index += 1
             iterations_since_epsilon_adjusted = 0
-            u = u + epsilon_i * np.log(a)
-            v = v + epsilon_i * np.log(b)  # absorb
+            _absorb(u, a, epsilon_i)
+            _absorb(v, b, epsilon_i)
             epsilon_i = get_reg(epsilon_index)
+            trace.start_stage(epsilon_i)
             alpha1 = lambda1 / (lambda1 + epsilon_i)
             alpha2 = lambda2 / (lambda2 + epsilon_i)
-            K = np.exp((np.array([u]).T - C + np.array([v])) / epsilon_i)
-            a = np.ones(len(p))
-            b = np.ones(len(q))
+            _update_kernel(K, C, u, v, epsilon_i)
+            _scaling_exponent(u, lambda1 + epsilon_i, out=exp_u_a)
+            _scaling_exponent(v, lambda2 + epsilon_i, out=exp_v_b)
+
+    extra_iterations = 0
+    while extra_iterations < extra_iter and not trace.budget_exhausted and not out_of_budget(current_iter):
+        _scaling_update(K, b, dy, p, alpha1, exp_u_a, b_dy, K_b, out=a)
+        _scaling_update(K.T, a, dx, q, alpha2, exp_v_b, a_dx, K_a, out=b)
+        extra_iterations += 1
+        current_iter += 1
+    if measure_duality_gap:
+        np.multiply(b, dy, out=b_dy)
+        np.dot(K, b_dy, out=K_b)
+        with np.errstate(divide='ignore'):
+            f = u + epsilon_i * np.log(a.astype(np.float64))
+            g = v + epsilon_i * np.log(b.astype(np.float64))
+        trace.record_duality_gap(_marginal_duality_gap(a * K_b, b * K_a, f, g, p, q, dx, dy,
+                                                       _kernel_mass(C, epsilon_i, dx, dy), epsilon_i, lambda1,
+                                                       lambda2))
+    trace.end_stage(iterations_since_epsilon_adjusted + extra_iterations, converged=not trace.budget_exhausted)
+
+    # The kernel is not needed anymore, build the transport map in its buffer
+    K *= a[:, np.newaxis]
+    K *= b
+    K /= C.shape[1]
+    if return_potentials:
+        return K, _dual_potentials(u, a, v, b, epsilon_i)
+    return K
+
+
+def _masked_dot(K, indices, x):
+    """K[:, indices].dot(x), without copying the selected columns of K when they are a large part of it"""
+    if 4 * len(indices) < K.shape[1]:
+        return K[:, indices].dot(x)
+    dense_x = np.zeros(K.shape[1], dtype=x.dtype)
+    dense_x[indices] = x
+    return K.dot(dense_x)
+
+
+def optimal_transport_greedy(C, G, lambda1, lambda2, epsilon, batch_size, tolerance, tau, epsilon0, max_iter,
+                             dtype=np.float64, greedy_ratio=0.5, potentials=None, return_potentials=False,
+                             trace=None, time_budget=None, iter_budget=None, **ignored):
+    """
+    Compute the optimal transport with greedy coordinate updates of the scaling variables (Greenkhorn).
+
+    Instead of updating all of a, then all of b, each step only updates the rows, or the columns, whose scaling
+    variable is furthest from its fixed point. Running row and column sums of the coupling are updated
+    incrementally, so that a step costs O(k * m) or O(k * n) for k updated rows or columns. Rows or columns that
+    have already converged, e.g. on the larger side of a strongly unbalanced day pair, are not visited again.
+
+    Parameters
+    ----------
+    C : 2-D ndarray
+        The cost matrix. C[i][j] is the cost to transport cell i to cell j
+    G : 1-D array_like
+        Growth value for input cells.
+    lambda1 : float, optional
+        Regularization parameter for the marginal constraint on p
+    lambda2 : float, optional
+        Regularization parameter for the marginal constraint on q
+    epsilon : float, optional
+        Entropy regularization parameter.
+    batch_size : int, optional
+        Number of iterations to perform between each duality gap check
+    tolerance : float, optional
+        Upper bound on the duality gap that the resulting transport map must guarantee.
+    tau : float, optional
+        Threshold at which to perform numerical stabilization
+    epsilon0 : float, optional
+        Starting value for exponentially-decreasing epsilon
+    max_iter : int, optional
+        Maximum number of iterations. Print a warning and return if it is reached, even without convergence.
+        An iteration is n + m coordinate updates, the work of one full alternating update of a and b.
+    dtype : str or numpy.dtype, optional
+        Floating point type of the kernel, the scaling iterations and the returned transport map.
+    greedy_ratio : float, optional
+        Each step updates the rows, or columns, whose violation is at least greedy_ratio times the largest one.
+        Values close to 1 update one coordinate at a time, as in the original Greenkhorn algorithm.
+    potentials : dict, optional
+        Dual potentials 'u' and 'v' returned by a previous solve, e.g. at a previous growth iteration.
+        The scaling iterations start from them at the final value of epsilon, skipping epsilon scaling.
+    return_potentials : bool, optional
+        Also return the final dual potentials, to warm-start another solve.
+    trace : wot.ot.SolverTrace, optional
+        Records the iterations, duality gaps and absorptions of each epsilon stage
+    time_budget : float, optional
+        Wall time, in seconds, after which to stop iterating and return the current transport map.
+    iter_budget : int, optional
+        Total number of iterations, over all epsilon stages, after which to stop iterating and return
+        the current transport map.
+
+    Returns
+    -------
+    tmap : 2-D ndarray
+        The entropy-regularized unbalanced transport map
+    potentials : dict
+        The final dual potentials, only if return_potentials is set
+    """
+    if not 0 < greedy_ratio <= 1:
+        raise ValueError('greedy_ratio must be in (0, 1], got {}'.format(greedy_ratio))
+    start_time = time.time()
+    dtype = np.dtype(dtype)
+    C = np.asarray(C, dtype=dtype)
+    I, J = C.shape
+    dx, dy = np.ones(I, dtype=dtype) / I, np.ones(J, dtype=dtype) / J
+    p = np.asarray(G, dtype=dtype)
+    q = np.full(J, np.average(G), dtype=dtype)
+
+    u = _initial_potential(potentials, 'u', I, dtype)
+    v = _initial_potential(potentials, 'v', J, dtype)
+    a, b = np.ones(I, dtype=dtype), np.ones(J, dtype=dtype)
+    exp_u_a, exp_v_b = np.ones(I, dtype=dtype), np.ones(J, dtype=dtype)
+    K = np.empty_like(C)
+    trace = SolverTrace() if trace is None else trace
+    trace.record_kernel(K)
+
+    epsilon_schedule = _warm_start_schedule(epsilon, epsilon0, potentials)
+    iteration_limit = max_iter if iter_budget is None else min(max_iter, iter_budget)
+    deadline = None if time_budget is None else start_time + time_budget
+    epsilon_i = epsilon_schedule[0]
+    # Work is counted in coordinate updates, I + J of them make an iteration
+    updates = 0
+    stopped = False
+
+    for e in range(len(epsilon_schedule)):
+        final_stage = e == len(epsilon_schedule) - 1
+        _absorb(u, a, epsilon_i)
+        _absorb(v, b, epsilon_i)
+        epsilon_i = epsilon_schedule[e]
+        trace.start_stage(epsilon_i)
+        stage_start_updates = updates
+        kernel_mass = _kernel_mass(C, epsilon_i, dx, dy) if final_stage else None
+        alpha1 = lambda1 / (lambda1 + epsilon_i)
+        alpha2 = lambda2 / (lambda2 + epsilon_i)
+        _update_kernel(K, C, u, v, epsilon_i)
+        _scaling_exponent(u, lambda1 + epsilon_i, out=exp_u_a)
+        _scaling_exponent(v, lambda2 + epsilon_i, out=exp_v_b)
+        threshold = tolerance if final_stage else max(1e-6, _min_tolerance(dtype))
+        check_interval = (batch_size if final_stage else 5) * (I + J)
+        next_check = updates + check_interval
+        # Running sums K.(b * dy) and K.T.(a * dx)
+        K_b, K_a = K.dot(b * dy), K.T.dot(a * dx)
+
+        while True:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                new_a = (p / K_b) ** alpha1 * exp_u_a
+                new_b = (q / K_a) ** alpha2 * exp_v_b
+                row_violation = np.abs(np.log(new_a / a))
+                col_violation = np.abs(np.log(new_b / b))
+            max_row_violation, max_col_violation = row_violation.max(), col_violation.max()
+
+            if updates >= next_check or (not final_stage and max(max_row_violation, max_col_violation) <= threshold):
+                next_check = updates + check_interval
+                if final_stage:
+                    # Refresh the running sums, which accumulate rounding errors, and check the duality gap
+                    K_b, K_a = K.dot(b * dy), K.T.dot(a * dx)
+                    with np.errstate(divide='ignore'):
+                        f = u + epsilon_i * np.log(a.astype(np.float64))
+                        g = v + epsilon_i * np.log(b.astype(np.float64))
+                    duality_gap = _marginal_duality_gap(a * K_b, b * K_a, f, g, p, q, dx, dy, kernel_mass,
+                                                        epsilon_i, lambda1, lambda2)
+                else:
+                    duality_gap = max(max_row_violation, max_col_violation)
+                trace.record_duality_gap(duality_gap)
+                if np.isnan(duality_gap):
+                    raise RuntimeError("Overflow encountered in duality gap computation, please report this incident")
+                if duality_gap <= threshold:
+                    break
+                if updates >= iteration_limit * (I + J) or (deadline is not None and time.time() >= deadline):
+                    if updates >= max_iter * (I + J):
+                        logger.warning("Reached max_iter with duality gap still above threshold. Returning")
+                    else:
+                        logger.warning("Solver budget exhausted with duality gap still above threshold. Returning")
+                        trace.budget_exhausted = True
+                    stopped = True
+                    break
+                continue
+
+            if max_row_violation >= max_col_violation:
+                rows = np.flatnonzero(row_violation >= greedy_ratio * max_row_violation)
+                K_a += _masked_dot(K.T, rows, (new_a[rows] - a[rows]) * dx[rows])
+                a[rows] = new_a[rows]
+                updates += len(rows)
+            else:
+                cols = np.flatnonzero(col_violation >= greedy_ratio * max_col_violation)
+                K_b += _masked_dot(K, cols, (new_b[cols] - b[cols]) * dy[cols])
+                b[cols] = new_b[cols]
+                updates += len(cols)
+
+            # stabilization
+            if a.max() > tau or b.max() > tau:
+                _absorb(u, a, epsilon_i)
+                _absorb(v, b, epsilon_i)
+                _update_kernel(K, C, u, v, epsilon_i)
+                _scaling_exponent(u, lambda1 + epsilon_i, out=exp_u_a)
+                _scaling_exponent(v, lambda2 + epsilon_i, out=exp_v_b)
+                K_b, K_a = K.dot(b * dy), K.T.dot(a * dx)
+                trace.record_absorption()
+
+        trace.end_stage((updates - stage_start_updates) // (I + J), converged=not stopped)
+        if stopped:
+            break
+
+    _log_iterations(updates // (I + J), start_time)
+    # The kernel is not needed anymore, build the transport map in its buffer
+    K *= a[:, np.newaxis]
+    K *= b
+    K /= J
+    if return_potentials:
+        return K, _dual_potentials(u, a, v, b, epsilon_i)
+    return K
+
+
+def optimal_transport_streaming(X, Y, G, lambda1, lambda2, epsilon, batch_size, tolerance, epsilon0, max_iter,
+                                dtype=np.float64, cost_scale=None, block_size=None, out=None, potentials=None,
+                                return_potentials=False, **ignored):
+    """
+    Compute the optimal transport between two point clouds without materializing the cost matrix or the kernel.
+
+    Scaling iterations are performed on the log-domain dual potentials. The squared euclidean cost is recomputed
+    tile by tile inside blocked log-sum-exp reductions, so that memory usage is O(block_size * m) instead of O(n * m).
+
+    Parameters
+    ----------
+    X : 2-D ndarray
+        Coordinates of the source cells, e.g. in local PCA space.
+    Y : 2-D ndarray
+        Coordinates of the destination cells.
+    G : 1-D array_like
+        Growth value for input cells.
+    lambda1 : float
+        Regularization parameter for the marginal constraint on p
+    lambda2 : float
+        Regularization parameter for the marginal constraint on q
+    epsilon : float
+        Entropy regularization parameter.
+    batch_size : int
+        Number of iterations to perform between each convergence check
+    tolerance : float
+        Upper bound on the change of the dual potentials, relative to epsilon, at convergence.
+    epsilon0 : float
+        Starting value for exponentially-decreasing epsilon
+    max_iter : int
+        Maximum number of iterations. Print a warning and return if it is reached, even without convergence.
+    dtype : str or numpy.dtype, optional
+        Floating point type of the cost tiles and of the returned transport map.
+    cost_scale : float, optional
+        The cost is the squared euclidean distance divided by cost_scale.
+        Defaults to an estimate of the median squared distance, as in OTModel.compute_default_cost_matrix
+    block_size : int, optional
+        Number of source cells per tile. Defaults to tiles of about 4 million entries.
+    out : array_like, optional
+        Destination for the transport map, written one tile at a time. Any 2-D array supporting slice assignment
+        can be used, such as a numpy.memmap or an h5py.Dataset, to write the transport map directly to disk.
+    potentials : dict, optional
+        Dual potentials 'u' and 'v' returned by a previous solve, e.g. at a previous growth iteration.
+        The scaling iterations start from them at the final value of epsilon, skipping epsilon scaling.
+    return_potentials : bool, optional
+        Also return the final dual potentials, as a dict with keys 'u', 'v' and 'epsilon'.
+
+    Returns
+    -------
+    transport_map : 2-D array_like
+        The entropy-regularized unbalanced transport map, or `out` if it was given.
+    potentials : dict
+        The final dual potentials. Only returned if return_potentials is True.
+    """
+    dtype = np.dtype(dtype)
+    X = np.asarray(X, dtype=dtype)
+    Y = np.asarray(Y, dtype=dtype)
+    I, J = X.shape[0], Y.shape[0]
+    if cost_scale is None:
+        cost_scale = _estimate_median_sqeuclidean(X, Y)
+    if block_size is None:
+        block_size = max(1, 2 ** 22 // J)
+    blocks = [slice(s, min(s + block_size, I)) for s in range(0, I, block_size)]
+    x_sq = np.einsum('ij,ij->i', X, X)
+    y_sq = np.einsum('ij,ij->i', Y, Y)
+
+    def cost_tile(rows):
+        tile = _sqeuclidean_tile(X[rows], x_sq[rows], Y, y_sq)
+        tile /= cost_scale
+        return tile
+
+    with np.errstate(divide='ignore'):
+        log_p = np.log(np.asarray(G, dtype=np.float64))
+    log_q = np.full(J, np.log(np.average(G)))
+    log_dx, log_dy = -np.log(I), -np.log(J)
+
+    f, g = _initial_potential(potentials, 'u', I, np.float64), _initial_potential(potentials, 'v', J, np.float64)
+    old_f, old_g = np.zeros(I), np.zeros(J)
+
+    epsilon_schedule = _warm_start_schedule(epsilon, epsilon0, potentials)
+    current_iter = 0
+
+    for e, epsilon_i in enumerate(epsilon_schedule):
+        final_stage = e == len(epsilon_schedule) - 1
+        alpha1 = lambda1 / (lambda1 + epsilon_i)
+        alpha2 = lambda2 / (lambda2 + epsilon_i)
+        threshold = tolerance if final_stage else max(1e-6, _min_tolerance(dtype))
+        change = np.inf
+        while change > threshold and current_iter < max_iter:
+            for i in range(batch_size if final_stage else 5):
+                current_iter += 1
+                np.copyto(old_f, f)
+                np.copyto(old_g, g)
+                # f = alpha1 * (epsilon * log(p) - epsilon * LSE_j((g_j - C_ij) / epsilon + log(dy)))
+                for rows in blocks:
+                    tile = cost_tile(rows)
+                    np.subtract(g, tile, out=tile)
+                    tile /= epsilon_i
+                    f[rows] = alpha1 * epsilon_i * (log_p[rows] - log_dy - _logsumexp(tile, axis=1))
+                # g = alpha2 * (epsilon * log(q) - epsilon * LSE_i((f_i - C_ij) / epsilon + log(dx)))
+                col_max, col_sum = None, None
+                for rows in blocks:
+                    tile = cost_tile(rows)
+                    np.subtract(f[rows, np.newaxis], tile, out=tile)
+                    tile /= epsilon_i
+                    col_max, col_sum = _logsumexp_accumulate(tile, col_max, col_sum)
+                g[:] = alpha2 * epsilon_i * (log_q - log_dx - (col_max + np.log(col_sum)))
+            change = max(np.max(np.abs(f - old_f)), np.max(np.abs(g - old_g))) / epsilon_i
+        if change > threshold:
+            logger.warning("Reached max_iter with dual potentials still changing. Returning")
+            break
 
-    for i in range(extra_iter):
-        a = (p / (K.dot(np.multiply(b, dy)))) ** alpha1 * np.exp(-u / (lambda1 + epsilon_i))
-        b = (q / (K.T.dot(np.multiply(a, dx)))) ** alpha2 * np.exp(-v / (lambda2 + epsilon_i))
+    if out is None:
+        out = np.empty((I, J), dtype=dtype)
+    for rows in blocks:
+        tile = cost_tile(rows)
+        np.subtract(f[rows, np.newaxis], tile, out=tile)
+        tile += g
+        tile /= epsilon_i
+        np.exp(tile, out=tile)
+        tile /= J
+        out[rows] = tile
+    if return_potentials:
+        return out, {'u': f, 'v': g, 'epsilon': epsilon_i}
+    return out
 
-    R = (K.T * a).T * b
 
-    return R / C.shape[1]
+def sqeuclidean_cost_matrix(X, Y, dtype=np.float64, normalize=True, out=None, block_size=None,
+                            median_sample_size=100000, random_state=58951):
+    """
+    Squared euclidean distances between the rows of X and Y, normalized by their median.
+
+    The distances are computed by blocks of rows as ||x||^2 + ||y||^2 - 2 x.y^T, with one GEMM per block
+    written directly into the output buffer, in the given dtype.
+
+    Parameters
+    ----------
+    X : 2-D array_like
+        Coordinates of the cells at the first timepoint
+    Y : 2-D array_like
+        Coordinates of the cells at the second timepoint
+    dtype : numpy dtype, optional
+        Data type of the cost matrix
+    normalize : bool, optional
+        Whether to divide the distances by their median
+    out : 2-D ndarray, optional
+        Preallocated C-contiguous buffer of shape (len(X), len(Y)) and the given dtype
+    block_size : int, optional
+        Number of rows per block. Defaults to blocks of about 4M entries.
+    median_sample_size : int or None, optional
+        The median is estimated on this many randomly sampled entries. None to compute it exactly.
+    random_state : int, optional
+        Seed of the entries sampled for the median
+
+    Returns
+    -------
+    cost_matrix : 2-D ndarray
+        The (normalized) squared euclidean distances, or `out` if it was given
+    """
+    dtype = np.dtype(dtype)
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    I, J = X.shape[0], Y.shape[0]
+    # Distances are invariant by translation: centering both clouds on their common mean limits the
+    # cancellation in ||x||^2 + ||y||^2 - 2 x.y^T
+    shift = (X.sum(axis=0) + Y.sum(axis=0)) / max(I + J, 1)
+    X = (X - shift).astype(dtype, copy=False)
+    Y = (Y - shift).astype(dtype, copy=False)
+    if out is None:
+        out = np.empty((I, J), dtype=dtype)
+    elif out.shape != (I, J) or out.dtype != dtype or not out.flags.c_contiguous:
+        raise ValueError('out must be a C-contiguous {} array of shape {}'.format(dtype, (I, J)))
+    if block_size is None:
+        block_size = max(1, 2 ** 22 // max(J, 1))
+    x_sq = np.einsum('ij,ij->i', X, X)
+    y_sq = np.einsum('ij,ij->i', Y, Y)
+    for start in range(0, I, block_size):
+        rows = slice(start, min(start + block_size, I))
+        tile = out[rows]
+        np.dot(X[rows], Y.T, out=tile)
+        tile *= -2
+        tile += x_sq[rows, np.newaxis]
+        tile += y_sq
+        np.maximum(tile, 0, out=tile)
+    if normalize:
+        out /= _sampled_median(out, median_sample_size, random_state)
+    return out
+
+
+def _sampled_median(a, sample_size, random_state=58951):
+    """Median of the entries of a, estimated on sample_size random entries (exact if None or above a.size)"""
+    if sample_size is None or a.size <= sample_size:
+        return np.median(a)
+    indices = np.random.RandomState(random_state).randint(a.size, size=sample_size)
+    return np.median(a.reshape(-1)[indices])
+
+
+def _sqeuclidean_tile(x, x_sq, y, y_sq):
+    """Squared euclidean distances between the rows of x and y, computed with a single GEMM"""
+    tile = np.dot(x, y.T)
+    tile *= -2
+    tile += x_sq[:, np.newaxis]
+    tile += y_sq
+    np.maximum(tile, 0, out=tile)
+    return tile
+
+
+def _estimate_median_sqeuclidean(X, Y, sample_size=100000, random_state=58951):
+    """Median of the squared euclidean distances between X and Y, estimated on a random sample of pairs"""
+    I, J = X.shape[0], Y.shape[0]
+    if I * J <= sample_size:
+        i, j = np.divmod(np.arange(I * J), J)
+    else:
+        rs = np.random.RandomState(random_state)
+        i, j = rs.randint(I, size=sample_size), rs.randint(J, size=sample_size)
+    diff = X[i] - Y[j]
+    return float(np.median(np.einsum('ij,ij->i', diff, diff)))
+
+
+def _logsumexp(tile, axis):
+    """Log-sum-exp reduction of tile along axis. Overwrites tile."""
+    tile_max = tile.max(axis=axis, keepdims=True)
+    tile -= tile_max
+    np.exp(tile, out=tile)
+    return np.log(tile.sum(axis=axis, dtype=np.float64)) + np.squeeze(tile_max, axis=axis)
+
+
+def _logsumexp_accumulate(tile, running_max, running_sum):
+    """Accumulates a column-wise streaming log-sum-exp over successive row tiles. Overwrites tile."""
+    tile_max = tile.max(axis=0).astype(np.float64)
+    if running_max is None:
+        running_max, running_sum = tile_max, np.zeros(tile.shape[1])
+    else:
+        new_max = np.maximum(running_max, tile_max)
+        running_sum *= np.exp(running_max - new_max)
+        running_max = new_max
+    tile -= running_max.astype(tile.dtype)
+    np.exp(tile, out=tile)
+    running_sum += tile.sum(axis=0, dtype=np.float64)
+    return running_max, running_sum
+
+
+def optimal_transport_sparse(X, Y, G, lambda1, lambda2, epsilon, batch_size, tolerance, tau, epsilon0, max_iter,
+                             dtype=np.float64, cost_scale=None, kernel_threshold=1e-8, kernel_knn=None,
+                             block_size=None, potentials=None, return_potentials=False, **ignored):
+    """
+    Compute the optimal transport between two point clouds on a truncated, sparse kernel, with the guarantee that
+    the duality gap of the truncated problem is at most `tolerance`.
+
+    Only the kernel entries exp(-C_ij / epsilon) above kernel_threshold times the largest entry of their row
+    are kept, or the kernel_knn nearest destination cells of each source cell. The nearest source cell of each
+    destination cell is always kept. The costs are computed tile by tile from the coordinates, and all scaling
+    iterations use sparse matrix-vector products, so that time and memory scale with the number of kept entries
+    instead of n * m.
+
+    Parameters
+    ----------
+    X : 2-D ndarray
+        Coordinates of the source cells, e.g. in local PCA space.
+    Y : 2-D ndarray
+        Coordinates of the destination cells.
+    G : 1-D array_like
+        Growth value for input cells.
+    lambda1 : float
+        Regularization parameter for the marginal constraint on p
+    lambda2 : float
+        Regularization parameter for the marginal constraint on q
+    epsilon : float
+        Entropy regularization parameter.
+    batch_size : int
+        Number of iterations to perform between each duality gap check
+    tolerance : float
+        Upper bound on the duality gap that the resulting transport map must guarantee.
+    tau : float
+        Threshold at which to perform numerical stabilization
+    epsilon0 : float
+        Starting value for exponentially-decreasing epsilon
+    max_iter : int
+        Maximum number of iterations. Print a warning and return if it is reached, even without convergence.
+    dtype : str or numpy.dtype, optional
+        Floating point type of the cost tiles, the kernel and the returned transport map.
+    cost_scale : float, optional
+        The cost is the squared euclidean distance divided by cost_scale.
+        Defaults to an estimate of the median squared distance, as in OTModel.compute_default_cost_matrix
+    kernel_threshold : float, optional
+        Relative threshold under which kernel entries are dropped.
+    kernel_knn : int, optional
+        Keep the kernel_knn nearest destination cells of each source cell instead of thresholding.
+    block_size : int, optional
+        Number of source cells per cost tile when building the kernel support.
+        Defaults to tiles of about 4 million entries.
+    potentials : dict, optional
+        Dual potentials 'u' and 'v' returned by a previous solve, e.g. at a previous growth iteration.
+        The scaling iterations start from them at the final value of epsilon, skipping epsilon scaling.
+    return_potentials : bool, optional
+        Also return the final dual potentials, as a dict with keys 'u', 'v' and 'epsilon'.
+
+    Returns
+    -------
+    transport_map : scipy.sparse.csr_matrix
+        The entropy-regularized unbalanced transport map
+    potentials : dict
+        The final dual potentials. Only returned if return_potentials is True.
+    """
+    dtype = np.dtype(dtype)
+    X = np.asarray(X, dtype=dtype)
+    Y = np.asarray(Y, dtype=dtype)
+    I, J = X.shape[0], Y.shape[0]
+    if cost_scale is None:
+        cost_scale = _estimate_median_sqeuclidean(X, Y)
+    support = _truncated_kernel_support(X, Y, cost_scale, epsilon, kernel_threshold, kernel_knn, block_size)
+    p = np.asarray(G, dtype=np.float64)
+    q = np.full(J, np.average(G))
+    dx, dy = np.ones(I) / I, np.ones(J) / J
+    epsilon_scalings = 5 if potentials is None else 0
+    u = None if potentials is None else _initial_potential(potentials, 'u', I, np.float64)
+    v = None if potentials is None else _initial_potential(potentials, 'v', J, np.float64)
+    R, u, v = _sparse_sinkhorn(support, p, q, dx, dy, lambda1, lambda2, epsilon, batch_size, tolerance, tau,
+                               epsilon0, max_iter, u=u, v=v, epsilon_scalings=epsilon_scalings)
+    R.data /= J
+    if return_potentials:
+        return R, {'u': u, 'v': v, 'epsilon': _epsilon_schedule(epsilon, epsilon0)[-1]}
+    return R
+
+
+def _truncated_kernel_support(X, Y, cost_scale, epsilon, kernel_threshold, kernel_knn, block_size=None):
+    """
+    Builds the support of the truncated kernel between the rows of X and Y, as a CSR matrix holding the costs of
+    the kept entries, in the dtype of X. Explicit zeros are kept : zero costs are part of the support.
+
+    The costs are computed by tiles of block_size rows, twice: once to find the nearest source cell of each
+    destination cell, and once to select the kept entries. Memory scales with block_size * m and the number of
+    kept entries.
+    """
+    I, J = X.shape[0], Y.shape[0]
+    if block_size is None:
+        block_size = max(1, 2 ** 22 // J)
+    # Distances are invariant by translation, centering limits the cancellation in the GEMM-based distances
+    shift = (X.sum(axis=0) + Y.sum(axis=0)) / max(I + J, 1)
+    X, Y = X - shift, Y - shift
+    x_sq, y_sq = np.einsum('ij,ij->i', X, X), np.einsum('ij,ij->i', Y, Y)
+    blocks = [slice(s, min(s + block_size, I)) for s in range(0, I, block_size)]
+
+    def cost_tile(rows):
+        tile = _sqeuclidean_tile(X[rows], x_sq[rows], Y, y_sq)
+        tile /= cost_scale
+        return tile
+
+    col_min, col_argmin = np.full(J, np.inf), np.zeros(J, dtype=np.intp)
+    for rows in blocks:
+        tile = cost_tile(rows)
+        tile_argmin = np.argmin(tile, axis=0)
+        tile_min = tile[tile_argmin, np.arange(J)]
+        closer = tile_min < col_min
+        col_min[closer] = tile_min[closer]
+        col_argmin[closer] = rows.start + tile_argmin[closer]
+
+    max_cost = None if kernel_knn is not None else -epsilon * np.log(kernel_threshold)
+    indices, costs, indptr = [], [], [np.zeros(1, dtype=np.int64)]
+    row_offset = 0
+    for rows in blocks:
+        tile = cost_tile(rows)
+        if kernel_knn is not None:
+            k = min(kernel_knn, J)
+            keep = np.zeros(tile.shape, dtype=bool)
+            np.put_along_axis(keep, np.argpartition(tile, k - 1, axis=1)[:, :k], True, axis=1)
+        else:
+            keep = tile <= tile.min(axis=1, keepdims=True) + max_cost
+        in_tile = (col_argmin >= rows.start) & (col_argmin < rows.stop)
+        keep[col_argmin[in_tile] - rows.start, np.where(in_tile)[0]] = True
+        tile_rows, cols = np.nonzero(keep)
+        indices.append(cols)
+        costs.append(tile[tile_rows, cols])
+        indptr.append(row_offset + np.cumsum(np.bincount(tile_rows, minlength=tile.shape[0])))
+        row_offset += len(cols)
+    return scipy.sparse.csr_matrix((np.concatenate(costs), np.concatenate(indices), np.concatenate(indptr)),
+                                   shape=(I, J))
+
+
+def _sparse_sinkhorn(support, p, q, dx, dy, lambda1, lambda2, epsilon, batch_size, tolerance, tau, epsilon0,
+                     max_iter, u=None, v=None, epsilon_scalings=5):
+    """
+    Stabilized unbalanced scaling iterations restricted to the support of a sparse cost matrix.
+    Starts from the dual potentials u, v if given.
+
+    Returns the unnormalized transport map, with the same sparsity structure as `support`,
+    and the dual potentials u, v.
+    """
+    I, J = support.shape
+    dtype = support.dtype
+    cost = support.data
+    indices = support.indices
+    rows = np.repeat(np.arange(I), np.diff(support.indptr))
+    K = scipy.sparse.csr_matrix((np.empty_like(cost), indices, support.indptr), shape=(I, J))
+    K_T = K.T
+
+    def update_kernel(epsilon_i):
+        np.subtract(u[rows], cost, out=K.data)
+        K.data += v[indices]
+        K.data /= epsilon_i
+        np.exp(K.data, out=K.data)
+
+    u = np.zeros(I) if u is None else np.array(u, dtype=np.float64)
+    v = np.zeros(J) if v is None else np.array(v, dtype=np.float64)
+    a, b = np.ones(I), np.ones(J)
+    dx_t, dy_t = dx.astype(dtype), dy.astype(dtype)
+    epsilon_schedule = _epsilon_schedule(epsilon, epsilon0, epsilon_scalings)
+    epsilon_i = epsilon_schedule[0]
+    tolerance = max(tolerance, _min_tolerance(dtype))
+    current_iter = 0
+
+    for e in range(len(epsilon_schedule)):
+        final_stage = e == len(epsilon_schedule) - 1
+        duality_gap = np.inf
+        _absorb(u, a, epsilon_i)
+        _absorb(v, b, epsilon_i)
+        epsilon_i = epsilon_schedule[e]
+        alpha1 = lambda1 / (lambda1 + epsilon_i)
+        alpha2 = lambda2 / (lambda2 + epsilon_i)
+        update_kernel(epsilon_i)
+        threshold = tolerance if final_stage else max(1e-6, _min_tolerance(dtype))
+
+        while duality_gap > threshold and current_iter < max_iter:
+            for i in range(batch_size if final_stage else 5):
+                current_iter += 1
+                old_a, old_b = a, b
+                a = (p / K.dot(b * dy_t)) ** alpha1 * np.exp(-u / (lambda1 + epsilon_i))
+                b = (q / K_T.dot(a * dx_t)) ** alpha2 * np.exp(-v / (lambda2 + epsilon_i))
+
+                # stabilization
+                if a.max() > tau or b.max() > tau:
+                    _absorb(u, a, epsilon_i)
+                    _absorb(v, b, epsilon_i)
+                    update_kernel(epsilon_i)
+
+            if final_stage:
+                kernel_mass = np.dot(dx[rows] * dy[indices], np.exp(-cost.astype(np.float64) / epsilon_i))
+                duality_gap = _marginal_duality_gap(a * K.dot(b * dy_t), b * K_T.dot(a * dx_t),
+                                                    u + epsilon_i * np.log(a), v + epsilon_i * np.log(b),
+                                                    p, q, dx, dy, kernel_mass, epsilon_i, lambda1, lambda2)
+            else:
+                duality_gap = max(
+                    np.linalg.norm(a - old_a) / (1 + np.linalg.norm(a)),
+                    np.linalg.norm(b - old_b) / (1 + np.linalg.norm(b)))
+
+        if duality_gap > threshold:
+            logger.warning("Reached max_iter with duality gap still above threshold. Returning")
+            break
+
+    if np.isnan(duality_gap):
+        raise RuntimeError("Overflow encountered in duality gap computation, please report this incident")
+    K.data *= a[rows]
+    K.data *= b[indices]
+    _absorb(u, a, epsilon_i)
+    _absorb(v, b, epsilon_i)
+    return K, u, v
+
+
+def _marginal_duality_gap(row_marginal, col_marginal, f, g, p, q, dx, dy, kernel_mass, epsilon, lambda1,
+                          lambda2):
+    """
+    Relative duality gap of the unbalanced entropic problem, computed from the marginals of the coupling.
+
+    Parameters
+    ----------
+    row_marginal, col_marginal : 1-D ndarray
+        R.dy and R.T.dx, where R is the current coupling
+    f, g : 1-D ndarray
+        The full dual potentials, such that R_ij = exp((f_i + g_j - C_ij) / epsilon)
+    kernel_mass : float
+        Sum of dx_i * dy_j * exp(-C_ij / epsilon)
+
+    All arguments can also hold several problems along their first axis, in which case the duality gap
+    of each problem is returned.
+
+    Notes
+    -----
+    Since epsilon * log(R_ij) + C_ij = f_i + g_j, the entropic and transport terms of the primal objective
+    only depend on the marginals. This avoids any n x m temporary.
+    """
+    row_marginal = row_marginal.astype(np.float64)
+    col_marginal = col_marginal.astype(np.float64)
+    mass = np.sum(dx * row_marginal, axis=-1)
+    pri = fdiv(lambda1, row_marginal, p, dx, axis=-1) + fdiv(lambda2, col_marginal, q, dy, axis=-1) \
+          + np.sum(dx * row_marginal * f, axis=-1) + np.sum(dy * col_marginal * g, axis=-1) \
+          - epsilon * mass + epsilon * kernel_mass
+    dua = - fdivstar(lambda1, -f, p, dx, axis=-1) - fdivstar(lambda2, -g, q, dy, axis=-1) \
+          - epsilon * (mass - kernel_mass)
+    return (pri - dua) / np.abs(pri)
+
+
+def optimal_transport_multiscale(X, Y, G, lambda1, lambda2, epsilon, batch_size, tolerance, tau, epsilon0, max_iter,
+                                 dtype=np.float64, cost_scale=None, n_clusters=None, coarse_threshold=1e-6,
+                                 **ignored):
+    """
+    Compute the optimal transport between two point clouds with a coarse-to-fine strategy.
+
+    Both point clouds are clustered into metacells with k-means. The unbalanced problem is first solved
+    between the cluster centroids, with cluster masses as marginals. The full problem is then solved on a
+    sparse support, made of all pairs of cells whose clusters are coupled by the coarse transport map,
+    starting from the coarse dual potentials and without epsilon scaling.
+
+    Parameters
+    ----------
+    X : 2-D ndarray
+        Coordinates of the source cells, e.g. in local PCA space.
+    Y : 2-D ndarray
+        Coordinates of the destination cells.
+    G : 1-D array_like
+        Growth value for input cells.
+    lambda1 : float
+        Regularization parameter for the marginal constraint on p
+    lambda2 : float
+        Regularization parameter for the marginal constraint on q
+    epsilon : float
+        Entropy regularization parameter.
+    batch_size : int
+        Number of iterations to perform between each duality gap check
+    tolerance : float
+        Upper bound on the duality gap that the resulting transport map must guarantee.
+    tau : float
+        Threshold at which to perform numerical stabilization
+    epsilon0 : float
+        Starting value for exponentially-decreasing epsilon, for the coarse problem
+    max_iter : int
+        Maximum number of iterations of each of the coarse and fine problems.
+    dtype : str or numpy.dtype, optional
+        Floating point type of the kernel and of the returned transport map.
+    cost_scale : float, optional
+        The cost is the squared euclidean distance divided by cost_scale.
+        Defaults to an estimate of the median squared distance, as in OTModel.compute_default_cost_matrix
+    n_clusters : int, optional
+        Number of metacells per timepoint. Defaults to twice the square root of the number of cells.
+    coarse_threshold : float, optional
+        A pair of clusters is refined if its coarse coupling is above coarse_threshold times the largest
+        coupling of the source cluster.
+
+    Returns
+    -------
+    transport_map : scipy.sparse.csr_matrix
+        The entropy-regularized unbalanced transport map
+    """
+    import sklearn.cluster
+
+    dtype = np.dtype(dtype)
+    X = np.asarray(X, dtype=dtype)
+    Y = np.asarray(Y, dtype=dtype)
+    I, J = X.shape[0], Y.shape[0]
+    G = np.asarray(G, dtype=np.float64)
+    if cost_scale is None:
+        cost_scale = _estimate_median_sqeuclidean(X, Y)
+
+    def cluster(points):
+        k = n_clusters if n_clusters is not None else int(2 * np.sqrt(len(points)))
+        k = max(1, min(k, len(points)))
+        kmeans = sklearn.cluster.MiniBatchKMeans(n_clusters=k, random_state=58951, n_init=3).fit(points)
+        labels = np.unique(kmeans.labels_, return_inverse=True)[1]  # drop empty clusters
+        centroids = np.vstack([points[labels == c].mean(axis=0) for c in range(labels.max() + 1)])
+        return labels, centroids
+
+    x_labels, x_centroids = cluster(X)
+    y_labels, y_centroids = cluster(Y)
+    x_sizes = np.bincount(x_labels)
+    y_sizes = np.bincount(y_labels)
+
+    # Coarse problem between centroids. Densities p, q are relative to the cluster weights dx, dy
+    coarse_cost = _sqeuclidean_tile(x_centroids, np.einsum('ij,ij->i', x_centroids, x_centroids),
+                                    y_centroids, np.einsum('ij,ij->i', y_centroids, y_centroids)) / cost_scale
+    coarse_support = scipy.sparse.csr_matrix(
+        (coarse_cost.ravel(), np.tile(np.arange(len(y_sizes)), len(x_sizes)),
+         np.arange(0, coarse_cost.size + 1, len(y_sizes))), shape=coarse_cost.shape)
+    coarse_p = np.bincount(x_labels, weights=G) / x_sizes
+    coarse_q = np.full(len(y_sizes), np.average(G))
+    coarse_R, coarse_u, coarse_v = _sparse_sinkhorn(coarse_support, coarse_p, coarse_q, x_sizes / I, y_sizes / J,
+                                                    lambda1, lambda2, epsilon, batch_size, tolerance, tau,
+                                                    epsilon0, max_iter)
+
+    # Refine all pairs of cells within the blocks supported by the coarse transport map
+    coarse_R = coarse_R.toarray()
+    blocks = coarse_R >= coarse_threshold * coarse_R.max(axis=1, keepdims=True)
+    blocks[np.argmax(coarse_R, axis=0), np.arange(coarse_R.shape[1])] = True
+    x_members = [np.where(x_labels == k)[0] for k in range(len(x_sizes))]
+    y_members = [np.where(y_labels == l)[0] for l in range(len(y_sizes))]
+    y_sq = np.einsum('ij,ij->i', Y, Y)
+    rows, cols, costs = [], [], []
+    for k in range(len(x_sizes)):
+        targets = np.concatenate([y_members[l] for l in np.where(blocks[k])[0]])
+        sources = x_members[k]
+        tile = _sqeuclidean_tile(X[sources], np.einsum('ij,ij->i', X[sources], X[sources]), Y[targets],
+                                 y_sq[targets])
+        tile /= cost_scale
+        rows.append(np.repeat(sources, len(targets)))
+        cols.append(np.tile(targets, len(sources)))
+        costs.append(tile.ravel())
+    rows, cols, costs = np.concatenate(rows), np.concatenate(cols), np.concatenate(costs)
+    order = np.lexsort((cols, rows))
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=I))))
+    support = scipy.sparse.csr_matrix((costs[order], cols[order], indptr), shape=(I, J))
+
+    # The final coarse epsilon is epsilon0 * epsilon, the fine problem is solved directly at that value
+    R, u, v = _sparse_sinkhorn(support, G, np.full(J, np.average(G)), np.ones(I) / I, np.ones(J) / J,
+                               lambda1, lambda2, epsilon, batch_size, tolerance, tau, epsilon0, max_iter,
+                               u=coarse_u[x_labels], v=coarse_v[y_labels], epsilon_scalings=0)
+    R.data /= J
+    return R
+
+
+class FactoredTransportMap:
+    """
+    A transport map stored as the product of two low-rank factors, left.dot(right.T)
+
+    Supports the matrix products and sums needed to push populations forward or pull them back
+    without forming the n x m matrix.
+
+    Parameters
+    ----------
+    left : 2-D ndarray
+        n x r factor, for the source cells.
+    right : 2-D ndarray
+        m x r factor, for the destination cells.
+    """
+
+    # Make numpy defer `ndarray @ FactoredTransportMap` to __rmatmul__
+    __array_ufunc__ = None
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.shape = (left.shape[0], right.shape[0])
+        self.dtype = np.result_type(left, right)
+
+    def __matmul__(self, other):
+        if isinstance(other, FactoredTransportMap):
+            return FactoredTransportMap(self.left.dot(self.right.T.dot(other.left)), other.right)
+        return self.left.dot(self.right.T @ other)
+
+    def __rmatmul__(self, other):
+        return (other @ self.left).dot(self.right.T)
+
+    def __getitem__(self, rows):
+        """Selects source cells"""
+        return FactoredTransportMap(self.left[rows], self.right)
+
+    def dot(self, other):
+        return self @ other
+
+    @property
+    def T(self):
+        return FactoredTransportMap(self.right, self.left)
+
+    def sum(self, axis=None):
+        if axis is None:
+            return self.left.sum(axis=0).dot(self.right.sum(axis=0))
+        if axis == 0:
+            return self.right.dot(self.left.sum(axis=0))
+        return self.left.dot(self.right.sum(axis=0))
+
+    def toarray(self):
+        return self.left.dot(self.right.T)
+
+    def to_anndata(self, obs, var):
+        """Stores the factors in obsm['tmap_left'] and varm['tmap_right'], with an empty sparse X"""
+        tmap = anndata.AnnData(scipy.sparse.csr_matrix(self.shape, dtype=self.dtype), obs, var)
+        tmap.obsm['tmap_left'] = self.left
+        tmap.varm['tmap_right'] = self.right
+        return tmap
+
+    @staticmethod
+    def from_anndata(tmap):
+        """The factored transport map stored in tmap, or None if tmap is not factored"""
+        if 'tmap_left' not in tmap.obsm.keys():
+            return None
+        return FactoredTransportMap(np.asarray(tmap.obsm['tmap_left']), np.asarray(tmap.varm['tmap_right']))
+
+
+def optimal_transport_lowrank(X, Y, G, lambda1, lambda2, epsilon, batch_size, tolerance, max_iter,
+                              dtype=np.float64, cost_scale=None, rank=None, max_kernel_error=0.05, densify=False,
+                              **ignored):
+    """
+    Compute the optimal transport with a low-rank Nystrom approximation of the kernel.
+
+    The kernel exp(-C / epsilon) is approximated by K_xz K_zz^+ K_zy, where z are `rank` landmark cells drawn
+    from both point clouds. Each scaling iteration then costs O((n + m) * rank) instead of O(n * m).
+    The approximation is only accurate when epsilon is large compared to the distance between neighboring
+    landmarks, and no log-domain stabilization is possible. Its relative error is measured on the exact kernel
+    of randomly sampled source cells: the solver refuses an approximation whose error is above max_kernel_error,
+    as happens with small values of epsilon, for which another solver should be used.
+
+    Parameters
+    ----------
+    X : 2-D ndarray
+        Coordinates of the source cells, e.g. in local PCA space.
+    Y : 2-D ndarray
+        Coordinates of the destination cells.
+    G : 1-D array_like
+        Growth value for input cells.
+    lambda1 : float
+        Regularization parameter for the marginal constraint on p
+    lambda2 : float
+        Regularization parameter for the marginal constraint on q
+    epsilon : float
+        Entropy regularization parameter.
+    batch_size : int
+        Number of iterations to perform between each convergence check
+    tolerance : float
+        Upper bound on the relative change of the scaling vectors at convergence.
+    max_iter : int
+        Maximum number of iterations. Print a warning and return if it is reached, even without convergence.
+    dtype : str or numpy.dtype, optional
+        Floating point type of the factors.
+    cost_scale : float, optional
+        The cost is the squared euclidean distance divided by cost_scale.
+        Defaults to an estimate of the median squared distance, as in OTModel.compute_default_cost_matrix
+    rank : int, optional
+        Number of landmarks, upper bound on the rank of the approximation. By default, the number of landmarks
+        is doubled from 100 until the error of the approximation is below max_kernel_error, as long as the
+        factors are smaller than the dense transport map.
+    max_kernel_error : float, optional
+        Largest accepted relative error of the approximate kernel, in Frobenius norm. Also bounds the negative
+        entries of the transport map, relative to its largest entry.
+    densify : bool, optional
+        Return a dense transport map instead of its factors.
+
+    Returns
+    -------
+    transport_map : wot.ot.FactoredTransportMap or 2-D ndarray
+        The entropy-regularized unbalanced transport map
+
+    Raises
+    ------
+    ValueError
+        If the error of the approximate kernel is above max_kernel_error
+    RuntimeError
+        If the transport map is not finite, or has negative entries below -max_kernel_error times its largest entry
+    """
+    dtype = np.dtype(dtype)
+    X = np.asarray(X, dtype=dtype)
+    Y = np.asarray(Y, dtype=dtype)
+    I, J = X.shape[0], Y.shape[0]
+    if cost_scale is None:
+        cost_scale = _estimate_median_sqeuclidean(X, Y)
+
+    points = np.vstack((X, Y))
+    rs = np.random.RandomState(58951)
+    # Landmarks are taken in a fixed random order, so that larger ranks add landmarks to the smaller ones
+    landmark_order = rs.permutation(len(points))
+    # The exact kernel rows of a sample of source cells, to measure the error of the approximation
+    check_rows = np.sort(rs.choice(I, size=min(I, 256, max(1, 2 ** 22 // J)), replace=False))
+
+    def kernel(P, Q):
+        K = _sqeuclidean_tile(P, np.einsum('ij,ij->i', P, P), Q, np.einsum('ij,ij->i', Q, Q))
+        K /= -cost_scale * epsilon
+        return np.exp(K, out=K)
+
+    exact_rows = kernel(X[check_rows], Y)
+
+    def nystrom_factors(n_landmarks):
+        Z = points[landmark_order[:n_landmarks]]
+        # K_zz^+ = U diag(1 / s) U.T, dropping the numerically null eigenvalues
+        s, U = np.linalg.eigh(kernel(Z, Z).astype(np.float64))
+        keep = s > s.max() * 1e-10
+        W = (U[:, keep] / np.sqrt(s[keep])).astype(dtype)
+        A, B = kernel(X, Z).dot(W), kernel(Y, Z).dot(W)
+        error = np.linalg.norm(A[check_rows].dot(B.T) - exact_rows) / np.linalg.norm(exact_rows)
+        return A, B, error
+
+    if rank is not None:
+        A, B, kernel_error = nystrom_factors(min(rank, len(points)))
+    else:
+        # Factors with more than n * m / (n + m) columns are larger than the dense transport map
+        max_rank = min(len(points), max(1, I * J // (I + J)))
+        rank = min(100, max_rank)
+        A, B, kernel_error = nystrom_factors(rank)
+        while kernel_error > max_kernel_error and rank < max_rank:
+            rank = min(2 * rank, max_rank)
+            A, B, kernel_error = nystrom_factors(rank)
+    logger.info('Nystrom kernel of rank {} with relative error {:.3g}'.format(A.shape[1], kernel_error))
+    if not kernel_error <= max_kernel_error:
+        raise ValueError('The Nystrom kernel with {} landmarks has a relative error of {:.3g} at epsilon={}, above '
+                         'max_kernel_error={}. Increase epsilon or the rank, or use another solver'
+                         .format(rank, kernel_error, epsilon, max_kernel_error))
+
+    p = np.asarray(G, dtype=dtype)
+    q = np.full(J, np.average(G), dtype=dtype)
+    dx, dy = np.ones(I, dtype=dtype) / I, np.ones(J, dtype=dtype) / J
+    alpha1 = lambda1 / (lambda1 + epsilon)
+    alpha2 = lambda2 / (lambda2 + epsilon)
+    machine_epsilon = np.finfo(dtype).eps
+
+    def kernel_product(L, R, x):
+        # The approximate kernel is not guaranteed to be positive: clip products to a relative floor
+        y = L.dot(R.T.dot(x))
+        return np.maximum(y, machine_epsilon * y.max())
+
+    a, b = np.ones(I, dtype=dtype), np.ones(J, dtype=dtype)
+    current_iter = 0
+    change = np.inf
+    while change > tolerance and current_iter < max_iter:
+        for i in range(batch_size):
+            current_iter += 1
+            old_a, old_b = a, b
+            a = (p / kernel_product(A, B, b * dy)) ** alpha1
+            b = (q / kernel_product(B, A, a * dx)) ** alpha2
+        change = max(np.linalg.norm(a - old_a) / (1 + np.linalg.norm(a)),
+                     np.linalg.norm(b - old_b) / (1 + np.linalg.norm(b)))
+    if change > tolerance:
+        logger.warning("Reached max_iter with scaling vectors still changing. Returning")
+
+    tmap = FactoredTransportMap(A * (a / J)[:, np.newaxis], B * b[:, np.newaxis])
+    if not (np.isfinite(tmap.left).all() and np.isfinite(tmap.right).all()):
+        raise RuntimeError('Overflow encountered in the low-rank transport map. Increase epsilon or use another '
+                           'solver')
+    # Entries are checked on the sampled rows, and through the marginals
+    sampled = tmap[check_rows].toarray()
+    for values in (sampled, tmap.sum(axis=1), tmap.sum(axis=0)):
+        if values.min() < -max_kernel_error * values.max():
+            raise RuntimeError('The low-rank transport map has negative entries, down to {:.3g} for a largest entry '
+                               'of {:.3g}. Increase epsilon or the rank, or use another solver'
+                               .format(values.min(), values.max()))
+    return tmap.toarray() if densify else tmap
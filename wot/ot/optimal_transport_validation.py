@@ -34,6 +34,7 @@ def compute_validation_summary(ot_model, day_triplets=None, interp_size=10000, c
     """
     if ot_model.covariate_field not in ot_model.matrix.obs:
         ot_model.matrix.obs['covariate'] = 1
+        ot_model._index_cells()
     if day_triplets is None:
         day_triplets = []
         unique_times = np.array(ot_model.timepoints)
@@ -60,16 +61,28 @@ def compute_validation_summary(ot_model, day_triplets=None, interp_size=10000, c
     # 'Rg': ["#ffff33", "between random (with growth) and real"]
 
     local_pca = ot_model.ot_config['local_pca']
+    global_pca = local_pca > 0 and ot_model.ot_config.get('pca_mode', 'local') == 'global'
+    if global_pca:
+        # Distances are computed in the embedding shared by all transport maps
+        embedding = ot_model.global_pca_embedding()
+        pca_var = pd.DataFrame(index=pd.RangeIndex(start=0, stop=embedding.shape[1], step=1))
+        eigenvals = None
+
+        def embedded_cells(t):
+            indices = ot_model.cell_indices(t)
+            return anndata.AnnData(embedding[indices], obs=ot_model.matrix.obs.iloc[indices], var=pca_var)
 
     for triplet in day_triplets:
         t0, t05, t1 = triplet
         interp_frac = (t05 - t0) / (t1 - t0)
 
-        p0_ds = ot_model.matrix[ot_model.matrix.obs[ot_model.day_field] == float(t0), :]
-        p05_ds = ot_model.matrix[ot_model.matrix.obs[ot_model.day_field] == float(t05), :]
-        p1_ds = ot_model.matrix[ot_model.matrix.obs[ot_model.day_field] == float(t1), :]
+        p0_ds = ot_model.matrix[ot_model.cell_indices(t0)]
+        p05_ds = ot_model.matrix[ot_model.cell_indices(t05)]
+        p1_ds = ot_model.matrix[ot_model.cell_indices(t1)]
 
-        if local_pca > 0:
+        if global_pca:
+            p0_ds, p05_ds, p1_ds = [embedded_cells(t) for t in (t0, t05, t1)]
+        elif local_pca > 0:
             matrices = list()
             matrices.append(p0_ds.X if not scipy.sparse.isspmatrix(p0_ds.X) else p0_ds.X.toarray())
             matrices.append(p1_ds.X if not scipy.sparse.isspmatrix(p1_ds.X) else p1_ds.X.toarray())
@@ -112,7 +125,7 @@ def compute_validation_summary(ot_model, day_triplets=None, interp_size=10000, c
             r05_no_growth = wot.ot.interpolate_randomly(p0_ds.X, p1_ds.X, interp_frac, interp_size)
             update_full_summary(r05_no_growth, t05, 'R')
             try:
-                i05 = wot.ot.interpolate_with_ot(p0_ds.X, p1_ds.X, tmap_full.X, interp_frac,
+                i05 = wot.ot.interpolate_with_ot(p0_ds.X, p1_ds.X, wot.tmap.coupling_matrix(tmap_full), interp_frac,
                                                  interp_size)  # TODO handle downsampling cells case
                 update_full_summary(i05, t05, 'I')
                 update_full_summary(i05, t05, 'I1', p0_ds.X)
@@ -129,6 +142,7 @@ def compute_validation_summary(ot_model, day_triplets=None, interp_size=10000, c
         p0 = wot.split_anndata(p0_ds, ot_model.covariate_field)
         p05 = wot.split_anndata(p05_ds, ot_model.covariate_field)
         p1 = wot.split_anndata(p1_ds, ot_model.covariate_field)
+        tmaps = ot_model.compute_covariate_transport_maps(t0, t1, list(itertools.product(p0.keys(), p1.keys())))
         for cv05 in p05.keys():
             p05_x = p05[cv05].X
             seen_first = set()
@@ -155,7 +169,7 @@ def compute_validation_summary(ot_model, day_triplets=None, interp_size=10000, c
                     distance_to_p05(p05[cv05_2].X, t05, 'P', cv05_2)
 
             for cv0, cv1 in itertools.product(p0.keys(), p1.keys()):
-                tmap = ot_model.compute_transport_map(t0, t1, covariate=(cv0, cv1))
+                tmap = tmaps[(cv0, cv1)]
                 if tmap is None:
                     # no data for combination of day and covariate
                     continue
@@ -165,7 +179,7 @@ def compute_validation_summary(ot_model, day_triplets=None, interp_size=10000, c
                 # p1_x = wot.ot.pca_transform(pca, mean, p1[cv1].X)
                 p0_x = p0[cv0].X
                 p1_x = p1[cv1].X
-                i05 = wot.ot.interpolate_with_ot(p0_x, p1_x, tmap.X, interp_frac, interp_size)
+                i05 = wot.ot.interpolate_with_ot(p0_x, p1_x, wot.tmap.coupling_matrix(tmap), interp_frac, interp_size)
                 if ot_model.cell_growth_rate_field in ot_model.matrix.obs:
                     r05_with_growth = wot.ot.interpolate_randomly_with_growth(p0_x, p1_x, interp_frac, interp_size,
                                                                               p0[cv0].obs[
@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import copy
+import hashlib
 import itertools
+import json
 import logging
 import os
+import queue
+import socket
+import tempfile
+import threading
 
 import anndata
 import numpy as np
 import pandas as pd
 import scipy
-import sklearn
+import scipy.optimize
 
 import wot.io
 import wot.ot
@@ -16,6 +24,15 @@ import wot.ot
 logger = logging.getLogger('wot')
 
 
+# Configuration keys that change the transport maps, besides those passed to the solver
+_TRANSPORT_MAP_CONFIG_KEYS = ('local_pca', 'pca_mode', 'pca_sample', 'growth_iters', 'warm_start',
+                              'share_covariate_cost')
+# Configuration keys that only change how the transport maps are computed. The budgets are among them, as the
+# transport maps that exhausted their budget are recomputed anyway.
+_COMPUTATION_CONFIG_KEYS = ('trace', 'out', 'memmap_dir', 'cost_cache_size', 'cache_potentials', 'time_budget',
+                            'iter_budget')
+
+
 class OTModel:
     """
     The OTModel computes transport maps.
@@ -32,8 +49,16 @@ class OTModel:
         Cell growth rate obs name
     **kwargs : dict
         Dictionary of parameters. Will be inserted as is into OT configuration.
+
+    Notes
+    -----
+    Solvers that write the transport map into a given buffer, such as streaming, write it to a temporary file in
+    the memmap_dir directory when it is set, so that the n x m transport map is paged to disk rather than held
+    in memory while it is computed and written. Otherwise, the transport map is built in memory.
     """
 
+    GLOBAL_PCA_KEY = 'X_wot_pca'
+
     def __init__(self, matrix, day_field='day', covariate_field='covariate',
                  growth_rate_field='cell_growth_rate', **kwargs):
         self.matrix = matrix
@@ -46,52 +71,44 @@ class OTModel:
         day_filter = kwargs.pop('cell_day_filter', None)
         ncounts = kwargs.pop('ncounts', None)
         ncells = kwargs.pop('ncells', None)
+        random_state = kwargs.pop('random_state', None)
         self.matrix = wot.io.filter_adata(self.matrix, obs_filter=cell_filter, var_filter=gene_filter)
         if day_filter is not None:
             days = [float(day) for day in day_filter.split(',')] if type(day_filter) == str else day_filter
             row_indices = self.matrix.obs[self.day_field].isin(days)
             self.matrix = self.matrix[row_indices].copy()
 
-        cvs = set(self.matrix.obs[self.covariate_field]) if self.covariate_field in self.matrix.obs else [None]
+        rng = np.random if random_state is None else np.random.RandomState(random_state)
         if ncells is not None:
-            index_list = []
-            for day in self.timepoints:
-                day_query = self.matrix.obs[self.day_field] == day
-                for cv in cvs:
-                    if cv is None:
-                        indices = np.where(day_query)[0]
-                    else:
-                        indices = np.where(day_query & (self.matrix.obs[self.covariate_field] == cv))[0]
-                    if len(indices) > ncells:
-                        np.random.shuffle(indices)
-                        indices = indices[0:ncells]
-                    index_list.append(indices)
-            row_indices = np.concatenate(index_list)
-            self.matrix = self.matrix[row_indices]
+            # Keep at most ncells random cells of each day and covariate: cells are ordered by group, then randomly
+            # within their group, and the first ncells of each group are kept
+            keys = [self.day_field] + ([self.covariate_field] if self.covariate_field in self.matrix.obs else [])
+            codes = self.matrix.obs.groupby(keys, observed=True, sort=False).ngroup().values
+            order = np.lexsort((rng.rand(len(codes)), codes))
+            sorted_codes = codes[order]
+            rank = np.arange(len(order)) - np.searchsorted(sorted_codes, sorted_codes)
+            # Cells without a day have the code -1
+            row_indices = np.sort(order[(rank < ncells) & (sorted_codes >= 0)])
+            self.matrix = self.matrix[row_indices].copy()
         if ncounts is not None:
-            for i in range(self.matrix.X.shape[0]):
-                p = self.matrix[i].X
-                if scipy.sparse.isspmatrix(p):
-                    p = p.toarray()
-                p = p.astype('float64')
-                total = p.sum()
-                if total > ncounts:
-                    p /= total
-                    self.matrix.X[i] = np.random.multinomial(ncounts, p, size=1)[0]
+            # Replaces the expression matrix without modifying the AnnData given by the caller
+            self.matrix = anndata.AnnData(wot.ot.downsample_counts(self.matrix.X, ncounts, random_state=rng),
+                                          obs=self.matrix.obs, var=self.matrix.var, obsm=dict(self.matrix.obsm))
 
         if self.matrix.X.shape[0] is 0:
             raise ValueError('No cells in matrix')
 
         self.ot_config = {'local_pca': 30, 'growth_iters': 1, 'epsilon': 0.05, 'lambda1': 1, 'lambda2': 50,
                           'epsilon0': 1, 'tau': 10000, 'scaling_iter': 3000, 'inner_iter_max': 50, 'tolerance': 1e-8,
-                          'max_iter': 1e7, 'batch_size': 5, 'extra_iter': 1000}
-        solver = kwargs.pop('solver', 'duality_gap')
-        if solver == 'fixed_iters':
-            self.solver = wot.ot.transport_stablev2
-        elif solver == 'duality_gap':
-            self.solver = wot.ot.optimal_transport_duality_gap
-        else:
-            raise ValueError('Unknown solver')
+                          'max_iter': 1e7, 'batch_size': 5, 'extra_iter': 1000, 'dtype': 'float64',
+                          'warm_start': True, 'cache_potentials': False}
+        # The solver, with the config keys it consumes, its input and coupling types, see wot.ot.register_solver
+        self.solver_spec = wot.ot.get_solver(kwargs.pop('solver', 'duality_gap'))
+        self.solver = self.solver_spec.solver
+        # Final dual potentials of each (t0, t1, covariate), kept when cache_potentials is set
+        self.potentials = {}
+        # wot.ot.SolverTrace of the last computation of each (t0, t1, covariate)
+        self.traces = {}
 
         parameters_from_file = kwargs.pop('parameters', None)
         for k in kwargs.keys():
@@ -102,16 +119,26 @@ class OTModel:
             for k in config_dict.keys():
                 self.ot_config[k] = config_dict[k]
 
+        for key in ('time_budget', 'iter_budget'):
+            # A budget the solver ignores would let it run to convergence while the maps look budgeted
+            if self.ot_config.get(key) is not None and not self.solver_spec.consumes(key):
+                raise ValueError('The {} solver does not support {}'.format(self.solver_spec.name, key))
         local_pca = self.ot_config['local_pca']
         if local_pca > self.matrix.X.shape[1]:
             logger.warning("local_pca set to {}, above gene count of {}. Disabling PCA" \
                            .format(local_pca, self.matrix.X.shape[1]))
             self.ot_config['local_pca'] = 0
+        # With share_covariate_cost, the cost of each day pair is computed once for all its covariate pairs and
+        # kept in a least recently used cache of at most cost_cache_size bytes
+        self.cost_cache = _LRUCache(int(self.ot_config.get('cost_cache_size', 2 ** 30)))
+        if self.ot_config.get('pca_mode', 'local') not in ('local', 'global'):
+            raise ValueError("Unknown pca_mode {}, expected 'local' or 'global'".format(self.ot_config['pca_mode']))
         if self.day_field not in self.matrix.obs.columns:
             raise ValueError("Days information not available for matrix")
         if any(self.matrix.obs[self.day_field].isnull()):
             self.matrix = self.matrix[self.matrix.obs[self.day_field].isnull() == False]
         self.timepoints = sorted(set(self.matrix.obs[self.day_field]))
+        self._index_cells()
 
     def get_covariate_pairs(self):
         """Get all covariate pairs in the dataset"""
@@ -122,7 +149,8 @@ class OTModel:
         return product(covariate, covariate)
 
     def compute_all_transport_maps(self, tmap_out='tmaps', overwrite=True, output_file_format='h5ad',
-                                   with_covariates=False):
+                                   with_covariates=False, on_budget_exhausted='flag', n_jobs=None, write_queue_size=2,
+                                   prefetch=False, shard=None, work_queue=False):
         """
         Computes all required transport maps.
 
@@ -131,11 +159,45 @@ class OTModel:
         tmap_out : str, optional
             Path and prefix for output transport maps
         overwrite : bool, optional
-            Overwrite existing transport maps
+            Overwrite existing transport maps. Otherwise, an existing transport map is only recomputed if the
+            hash of its inputs, stored in its uns['input_hash'], changed, or if its solver exhausted its budget,
+            as recorded in its uns['solver_status']. The inputs are the cells, their expression and growth rates,
+            the genes and the configuration of the day pair.
         output_file_format: str, optional
-            Transport map file format
+            Transport map file format. Factored transport maps, such as those of the lowrank solver, are only
+            written in h5ad format.
         with_covariates : bool, optional, default : False
             Compute all covariate-restricted transport maps as well
+        on_budget_exhausted : {'flag', 'reschedule'}, optional
+            What to do with the transport maps whose solver ran out of its time_budget or iter_budget, which apply
+            to the whole transport map, over all growth iterations.
+            'flag' keeps them, with budget_exhausted set in their solver trace, and logs a warning.
+            'reschedule' recomputes them without budget once all other transport maps are computed.
+        n_jobs : int, optional
+            Number of worker processes computing day pairs in parallel, the largest pairs first.
+            -1 to use all processors. BLAS threads are shared evenly between the workers.
+        write_queue_size : int, optional
+            Number of computed transport maps that can wait to be written by a background thread while the next
+            ones are computed. 0 to write each transport map before computing the next one. Worker processes,
+            with n_jobs, always write their transport maps before computing the next ones.
+        prefetch : bool, optional
+            Select the cells and compute the cost matrix of the next day pair while the current one is solved.
+            This holds two cost matrices in memory.
+        shard : str or (int, int), optional
+            'i/N' or (i, N), with 0 <= i < N, to only compute the i-th of N disjoint shards of the day pairs, e.g. on
+            the i-th of N nodes. Day pairs are assigned to shards deterministically, balancing their estimated
+            cost. Learned growth rates and solver traces are written to <tmap_out>_shard<i>_g.txt and
+            <tmap_out>_shard<i>_trace.json.
+        work_queue : bool, optional
+            Share the day pairs with other workers running on the same output directory: each worker claims the
+            next day pair, the most costly first, with a lock file next to the transport maps, and skips the day
+            pairs claimed by others or whose transport maps are up to date. Locks are released when a worker exits,
+            even if it is killed, so that restarting workers resumes the computation. Learned growth rates and
+            solver traces are written to <tmap_out>_<host>-<pid>_g.txt and <tmap_out>_<host>-<pid>_trace.json.
+            Day pairs are computed one after the other: run more workers to use more processors.
+
+        Transport maps are written to a hidden temporary file first, then renamed, so that a worker that is killed
+        never leaves a partially written transport map.
 
         Returns
         -------
@@ -143,22 +205,18 @@ class OTModel:
             Only computes and saves all transport maps, does not return them.
         """
 
+        if on_budget_exhausted not in ('flag', 'reschedule'):
+            raise ValueError('Unknown on_budget_exhausted policy: {}'.format(on_budget_exhausted))
+        if self.solver_spec.coupling == 'factored' and not self.ot_config.get('densify', False) \
+                and output_file_format != 'h5ad':
+            raise ValueError('The {} solver returns factored transport maps, which can only be written in h5ad '
+                             'format, not {}'.format(self.solver_spec.name, output_file_format))
         tmap_dir, tmap_prefix = os.path.split(tmap_out) if tmap_out is not None else (None, None)
         tmap_prefix = tmap_prefix or "tmaps"
         tmap_dir = tmap_dir or '.'
         if not os.path.exists(tmap_dir):
             os.makedirs(tmap_dir)
-        t = self.timepoints
-        day_pairs = self.day_pairs
-
-        if day_pairs is None or len(day_pairs) == 0:
-            day_pairs = [(t[i], t[i + 1]) for i in range(len(t) - 1)]
-
-        if with_covariates:
-            covariate_day_pairs = [(*d, c) for d, c in itertools.product(day_pairs, self.get_covariate_pairs())]
-            # if type(day_pairs) is dict:
-            #     day_pairs = list(day_pairs.keys())
-            day_pairs = covariate_day_pairs
+        day_pairs = self._transport_map_day_pairs(with_covariates)
 
         # if not force:
         #     if with_covariates:
@@ -171,28 +229,389 @@ class OTModel:
             logger.info('No day pairs')
             return
 
-        full_learned_growth_df = None
+        output_suffix = ''
+        if shard is not None:
+            shard_index, shard_count = _parse_shard(shard)
+            day_pairs = self._shard_day_pairs(day_pairs, shard_index, shard_count)
+            output_suffix += '_shard{}'.format(shard_index)
+            logger.info('Computing {} day pairs of shard {}/{}'.format(len(day_pairs), shard_index, shard_count))
+        if work_queue:
+            output_suffix += '_{}-{}'.format(socket.gethostname(), os.getpid())
+
+        learned_growth_dfs = {}
         save_learned_growth = self.ot_config.get('growth_iters', 1) > 1
+        output_files = {}
+        input_hashes = {}
         for day_pair in day_pairs:
             path = tmap_prefix
             if not with_covariates:
                 path += "_{}_{}".format(*day_pair)
             else:
-                path += "_{}_{}_cv{}_cv{}".format(*day_pair)
+                path += "_{}_{}_cv{}_cv{}".format(day_pair[0], day_pair[1], *day_pair[2])
             output_file = os.path.join(tmap_dir, path)
             output_file = wot.io.check_file_extension(output_file, output_file_format)
+            input_hash = self.transport_map_input_hash(*day_pair)
             if os.path.exists(output_file) and not overwrite:
-                logger.info('Found existing tmap at ' + output_file + '. ')
+                if OTModel._is_up_to_date(output_file, input_hash):
+                    logger.info('Found up to date tmap at ' + output_file + '. ')
+                    continue
+                logger.info('Inputs of tmap at ' + output_file + ' changed or its solver budget was exhausted. '
+                            'Recomputing')
+            output_files[day_pair] = output_file
+            input_hashes[day_pair] = input_hash
+
+        # All covariate pairs of a day pair are computed together
+        groups = {}
+        for day_pair in output_files:
+            groups.setdefault(day_pair[:2], []).append(day_pair)
+        groups = list(groups.values())
+
+        parallel = not work_queue and n_jobs is not None and n_jobs != 1 and len(groups) > 1
+        # Worker processes are forked, which must not happen while the writer thread holds locks, such as the
+        # HDF5 library lock: with worker processes, transport maps are written synchronously
+        with _TransportMapWriter(0 if parallel else write_queue_size) as writer:
+            if work_queue:
+                results = self._claim_and_compute_transport_maps(groups, output_files, input_hashes,
+                                                                  output_file_format, with_covariates,
+                                                                  os.path.join(tmap_dir, '.' + tmap_prefix))
+            elif parallel:
+                results = self._compute_transport_map_groups_in_parallel(groups, output_files, input_hashes,
+                                                                         output_file_format, with_covariates, n_jobs)
+            else:
+                results = self._compute_and_write_transport_maps(groups, output_files, input_hashes,
+                                                                 output_file_format, with_covariates, writer=writer,
+                                                                 prefetch=prefetch)
+            exhausted = []
+            for computed in results:
+                for day_pair, (learned_growth_df, trace) in computed.items():
+                    if save_learned_growth:
+                        learned_growth_dfs[day_pair] = learned_growth_df
+                    if trace is not None:
+                        self.traces[day_pair if with_covariates else (*day_pair, None)] = trace
+                        if trace.budget_exhausted:
+                            exhausted.append(day_pair)
+            exhausted.sort(key=list(output_files).index)
+
+            if exhausted and on_budget_exhausted == 'flag':
+                logger.warning('Solver budget exhausted for {} transport maps: {}'.format(len(exhausted), exhausted))
+            elif exhausted:
+                logger.info('Recomputing {} transport maps without budget'.format(len(exhausted)))
+                for day_pair in exhausted:
+                    t0, t1, covariate = day_pair if with_covariates else (*day_pair, None)
+                    config = {**self.ot_config, **self._local_config(t0, t1), 't0': t0, 't1': t1,
+                              'covariate': covariate, 'time_budget': None, 'iter_budget': None}
+                    tmap = self.compute_single_transport_map(config)
+                    tmap.uns['input_hash'] = input_hashes[day_pair]
+                    writer.write(tmap, output_files[day_pair], output_file_format)
+                    if save_learned_growth:
+                        learned_growth_dfs[day_pair] = tmap.obs
+
+        if learned_growth_dfs:
+            pd.concat([learned_growth_dfs[day_pair] for day_pair in output_files if day_pair in learned_growth_dfs],
+                      copy=False).to_csv(os.path.join(tmap_dir, tmap_prefix + output_suffix + '_g.txt'), sep='\t',
+                                         index_label='id')
+        self._write_solver_traces(os.path.join(tmap_dir, tmap_prefix + output_suffix + '_trace.json'),
+                                  [day_pair if with_covariates else (*day_pair, None) for day_pair in output_files])
+
+    def plan_transport_maps(self, with_covariates=False, calibrate=True, memory_limit=None):
+        """
+        Estimates the resources needed to compute each transport map, without computing them
+
+        Parameters
+        ----------
+        with_covariates : bool, optional
+            Plan the covariate-restricted transport maps, as compute_all_transport_maps
+        calibrate : bool, optional
+            Estimate the time and peak memory from a micro-benchmark of the local PCA, cost and solver on two small
+            problems of cells randomly sampled from the largest day pair. If the solver refuses these problems,
+            the estimates are those without calibration. Otherwise, the peak memory assumes a dense cost matrix, if the
+            solver takes one, and a dense kernel, in which the dense coupling is built, and the time is not
+            estimated. The memory of the solvers that work by blocks of the kernel, such as streaming,
+            is overestimated.
+        memory_limit : int, optional
+            Memory available to compute a transport map, in bytes. Adds a big_memory column flagging the transport
+            maps whose estimated peak memory is above it.
+
+        Returns
+        -------
+        plan : pandas.DataFrame
+            One row per transport map, with columns t0, t1 (cv0 and cv1 with covariates), n and m the number of
+            cells at t0 and t1, cost_bytes, kernel_bytes and tmap_bytes the sizes of dense n x m matrices in the
+            solver dtype, pca_bytes the temporary memory of the local PCA, peak_bytes the estimated peak memory,
+            seconds the estimated time to compute the transport map (NaN without calibration) and status, 'ok' or
+            why the calibration failed.
+        """
+        spec = self.solver_spec
+        itemsize = np.dtype(self.ot_config.get('dtype', 'float64')).itemsize
+        calibration = self._calibrate_solver() if calibrate else None
+        status = 'ok'
+        if calibration is not None and 'error' in calibration:
+            status = 'solver cannot run with this configuration: {}'.format(calibration['error'])
+            logger.warning('Solver calibration failed, the plan is not calibrated: {}'.format(calibration['error']))
+            calibration = None
+        rows = []
+        for day_pair in self._transport_map_day_pairs(with_covariates):
+            t0, t1 = day_pair[:2]
+            config = {**self.ot_config, **self._local_config(t0, t1)}
+            p0_indices, p1_indices = self._transport_problem_cells(*day_pair)
+            n, m = len(p0_indices), len(p1_indices)
+            dense_bytes = n * m * itemsize
+            row = {'t0': t0, 't1': t1}
+            if with_covariates:
+                row['cv0'], row['cv1'] = day_pair[2]
+            row.update(n=n, m=m, cost_bytes=dense_bytes, kernel_bytes=dense_bytes, tmap_bytes=dense_bytes,
+                       pca_bytes=self._pca_bytes(p0_indices, p1_indices, config['local_pca'],
+                                                 config.get('pca_mode', 'local')))
+            if calibration is not None:
+                solve_bytes = np.dot(calibration['bytes'], [n * m, n + m])
+                row['seconds'] = np.dot(calibration['seconds'], [n * m, n + m]) * config.get('growth_iters', 1)
+            else:
+                # The solvers of dense couplings build them in the kernel buffer
+                solve_bytes = (dense_bytes if spec.input == 'cost' else 0) \
+                              + (dense_bytes if spec.coupling == 'dense' else 0)
+                row['seconds'] = np.nan
+            row['peak_bytes'] = int(max(row['pca_bytes'], solve_bytes))
+            row['status'] = status
+            rows.append(row)
+        columns = ['t0', 't1'] + (['cv0', 'cv1'] if with_covariates else []) + [
+            'n', 'm', 'cost_bytes', 'kernel_bytes', 'tmap_bytes', 'pca_bytes', 'peak_bytes', 'seconds', 'status']
+        plan = pd.DataFrame(rows, columns=columns)
+        if memory_limit is not None:
+            plan['big_memory'] = plan['peak_bytes'] > memory_limit
+        return plan
+
+    def _pca_bytes(self, p0_indices, p1_indices, local_pca, pca_mode='local'):
+        """Estimated temporary memory of the local PCA of the given cells, 0 without local PCA"""
+        if local_pca is None or local_pca <= 0 or pca_mode == 'global':
+            return 0
+        n_cells = len(p0_indices) + len(p1_indices)
+        X = self.matrix.X
+        if scipy.sparse.isspmatrix_csr(X):
+            # Stacked float64 values and int32 indices, and a few cells x (n_components + oversamples) matrices
+            nnz = np.diff(X.indptr)
+            return int((nnz[p0_indices].sum() + nnz[p1_indices].sum()) * 12 + 3 * n_cells * (local_pca + 10) * 8)
+        # The stacked and centered dense float64 matrices
+        return int(2 * n_cells * X.shape[1] * 8)
+
+    def _calibrate_solver(self, sizes=((100, 120), (200, 240))):
+        """
+        Times the local PCA, cost and solver on small problems made of cells randomly sampled from the day pair
+        with the most cells, and measures the memory allocated by the cost and solver
+
+        Returns
+        -------
+        dict
+            'seconds' and 'bytes', each (a, b) such that a problem with n and m cells takes a * n * m + b * (n + m),
+            fitted by non-negative least squares. Only 'error', the message of the solver, if it refused to solve
+            these problems.
+        """
+        import time
+        import tracemalloc
+
+        spec = self.solver_spec
+        dtype = self.ot_config.get('dtype', np.float64)
+        params = spec.solver_config(self.ot_config)
+        params.pop('trace', None)
+        rng = np.random.RandomState(0)
+        t0, t1 = max(self._transport_map_day_pairs(),
+                     key=lambda day_pair: sum(len(indices) for indices in self._transport_problem_cells(*day_pair)))
+        cells0, cells1 = self.cell_indices(t0), self.cell_indices(t1)
+
+        def solve(X, Y):
+            if spec.input == 'cost':
+                return spec.solver(C=OTModel.compute_default_cost_matrix(X, Y, dtype=dtype), G=np.ones(len(X)),
+                                   **params)
+            return spec.solver(X=X, Y=Y, G=np.ones(len(X)), **params)
+
+        measurements = []
+        for n, m in sizes:
+            start = time.perf_counter()
+            X, Y = self._cost_coordinates(rng.choice(cells0, n, replace=n > len(cells0)),
+                                          rng.choice(cells1, m, replace=m > len(cells1)), self.ot_config['local_pca'],
+                                          self.ot_config.get('pca_mode', 'local'))
+            try:
+                solve(X, Y)
+            except (ValueError, RuntimeError) as e:
+                return {'error': str(e)}
+            seconds = time.perf_counter() - start
+            # Memory is measured on a second run, as tracing allocations slows the solver down. The memory of the
+            # local PCA is estimated separately, see _pca_bytes.
+            tracemalloc.start()
+            try:
+                solve(X, Y)
+                peak_bytes = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            measurements.append((n * m, n + m, seconds, peak_bytes))
+        A = np.array([[entries, cells] for entries, cells, _, _ in measurements], dtype=np.float64)
+        calibration = {}
+        for key, column in (('seconds', 2), ('bytes', 3)):
+            values = np.array([measurement[column] for measurement in measurements], dtype=np.float64)
+            calibration[key] = tuple(scipy.optimize.nnls(A, values)[0])
+        logger.info('Solver calibration: {}'.format(calibration))
+        return calibration
+
+    def _transport_map_day_pairs(self, with_covariates=False):
+        """The (t0, t1), or (t0, t1, (cv0, cv1)) with covariates, of all the transport maps to compute"""
+        t = self.timepoints
+        day_pairs = self.day_pairs
+
+        if day_pairs is None or len(day_pairs) == 0:
+            day_pairs = [(t[i], t[i + 1]) for i in range(len(t) - 1)]
+
+        if with_covariates:
+            covariate_day_pairs = [(*d, c) for d, c in itertools.product(day_pairs, self.get_covariate_pairs())]
+            # if type(day_pairs) is dict:
+            #     day_pairs = list(day_pairs.keys())
+            day_pairs = covariate_day_pairs
+        return list(day_pairs)
+
+    def _compute_and_write_transport_maps(self, groups, output_files, input_hashes, output_file_format,
+                                          with_covariates, writer=None, prefetch=False):
+        """
+        Computes and writes the transport maps of the given groups of day pairs. The day pairs of a group share
+        t0 and t1.
+
+        Yields
+        ------
+        dict of day pair to (pandas.DataFrame, wot.ot.SolverTrace)
+            For each group, the learned growth rates and the solver trace (or None) of each transport map that
+            was computed
+        """
+        writer = _TransportMapWriter(0) if writer is None else writer
+
+        def write(tmaps):
+            results = {}
+            for day_pair, tmap in tmaps.items():
+                if tmap is None:
+                    continue
+                tmap.uns['input_hash'] = input_hashes[day_pair]
+                writer.write(tmap, output_files[day_pair], output_file_format)
+                results[day_pair] = (tmap.obs, self.traces.get(day_pair if with_covariates else (*day_pair, None)))
+            return results
+
+        if with_covariates:
+            for day_pairs in groups:
+                t0, t1 = day_pairs[0][:2]
+                tmaps = self.compute_covariate_transport_maps(t0, t1, [day_pair[2] for day_pair in day_pairs])
+                yield write({(t0, t1, covariate): tmap for covariate, tmap in tmaps.items()})
+            return
+
+        day_pairs = [day_pair for day_pairs in groups for day_pair in day_pairs]
+        if not prefetch:
+            for day_pair in day_pairs:
+                yield write({day_pair: self.compute_transport_map(*day_pair)})
+            return
+
+        def prepare(t0, t1):
+            return self._prepare_transport_problem({**self.ot_config, **self._local_config(t0, t1), 't0': t0,
+                                                    't1': t1, 'covariate': None})
+
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+            next_problem = prefetcher.submit(prepare, *day_pairs[0])
+            for i, day_pair in enumerate(day_pairs):
+                logger.info('Computing transport map from {} to {}'.format(*day_pair))
+                problem = next_problem.result()
+                if i + 1 < len(day_pairs):
+                    next_problem = prefetcher.submit(prepare, *day_pairs[i + 1])
+                yield write({day_pair: None if problem is None else self._solve_transport_problem(problem)})
+
+    def _compute_transport_map_groups_in_parallel(self, groups, output_files, input_hashes, output_file_format,
+                                                  with_covariates, n_jobs):
+        """Runs _compute_and_write_transport_maps on each group of day pairs in a pool of worker processes"""
+        import concurrent.futures
+        import multiprocessing
+
+        n_jobs = min(multiprocessing.cpu_count() if n_jobs < 0 else n_jobs, len(groups))
+        # Scheduling the largest pairs first keeps the workers busy until the end
+        groups = sorted(groups, key=lambda day_pairs: -self._transport_cost_estimate(day_pairs))
+        blas_threads = max(1, multiprocessing.cpu_count() // n_jobs)
+        logger.info('Computing {} day pairs with {} workers'.format(len(groups), n_jobs))
+
+        shared_matrix = _SharedMatrix(self.matrix.X)
+        # Workers get the model without its expression matrix, which they map from shared memory
+        model = copy.copy(self)
+        model.matrix = anndata.AnnData(obs=self.matrix.obs, var=self.matrix.var, obsm=dict(self.matrix.obsm))
+        model.traces = {}
+        model.potentials = {}
+        model.cost_cache = _LRUCache(self.cost_cache.max_bytes)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                                        initargs=(model, shared_matrix, blas_threads)) as executor:
+                futures = [executor.submit(_compute_and_write_transport_maps, day_pairs, output_files, input_hashes,
+                                           output_file_format, with_covariates) for day_pairs in groups]
+                for future in concurrent.futures.as_completed(futures):
+                    yield future.result()
+        finally:
+            shared_matrix.unlink()
+
+    def _transport_cost_estimate(self, day_pairs):
+        """Estimated cost of computing the transport maps of the given day pairs: the number of entries of their
+        cost matrices, which grows with the product of the cell counts at t0 and t1"""
+        cost = 0
+        for day_pair in day_pairs:
+            p0_indices, p1_indices = self._transport_problem_cells(*day_pair)
+            cost += len(p0_indices) * len(p1_indices)
+        return cost
+
+    def _shard_day_pairs(self, day_pairs, shard_index, shard_count):
+        """
+        The day pairs of the shard_index-th of shard_count shards
+
+        All covariate pairs of a day pair are in the same shard. Day pairs are assigned one after the other, the
+        most costly first, to the shard with the lowest total cost so far, so that every worker computes the
+        same assignment.
+        """
+        groups = {}
+        for day_pair in day_pairs:
+            groups.setdefault(tuple(day_pair[:2]), []).append(day_pair)
+        costs = {key: self._transport_cost_estimate(group) for key, group in groups.items()}
+        loads = [0] * shard_count
+        selected = set()
+        for key in sorted(groups, key=lambda key: -costs[key]):
+            shard = loads.index(min(loads))
+            loads[shard] += costs[key]
+            if shard == shard_index:
+                selected.update(groups[key])
+        return [day_pair for day_pair in day_pairs if day_pair in selected]
+
+    def _claim_and_compute_transport_maps(self, groups, output_files, input_hashes, output_file_format,
+                                          with_covariates, lock_prefix):
+        """
+        Computes and writes the groups of day pairs that are not claimed by another worker, the most costly first.
+        A group is claimed by locking the file <lock_prefix>_<t0>_<t1>.lock while it is computed and written.
+        The transport maps written by another worker since the group was listed are skipped.
+
+        Yields
+        ------
+        dict of day pair to (pandas.DataFrame, wot.ot.SolverTrace)
+            As _compute_and_write_transport_maps
+        """
+        for day_pairs in sorted(groups, key=lambda day_pairs: -self._transport_cost_estimate(day_pairs)):
+            t0, t1 = day_pairs[0][:2]
+            lock = _FileLock('{}_{}_{}.lock'.format(lock_prefix, t0, t1))
+            if not lock.acquire():
+                logger.info('Transport maps from {} to {} claimed by another worker'.format(t0, t1))
                 continue
+            try:
+                day_pairs = [day_pair for day_pair in day_pairs
+                             if not OTModel._is_up_to_date(output_files[day_pair], input_hashes[day_pair])]
+                if day_pairs:
+                    yield from self._compute_and_write_transport_maps([day_pairs], output_files, input_hashes,
+                                                                      output_file_format, with_covariates)
+            finally:
+                lock.release()
 
-            tmap = self.compute_transport_map(*day_pair)
-            wot.io.write_dataset(tmap, output_file, output_format=output_file_format)
-            if save_learned_growth:
-                learned_growth_df = tmap.obs
-                full_learned_growth_df = learned_growth_df if full_learned_growth_df is None else pd.concat(
-                    (full_learned_growth_df, learned_growth_df), copy=False)
-        if full_learned_growth_df is not None:
-            full_learned_growth_df.to_csv(os.path.join(tmap_dir, tmap_prefix + '_g.txt'), sep='\t', index_label='id')
+    def _write_solver_traces(self, path, keys):
+        """Writes the solver traces of the given (t0, t1, covariate) to a JSON file, if there are any"""
+        traces = [{'t0': float(t0), 't1': float(t1),
+                   'covariate': None if covariate is None else [str(c) for c in covariate],
+                   **self.traces[(t0, t1, covariate)].to_dict()}
+                  for t0, t1, covariate in keys if (t0, t1, covariate) in self.traces]
+        if traces:
+            with open(path, 'w') as f:
+                json.dump(traces, f, indent=1)
 
     def compute_transport_map(self, t0, t1, covariate=None):
         """
@@ -217,31 +636,99 @@ class OTModel:
         ValueError
             If the OTModel was initialized with day_pairs and the given pair is not present.
         """
-        if self.day_pairs is not None:
-            if (t0, t1) not in self.day_pairs:
-                raise ValueError("Transport map ({},{}) is not present in day_pairs".format(t0, t1))
-            local_config = self.day_pairs[(t0, t1)]
-        else:
-            local_config = {}
         if covariate is None:
             logger.info('Computing transport map from {} to {}'.format(t0, t1))
         else:
             logger.info('Computing transport map from {} {} to {} {}'.format(t0, covariate[0], t1, covariate[1]))
-        config = {**self.ot_config, **local_config, 't0': t0, 't1': t1, 'covariate': covariate}
+        config = {**self.ot_config, **self._local_config(t0, t1), 't0': t0, 't1': t1, 'covariate': covariate}
         return self.compute_single_transport_map(config)
 
+    def compute_covariate_transport_maps(self, t0, t1, covariate_pairs=None):
+        """
+        Computes the covariate-restricted transport maps from time t0 to time t1
+
+        With the duality_gap solver, all the covariate-restricted problems of the day pair are solved together
+        by wot.ot.optimal_transport_duality_gap_batch. Other solvers solve them one after the other, as does
+        the duality_gap solver with acceleration, omega, a time_budget or iter_budget, cache_potentials,
+        or warm_start with more than one growth iteration.
+
+        Parameters
+        ----------
+        t0 : float
+            Source timepoint for the transport maps
+        t1 : float
+            Destination timepoint for the transport maps
+        covariate_pairs : list of (str, str), optional
+            The covariate restrictions on cells from t0 and t1. Defaults to all pairs of covariates
+
+        Returns
+        -------
+        dict of (str, str) to anndata.AnnData
+            The transport map from t0 to t1 for each covariate pair,
+            or None for the pairs without cells at t0 or t1
+
+        Raises
+        ------
+        ValueError
+            If the OTModel was initialized with day_pairs and the given pair is not present.
+        """
+        local_config = self._local_config(t0, t1)
+        covariate_pairs = list(self.get_covariate_pairs() if covariate_pairs is None else covariate_pairs)
+        if self.solver is not wot.ot.optimal_transport_duality_gap or len(covariate_pairs) < 2 \
+                or not _batch_solver_supports({**self.ot_config, **local_config}):
+            return {covariate: self.compute_transport_map(t0, t1, covariate=covariate)
+                    for covariate in covariate_pairs}
+
+        logger.info('Computing {} covariate transport maps from {} to {}'.format(len(covariate_pairs), t0, t1))
+        tmaps = dict.fromkeys(covariate_pairs)
+        problems = []
+        for covariate in covariate_pairs:
+            config = {**self.ot_config, **local_config, 't0': t0, 't1': t1, 'covariate': covariate}
+            problem = self._prepare_transport_problem(config)
+            if problem is not None:
+                problems.append((covariate, *problem))
+        if not problems:
+            return tmaps
+
+        config = problems[0][1]
+        params = {k: config[k] for k in config if k not in ('C', 'G')}
+        G = [problem[1]['G'] for problem in problems]
+        learned_growth = [[g] for g in G]
+        traces = [wot.ot.SolverTrace() for _ in problems]
+        for i in range(config.get('growth_iters', 1)):
+            if i > 0:
+                G = [tmap.sum(axis=1) for tmap in batch]
+                for g, learned in zip(G, learned_growth):
+                    learned.append(g)
+            for trace in traces:
+                trace.growth_iter = i
+            batch = wot.ot.optimal_transport_duality_gap_batch([problem[1]['C'] for problem in problems], G,
+                                                               trace=traces, **params)
+        for (covariate, config, obs0, obs1, delta_days), tmap, learned, trace in zip(problems, batch, learned_growth,
+                                                                                     traces):
+            tmaps[covariate] = self._transport_map_anndata(tmap, learned, obs0, obs1, delta_days)
+            self.traces[(t0, t1, covariate)] = trace
+            _set_solver_trace(tmaps[covariate], trace)
+        return tmaps
+
+    def _local_config(self, t0, t1):
+        """Parameters specific to the day pair (t0, t1), from the configuration given at initialization"""
+        if self.day_pairs is not None:
+            if (t0, t1) not in self.day_pairs:
+                raise ValueError("Transport map ({},{}) is not present in day_pairs".format(t0, t1))
+            return self.day_pairs[(t0, t1)]
+        return {}
+
     @staticmethod
-    def compute_default_cost_matrix(a, b, eigenvals=None):
+    def compute_default_cost_matrix(a, b, eigenvals=None, dtype=np.float64):
 
         if eigenvals is not None:
             a = a.dot(eigenvals)
             b = b.dot(eigenvals)
 
-        cost_matrix = sklearn.metrics.pairwise.pairwise_distances(a.toarray() if scipy.sparse.isspmatrix(a) else a,
-                                                                  b.toarray() if scipy.sparse.isspmatrix(b) else b,
-                                                                  metric='sqeuclidean', n_jobs=-1)
-        cost_matrix = cost_matrix / np.median(cost_matrix)
-        return cost_matrix
+        a = a.toarray() if scipy.sparse.isspmatrix(a) else a
+        b = b.toarray() if scipy.sparse.isspmatrix(b) else b
+        return wot.ot.sqeuclidean_cost_matrix(a, b, dtype=dtype)
 
     def compute_single_transport_map(self, config):
         """
@@ -258,55 +745,534 @@ class OTModel:
         import gc
         gc.collect()
 
+        problem = self._prepare_transport_problem(config)
+        if problem is None:
+            return None
+        return self._solve_transport_problem(problem)
+
+    def _solve_transport_problem(self, problem):
+        """Solves a transport problem returned by _prepare_transport_problem, returns the transport map"""
+        config, obs0, obs1, delta_days = problem
+        t0, t1, covariate = config.pop('t0'), config.pop('t1'), config.pop('covariate')
+
+        # Growth iterations resume from the dual potentials of the previous iteration. With cache_potentials,
+        # recomputing the same transport map (e.g. in a parameter sweep) resumes from the previous solution.
+        spec = self.solver_spec
+        memmap_dir = config.pop('memmap_dir', None)
+        warm_start = config.get('warm_start', True) and spec.warm_start
+        cache_potentials = config.get('cache_potentials', False) and warm_start
+        params = spec.solver_config(config)
+        params.update({k: config[k] for k in ('C', 'X', 'Y', 'G') if k in config})
+        params.update(growth_iters=config.get('growth_iters', 1), warm_start=warm_start)
+        if cache_potentials:
+            params['potentials'] = self.potentials.get((t0, t1, covariate))
+        if memmap_dir is not None and spec.consumes('out'):
+            params['out'] = _memmap_array(memmap_dir, (len(obs0), len(obs1)), config.get('dtype', np.float64))
+        trace = wot.ot.SolverTrace()
+        if spec.consumes('trace'):
+            params['trace'] = trace
+        tmap, learned_growth, potentials = wot.ot.compute_transport_matrix(solver=self.solver,
+                                                                           return_potentials=True, **params)
+        if cache_potentials:
+            self.potentials[(t0, t1, covariate)] = potentials
+        tmap = self._transport_map_anndata(tmap, learned_growth, obs0, obs1, delta_days, coupling=spec.coupling)
+        # Solvers that do not record traces leave them empty
+        if trace.stages:
+            self.traces[(t0, t1, covariate)] = trace
+            _set_solver_trace(tmap, trace)
+        else:
+            self.traces.pop((t0, t1, covariate), None)
+        return tmap
+
+    def _prepare_transport_problem(self, config):
+        """
+        Selects the cells of a transport problem and sets the solver inputs in config.
+
+        Returns
+        -------
+        (config, obs0, obs1, delta_days) or None
+            config holds the cost matrix C or the coordinates X and Y, and the growth G, with t0, t1 and covariate.
+            obs0 and obs1 are the metadata of the cells at t0 and t1.
+            None if there are no cells at t0 or t1.
+        """
         t0 = config.pop('t0', None)
         t1 = config.pop('t1', None)
         if t0 is None or t1 is None:
             raise ValueError("config must have both t0 and t1, indicating target timepoints")
         ds = self.matrix
         covariate = config.pop('covariate', None)
-        if covariate is None:
-            p0_indices = ds.obs[self.day_field] == float(t0)
-            p1_indices = ds.obs[self.day_field] == float(t1)
-        else:
-            p0_indices = (ds.obs[self.day_field] == float(t0)) & (ds.obs[self.covariate_field] == covariate[0])
-            p1_indices = (ds.obs[self.day_field] == float(t1)) & (ds.obs[self.covariate_field] == covariate[1])
+        p0_indices, p1_indices = self._transport_problem_cells(t0, t1, covariate)
 
-        p0 = ds[p0_indices, :]
-        p1 = ds[p1_indices, :]
-
-        if p0.shape[0] == 0:
+        if len(p0_indices) == 0:
             logger.info('No cells at {}'.format(t0))
             return None
-        if p1.shape[0] == 0:
+        if len(p1_indices) == 0:
             logger.info('No cells at {}'.format(t1))
             return None
+        obs0, obs1 = ds.obs.iloc[p0_indices], ds.obs.iloc[p1_indices]
 
         local_pca = config.pop('local_pca', None)
-        eigenvals = None
+        pca_mode = config.pop('pca_mode', 'local')
+        config.pop('pca_sample', None)
+        config.pop('cost_cache_size', None)
+        dtype = config.get('dtype', np.float64)
+        if config.pop('share_covariate_cost', False):
+            # The inputs of a covariate pair are a block of the inputs of the whole day pair, computed once
+            day0, day1 = self.cell_indices(t0), self.cell_indices(t1)
+            x0, x1, C = self._day_pair_cost_inputs(t0, t1, local_pca, pca_mode, dtype)
+            rows, cols = np.searchsorted(day0, p0_indices), np.searchsorted(day1, p1_indices)
+            if C is None:
+                config['X'], config['Y'] = x0[rows], x1[cols]
+            elif len(rows) == C.shape[0] and len(cols) == C.shape[1]:
+                config['C'] = C
+            else:
+                config['C'] = C[np.ix_(rows, cols)]
+        else:
+            p0_x, p1_x = self._cost_coordinates(p0_indices, p1_indices, local_pca, pca_mode)
+            if self.solver_spec.input == 'points':
+                config['X'], config['Y'] = p0_x, p1_x
+            else:
+                config['C'] = OTModel.compute_default_cost_matrix(p0_x, p1_x, dtype=dtype)
+        delta_days = t1 - t0
+
+        if self.cell_growth_rate_field in obs0.columns:
+            config['G'] = np.power(obs0[self.cell_growth_rate_field].values, delta_days)
+        else:
+            config['G'] = np.ones(len(obs0))
+        config.update({'t0': t0, 't1': t1, 'covariate': covariate})
+        return config, obs0, obs1, delta_days
+
+    def _cost_coordinates(self, p0_indices, p1_indices, local_pca, pca_mode='local'):
+        """Coordinates of the given cells at t0 and t1 in which the cost is computed: scaled PCA or expression"""
+        ds = self.matrix
+        if local_pca is not None and local_pca > 0 and pca_mode == 'global':
+            embedding = self.global_pca_embedding()
+            return embedding[p0_indices], embedding[p1_indices]
+        p0_X, p1_X = ds.X[p0_indices], ds.X[p1_indices]
         if local_pca is not None and local_pca > 0:
             # pca, mean = wot.ot.get_pca(local_pca, p0.X, p1.X)
             # p0_x = wot.ot.pca_transform(pca, mean, p0.X)
             # p1_x = wot.ot.pca_transform(pca, mean, p1.X)
-            p0_x, p1_x, pca, mean = wot.ot.compute_pca(p0.X, p1.X, local_pca)
+            p0_x, p1_x, pca, mean = wot.ot.compute_pca(p0_X, p1_X, local_pca)
             eigenvals = np.diag(pca.singular_values_)
-        else:
-            p0_x = p0.X
-            p1_x = p1.X
+            return p0_x.dot(eigenvals), p1_x.dot(eigenvals)
+        return (p0_X.toarray() if scipy.sparse.isspmatrix(p0_X) else p0_X,
+                p1_X.toarray() if scipy.sparse.isspmatrix(p1_X) else p1_X)
 
-        C = OTModel.compute_default_cost_matrix(p0_x, p1_x, eigenvals)
-        config['C'] = C
-        delta_days = t1 - t0
+    def _day_pair_cost_inputs(self, t0, t1, local_pca, pca_mode, dtype):
+        """
+        Coordinates and cost matrix of all the cells of t0 and t1, kept in the cost cache
 
-        if self.cell_growth_rate_field in p0.obs.columns:
-            config['G'] = np.power(p0.obs[self.cell_growth_rate_field].values, delta_days)
-        else:
-            config['G'] = np.ones(C.shape[0])
-        tmap, learned_growth = wot.ot.compute_transport_matrix(solver=self.solver, **config)
-        learned_growth.append(tmap.sum(axis=1))
+        Returns
+        -------
+        (x0, x1, C)
+            The coordinates of the cells of t0 and t1, in the order of cell_indices, and their cost matrix,
+            or None when the solver takes coordinates
+        """
+        key = (float(t0), float(t1), local_pca, pca_mode, str(np.dtype(dtype)), self.solver_spec.input)
+        inputs = self.cost_cache.get(key)
+        if inputs is None:
+            x0, x1 = self._cost_coordinates(self.cell_indices(t0), self.cell_indices(t1), local_pca, pca_mode)
+            C = None
+            if self.solver_spec.input == 'cost':
+                C = OTModel.compute_default_cost_matrix(x0, x1, dtype=dtype)
+            inputs = (x0, x1, C)
+            self.cost_cache.put(key, inputs, sum(a.nbytes for a in inputs if a is not None))
+        return inputs
+
+    def global_pca_embedding(self):
+        """
+        PCA embedding of all cells, used instead of the local PCA of each day pair when pca_mode is 'global'
+
+        The embedding is fitted once, on all cells or on a random subset of pca_sample cells, and cached in
+        matrix.obsm['X_wot_pca'].
+
+        Returns
+        -------
+        embedding : 2-D ndarray
+            Coordinates of all cells, scaled by the singular values, cells x local_pca
+        """
+        if self.GLOBAL_PCA_KEY not in self.matrix.obsm:
+            n_cells = self.matrix.X.shape[0]
+            pca_sample = self.ot_config.get('pca_sample')
+            fit_indices = None
+            if pca_sample is not None and int(pca_sample) < n_cells:
+                fit_indices = np.sort(np.random.RandomState(58951).choice(n_cells, int(pca_sample), replace=False))
+            logger.info('Fitting global PCA on {} cells'.format(n_cells if fit_indices is None else len(fit_indices)))
+            self.matrix.obsm[self.GLOBAL_PCA_KEY] = wot.ot.compute_pca_embedding(
+                self.matrix.X, self.ot_config['local_pca'], fit_indices)
+        return self.matrix.obsm[self.GLOBAL_PCA_KEY]
+
+    def _index_cells(self):
+        """Builds the row indices of the cells of each day, and of each (day, covariate), in one pass over obs"""
+        obs = self.matrix.obs
+        self.cell_index = {float(day): indices for day, indices in
+                           obs.groupby(self.day_field, observed=True).indices.items()}
+        if self.covariate_field in obs.columns:
+            self.cell_index.update(
+                {(float(day), covariate): indices for (day, covariate), indices in
+                 obs.groupby([self.day_field, self.covariate_field], observed=True).indices.items()})
+
+    def cell_indices(self, day, covariate=None):
+        """
+        Row indices in the matrix of the cells of the given day
+
+        Parameters
+        ----------
+        day : float
+            The day
+        covariate : optional
+            Only keep the cells with this covariate value
+
+        Returns
+        -------
+        indices : 1-D ndarray of int
+            The row indices, empty if there are no such cells
+        """
+        key = float(day) if covariate is None else (float(day), covariate)
+        return self.cell_index.get(key, np.empty(0, dtype=np.intp))
+
+    def _transport_problem_cells(self, t0, t1, covariate=None):
+        """Row indices of the cells at t0 and t1, restricted to the given covariate pair"""
+        if covariate is None:
+            return self.cell_indices(t0), self.cell_indices(t1)
+        return self.cell_indices(t0, covariate[0]), self.cell_indices(t1, covariate[1])
+
+    def transport_map_input_hash(self, t0, t1, covariate=None):
+        """
+        Hash of everything the transport map from t0 to t1 depends on
+
+        The hash covers the ids, expression rows and growth rates of the cells at t0 and t1, the genes,
+        the solver and the part of the OT configuration, merged with the configuration of the day pair, that
+        changes the transport map: the solver parameters, the PCA and growth settings. Settings that only change
+        how it is computed, such as cost_cache_size, memmap_dir or the budgets, are left out. With the global
+        PCA, which depends on all cells, it also covers the embedding of the cells at t0 and t1. With
+        share_covariate_cost, it covers all the cells of t0 and t1 rather than those of the covariate pair.
+
+        Returns
+        -------
+        str
+            Hexadecimal SHA-256 digest
+        """
+        digest = hashlib.sha256()
+        config = {**self.ot_config, **self._local_config(t0, t1)}
+        hashed_config = self.solver_spec.solver_config(config)
+        hashed_config.update({k: config[k] for k in _TRANSPORT_MAP_CONFIG_KEYS if k in config})
+        for k in _COMPUTATION_CONFIG_KEYS:
+            hashed_config.pop(k, None)
+        # An option set to None, as the command line does for the options it is not given, is the default
+        hashed_config = {k: v for k, v in hashed_config.items() if v is not None}
+        digest.update(json.dumps([self.solver_spec.name, float(t0), float(t1), covariate, hashed_config],
+                                 sort_keys=True, default=str).encode())
+        digest.update('\0'.join(map(str, self.matrix.var.index)).encode())
+        embedding = None
+        if config.get('pca_mode', 'local') == 'global' and config['local_pca'] > 0:
+            embedding = self.global_pca_embedding()
+        # A shared cost depends on all the cells of the day pair
+        cells = self._transport_problem_cells(t0, t1, None if config.get('share_covariate_cost') else covariate)
+        for indices in cells:
+            obs = self.matrix.obs.iloc[indices]
+            digest.update('\0'.join(map(str, obs.index)).encode())
+            if self.cell_growth_rate_field in obs.columns:
+                digest.update(np.ascontiguousarray(obs[self.cell_growth_rate_field].values, dtype=np.float64))
+            X = self.matrix.X[indices]
+            if scipy.sparse.issparse(X):
+                X = X.tocsr()
+                X.sort_indices()
+                arrays = (X.data, X.indices, X.indptr)
+            else:
+                arrays = (np.asarray(X),)
+            if embedding is not None:
+                arrays += (embedding[indices],)
+            for array in arrays:
+                digest.update(str(array.dtype).encode())
+                digest.update(np.ascontiguousarray(array))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _stored_uns_strings(path, keys):
+        """The string annotations stored in the uns of a transport map file, None for those that are missing"""
+        import h5py
+        values = dict.fromkeys(keys)
+        try:
+            with h5py.File(path, 'r') as f:
+                for key in keys:
+                    if 'uns' in f and key in f['uns']:
+                        value = f['uns'][key][()]
+                    else:
+                        value = f.attrs.get(key)
+                    values[key] = value.decode() if isinstance(value, bytes) else value
+        except (OSError, KeyError):
+            pass
+        return values
+
+    @staticmethod
+    def _is_up_to_date(path, input_hash):
+        """
+        Whether the transport map file at path was computed from the inputs with the given hash, and its solver
+        did not exhaust its budget
+        """
+        stored = OTModel._stored_uns_strings(path, ('input_hash', 'solver_status'))
+        return stored['input_hash'] == input_hash and stored['solver_status'] != 'budget_exhausted'
+
+    @staticmethod
+    def _transport_map_anndata(tmap, learned_growth, obs0, obs1, delta_days, coupling='dense'):
+        """The transport map as an AnnData, with the learned growth rates in obs"""
+        learned_growth.append(np.asarray(tmap.sum(axis=1)).ravel())
         obs_growth = {}
         for i in range(len(learned_growth)):
             g = learned_growth[i]
             g = np.power(g, 1.0 / delta_days)
             obs_growth['g' + str(i)] = g
-        obs = pd.DataFrame(index=p0.obs.index, data=obs_growth)
-        return anndata.AnnData(tmap, obs, pd.DataFrame(index=p1.obs.index))
+        obs = pd.DataFrame(index=obs0.index, data=obs_growth)
+        if isinstance(tmap, wot.ot.FactoredTransportMap):
+            return tmap.to_anndata(obs, pd.DataFrame(index=obs1.index))
+        if coupling == 'sparse':
+            tmap = scipy.sparse.csr_matrix(tmap)
+        return anndata.AnnData(tmap, obs, pd.DataFrame(index=obs1.index))
+
+
+class _LRUCache:
+    """Least recently used cache of arrays, holding at most max_bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """The value of key, or None"""
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key, value, nbytes):
+        """Caches value, of size nbytes, evicting the least recently used values. Values above max_bytes are
+        not cached."""
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return
+        while self._entries and self.nbytes + nbytes > self.max_bytes:
+            self.nbytes -= self._entries.popitem(last=False)[1][1]
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _set_solver_trace(tmap, trace):
+    """
+    Stores the summary of the solver trace in tmap.uns['solver_trace'], and whether the solver exhausted its
+    budget in tmap.uns['solver_status'], a string so that it is also written to loom files
+    """
+    tmap.uns['solver_trace'] = {k: v for k, v in trace.summary().items() if v is not None}
+    tmap.uns['solver_status'] = 'budget_exhausted' if trace.budget_exhausted else 'complete'
+
+
+def _batch_solver_supports(config):
+    """
+    Whether wot.ot.optimal_transport_duality_gap_batch computes the same transport maps as the serial solver
+    for config. It has no acceleration, no budget, and restarts each growth iteration from zero potentials.
+    """
+    if any(config.get(key) is not None for key in ('acceleration', 'omega', 'time_budget', 'iter_budget')):
+        return False
+    if config.get('cache_potentials', False):
+        return False
+    return not (config.get('warm_start', True) and config.get('growth_iters', 1) > 1)
+
+
+def _memmap_array(directory, shape, dtype):
+    """An array backed by an unnamed temporary file in directory, which is removed when the array is freed"""
+    with tempfile.TemporaryFile(dir=directory) as f:
+        # The mapping outlives the file object. A plain ndarray view is written by anndata like any array.
+        return np.memmap(f, dtype=dtype, mode='w+', shape=shape).view(np.ndarray)
+
+
+def _write_transport_map(tmap, path, output_format):
+    """
+    Writes a transport map to a hidden temporary file next to path, then renames it to path, so that path is
+    never partially written, e.g. when the process is killed
+    """
+    directory, name = os.path.split(path)
+    stem, extension = os.path.splitext(name)
+    temp_path = os.path.join(directory, '.{}.{}.tmp{}'.format(stem, os.getpid(), extension))
+    try:
+        wot.io.write_dataset(tmap, temp_path, output_format=output_format)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class _FileLock:
+    """
+    Non-blocking exclusive lock on a file, shared between processes and hosts through the file system.
+    The lock is released by the operating system when its process exits, even if it is killed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        """Tries to acquire the lock, returns whether it was acquired"""
+        import fcntl
+        f = open(self.path, 'a')
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self.file = f
+        return True
+
+    def release(self):
+        import fcntl
+        fcntl.lockf(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+
+def _parse_shard(shard):
+    """(index, count) of a shard given as 'i/N' or (i, N), with 0 <= i < N"""
+    try:
+        index, count = (int(x) for x in (shard.split('/') if isinstance(shard, str) else shard))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid shard {}, expected i/N'.format(shard))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('Invalid shard {}, expected i/N with 0 <= i < N'.format(shard))
+    return index, count
+
+
+class _TransportMapWriter:
+    """
+    Writes transport maps in a background thread, so that the next ones are computed meanwhile.
+
+    At most queue_size transport maps wait to be written; with queue_size=0 they are written synchronously.
+    The first write error is raised by the next call to write, or by close.
+    """
+
+    def __init__(self, queue_size=2):
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_size) if queue_size > 0 else None
+        if self.queue is not None:
+            self.thread = threading.Thread(target=self._run, name='wot-tmap-writer', daemon=True)
+            self.thread.start()
+
+    def write(self, tmap, path, output_format):
+        if self.error is not None:
+            raise self.error
+        if self.queue is None:
+            _write_transport_map(tmap, path, output_format)
+        else:
+            self.queue.put((tmap, path, output_format))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                tmap, path, output_format = item
+                try:
+                    _write_transport_map(tmap, path, output_format)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        """Waits for all transport maps to be written"""
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # Do not hide the exception being raised behind a write error
+        try:
+            self.close()
+        except Exception:
+            logger.exception('Error writing transport maps')
+
+
+class _SharedMatrix:
+    """
+    A dense or sparse matrix copied once into shared memory, to be mapped read-only by worker processes.
+
+    Pickling a _SharedMatrix only sends the names of the shared memory blocks.
+    """
+
+    def __init__(self, X):
+        from multiprocessing import shared_memory
+        self.sparse_format = X.format if scipy.sparse.issparse(X) else None
+        self.shape = X.shape
+        arrays = [X.data, X.indices, X.indptr] if self.sparse_format is not None else [np.asarray(X)]
+        self.blocks = []
+        self.specs = []
+        for array in arrays:
+            block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks.append(block)
+            self.specs.append((block.name, array.shape, array.dtype.str))
+
+    def __getstate__(self):
+        return {'sparse_format': self.sparse_format, 'shape': self.shape, 'specs': self.specs, 'blocks': []}
+
+    def attach(self):
+        """The matrix, backed by the shared memory blocks"""
+        from multiprocessing import shared_memory
+        arrays = []
+        for name, shape, dtype in self.specs:
+            block = shared_memory.SharedMemory(name=name)
+            self.blocks.append(block)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            array.flags.writeable = False
+            arrays.append(array)
+        if self.sparse_format is None:
+            return arrays[0]
+        matrix_type = scipy.sparse.csr_matrix if self.sparse_format == 'csr' else scipy.sparse.csc_matrix
+        return matrix_type(tuple(arrays), shape=self.shape, copy=False)
+
+    def unlink(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
+# The OTModel of a worker process and its BLAS thread limits, set by _init_worker
+_worker_model = None
+_worker_blas_limits = None
+
+
+def _init_worker(model, shared_matrix, blas_threads):
+    global _worker_model, _worker_blas_limits
+    try:
+        import threadpoolctl
+        _worker_blas_limits = threadpoolctl.threadpool_limits(limits=blas_threads)
+    except ImportError:
+        for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            os.environ[variable] = str(blas_threads)
+    model.matrix = anndata.AnnData(shared_matrix.attach(), model.matrix.obs, model.matrix.var,
+                                   obsm=dict(model.matrix.obsm))
+    _worker_model = model
+
+
+def _compute_and_write_transport_maps(day_pairs, output_files, input_hashes, output_file_format, with_covariates):
+    results, = _worker_model._compute_and_write_transport_maps([day_pairs], output_files, input_hashes,
+                                                               output_file_format, with_covariates)
+    return results
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from . import optimal_transport
+
+logger = logging.getLogger('wot')
+
+ENTRY_POINT_GROUP = 'wot.solvers'
+COUPLING_TYPES = ('dense', 'sparse', 'factored')
+INPUT_TYPES = ('cost', 'points')
+
+_solvers = {}
+_entry_points_loaded = False
+
+
+class SolverSpec:
+    """
+    Description of a transport solver, as registered with wot.ot.register_solver
+
+    Attributes
+    ----------
+    name : str
+        Name of the solver, e.g. the value of the --solver command line option
+    solver : callable
+        The solver. It is called with the cost matrix C, or the coordinates X and Y of both timepoints,
+        the growth G, and the config keys it consumes
+    config_keys : tuple of str or None
+        OT configuration keys passed to the solver. None to pass the whole configuration
+    warm_start : bool
+        Whether the solver accepts the potentials and return_potentials arguments
+    coupling : str
+        Type of the couplings returned by the solver: dense (ndarray), sparse (scipy.sparse matrix)
+        or factored (wot.ot.FactoredTransportMap)
+    input : str
+        'cost' if the solver takes the cost matrix C, 'points' if it takes the coordinates X and Y
+    """
+
+    def __init__(self, name, solver, config_keys=None, warm_start=False, coupling='dense', input='cost'):
+        if coupling not in COUPLING_TYPES:
+            raise ValueError('Unknown coupling type {}, expected one of {}'.format(coupling, COUPLING_TYPES))
+        if input not in INPUT_TYPES:
+            raise ValueError('Unknown input type {}, expected one of {}'.format(input, INPUT_TYPES))
+        self.name = name
+        self.solver = solver
+        self.config_keys = None if config_keys is None else tuple(config_keys)
+        self.warm_start = warm_start
+        self.coupling = coupling
+        self.input = input
+
+    def consumes(self, key):
+        """Whether the solver is passed the config key"""
+        return self.config_keys is None or key in self.config_keys
+
+    def solver_config(self, config):
+        """The part of config that is passed to the solver"""
+        if self.config_keys is None:
+            return dict(config)
+        return {k: config[k] for k in self.config_keys if k in config}
+
+    def __repr__(self):
+        return 'SolverSpec({!r}, coupling={!r}, input={!r}, warm_start={!r})'.format(
+            self.name, self.coupling, self.input, self.warm_start)
+
+
+def register_solver(name, solver, config_keys=None, warm_start=False, coupling='dense', input='cost'):
+    """
+    Registers a transport solver, to be selected by name in OTModel and on the command line
+
+    Parameters
+    ----------
+    name : str
+        Name of the solver. Registering an existing name replaces the previous solver.
+    solver : callable
+        The solver. It is called with the cost matrix C, or the coordinates X and Y of both timepoints,
+        the growth G, and the config keys it consumes. It returns the coupling.
+    config_keys : list of str, optional
+        OT configuration keys consumed by the solver, e.g. ['epsilon', 'lambda1', 'lambda2'].
+        By default, the whole configuration is passed and the solver must accept extra keyword arguments.
+    warm_start : bool, optional
+        Whether the solver accepts the potentials and return_potentials arguments. If set, it returns
+        (coupling, potentials) when called with return_potentials=True.
+    coupling : {'dense', 'sparse', 'factored'}, optional
+        Type of the couplings returned by the solver
+    input : {'cost', 'points'}, optional
+        Whether the solver takes the cost matrix C, or the coordinates X and Y of both timepoints
+
+    Returns
+    -------
+    spec : wot.ot.SolverSpec
+        The registered solver
+
+    Example
+    -------
+    >>> wot.ot.register_solver('my_solver', my_solver, config_keys=['epsilon', 'lambda1', 'lambda2'])
+    >>> wot.ot.OTModel(adata, solver='my_solver')
+
+    Solvers can also be registered by other packages, with a 'wot.solvers' entry point referring to a
+    wot.ot.SolverSpec, or to a solver function registered with the default options.
+    """
+    spec = SolverSpec(name, solver, config_keys=config_keys, warm_start=warm_start, coupling=coupling, input=input)
+    _solvers[name] = spec
+    return spec
+
+
+def get_solver(name):
+    """
+    The registered solver with the given name
+
+    Raises
+    ------
+    ValueError
+        If there is no solver with this name
+    """
+    _load_entry_points()
+    if name not in _solvers:
+        raise ValueError('Unknown solver {}, expected one of {}'.format(name, solver_names()))
+    return _solvers[name]
+
+
+def solver_names():
+    """Names of all registered solvers"""
+    _load_entry_points()
+    return list(_solvers.keys())
+
+
+def _load_entry_points():
+    """Registers the solvers declared by installed packages in the wot.solvers entry point group, once"""
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    for entry_point in _iter_entry_points(ENTRY_POINT_GROUP):
+        try:
+            solver = entry_point.load()
+        except Exception:
+            logger.exception('Unable to load solver {}'.format(entry_point.name))
+            continue
+        if isinstance(solver, SolverSpec):
+            solver.name = entry_point.name
+            _solvers[entry_point.name] = solver
+        else:
+            register_solver(entry_point.name, solver)
+
+
+def _iter_entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return list(pkg_resources.iter_entry_points(group))
+    entry_points = entry_points()
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=group))
+    return list(entry_points.get(group, []))
+
+
+_scaling_keys = ('lambda1', 'lambda2', 'epsilon', 'dtype')
+_budget_keys = ('trace', 'time_budget', 'iter_budget')
+
+register_solver('duality_gap', optimal_transport.optimal_transport_duality_gap,
+                config_keys=_scaling_keys + ('batch_size', 'tolerance', 'tau', 'epsilon0', 'max_iter', 'acceleration',
+                                             'omega', 'anderson_depth') + _budget_keys,
+                warm_start=True)
+register_solver('fixed_iters', optimal_transport.transport_stablev2,
+                config_keys=_scaling_keys + ('scaling_iter', 'tau', 'epsilon0', 'extra_iter', 'inner_iter_max')
+                            + _budget_keys,
+                warm_start=True)
+register_solver('greedy', optimal_transport.optimal_transport_greedy,
+                config_keys=_scaling_keys + ('batch_size', 'tolerance', 'tau', 'epsilon0', 'max_iter', 'greedy_ratio')
+                            + _budget_keys,
+                warm_start=True)
+register_solver('streaming', optimal_transport.optimal_transport_streaming,
+                config_keys=_scaling_keys + ('batch_size', 'tolerance', 'epsilon0', 'max_iter', 'cost_scale',
+                                             'block_size', 'out'),
+                warm_start=True, input='points')
+register_solver('sparse', optimal_transport.optimal_transport_sparse,
+                config_keys=_scaling_keys + ('batch_size', 'tolerance', 'tau', 'epsilon0', 'max_iter', 'cost_scale',
+                                             'kernel_threshold', 'kernel_knn', 'block_size'),
+                warm_start=True, coupling='sparse', input='points')
+register_solver('multiscale', optimal_transport.optimal_transport_multiscale,
+                config_keys=_scaling_keys + ('batch_size', 'tolerance', 'tau', 'epsilon0', 'max_iter', 'cost_scale',
+                                             'n_clusters', 'coarse_threshold'),
+                coupling='sparse', input='points')
+register_solver('lowrank', optimal_transport.optimal_transport_lowrank,
+                config_keys=_scaling_keys + ('batch_size', 'tolerance', 'max_iter', 'cost_scale', 'rank',
+                                             'max_kernel_error', 'densify'),
+                coupling='factored', input='points')
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+
+class SolverTrace:
+    """
+    Convergence telemetry of the scaling iterations of a solver.
+
+    Pass a SolverTrace as the `trace` argument of optimal_transport_duality_gap or transport_stablev2 to record,
+    for each epsilon stage, the number of iterations, the duality gap at each check, the number of absorptions
+    and the wall time, along with the size of the largest kernel buffer.
+
+    Attributes
+    ----------
+    stages : list of dict
+        One dict per epsilon stage, with keys growth_iter, epsilon, iterations, absorptions, duality_gaps,
+        wall_time and converged
+    peak_kernel_bytes : int
+        Size in bytes of the largest kernel buffer allocated by the solver
+    growth_iter : int
+        Index of the current growth iteration, set by wot.ot.compute_transport_matrix
+    budget_exhausted : bool
+        Whether the solver stopped early because its time_budget or iter_budget was exhausted
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.peak_kernel_bytes = 0
+        self.growth_iter = 0
+        self.budget_exhausted = False
+        self._stage_start = None
+
+    def start_stage(self, epsilon):
+        """Starts recording a new epsilon stage"""
+        self.stages.append({'growth_iter': self.growth_iter, 'epsilon': float(epsilon), 'iterations': 0,
+                            'absorptions': 0, 'duality_gaps': [], 'wall_time': 0.0, 'converged': False})
+        self._stage_start = time.time()
+
+    def end_stage(self, iterations, converged=True):
+        """Ends the current epsilon stage, after the given number of scaling iterations"""
+        stage = self.stages[-1]
+        stage['iterations'] = int(iterations)
+        stage['converged'] = bool(converged)
+        stage['wall_time'] = time.time() - self._stage_start
+
+    def record_duality_gap(self, duality_gap):
+        """Records the duality gap, or convergence criterion, at a check of the current stage"""
+        self.stages[-1]['duality_gaps'].append(float(duality_gap))
+
+    def record_absorption(self):
+        """Records an absorption of the scaling variables into the dual potentials"""
+        self.stages[-1]['absorptions'] += 1
+
+    def record_kernel(self, *buffers):
+        """Records the size of kernel-sized buffers allocated together"""
+        self.peak_kernel_bytes = max(self.peak_kernel_bytes, sum(buffer.nbytes for buffer in buffers))
+
+    @property
+    def iterations(self):
+        return sum(stage['iterations'] for stage in self.stages)
+
+    @property
+    def converged(self):
+        return len(self.stages) > 0 and self.stages[-1]['converged']
+
+    def summary(self):
+        """
+        Totals over all stages
+
+        Returns
+        -------
+        summary : dict
+            iterations, stages, absorptions, wall_time, duality_gap (at the last check, or None),
+            converged, budget_exhausted and peak_kernel_bytes
+        """
+        last_gaps = [gap for stage in self.stages for gap in stage['duality_gaps']]
+        return {'iterations': self.iterations,
+                'stages': len(self.stages),
+                'absorptions': sum(stage['absorptions'] for stage in self.stages),
+                'wall_time': sum(stage['wall_time'] for stage in self.stages),
+                'duality_gap': last_gaps[-1] if last_gaps else None,
+                'converged': self.converged,
+                'budget_exhausted': bool(self.budget_exhausted),
+                'peak_kernel_bytes': int(self.peak_kernel_bytes)}
+
+    def to_dict(self):
+        """The summary along with all stages, as a JSON-serializable dict"""
+        return {**self.summary(), 'stage_trace': [dict(stage) for stage in self.stages]}
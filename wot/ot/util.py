@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import types
+
 import numpy as np
 import ot as pot
 import scipy.sparse
@@ -7,6 +9,8 @@ import scipy.stats
 import sklearn.decomposition
 import sklearn.metrics
 
+from .optimal_transport import FactoredTransportMap
+
 
 def compute_growth_scores(proliferation, apoptosis, beta_max=1.7, beta_center=0.25, delta_max=1.7, delta_min=0.3,
                           beta_min=0.3):
@@ -116,8 +120,8 @@ def interpolate_with_ot(p0, p1, tmap, interp_frac, size):
         The genes of each cell in the source population
     p1 : 2-D array
         The genes of each cell in the destination population
-    tmap : 2-D array
-        A transport map from p0 to p1
+    tmap : 2-D array, scipy.sparse matrix or wot.ot.FactoredTransportMap
+        A transport map from p0 to p1, such as wot.tmap.coupling_matrix of a transport map
     t_interpolate : float
         The fraction at which to interpolate
     size : int
@@ -132,7 +136,9 @@ def interpolate_with_ot(p0, p1, tmap, interp_frac, size):
     p1 = p1.toarray() if scipy.sparse.isspmatrix(p1) else p1
     p0 = np.asarray(p0, dtype=np.float64)
     p1 = np.asarray(p1, dtype=np.float64)
-    tmap = np.asarray(tmap, dtype=np.float64)
+    if isinstance(tmap, FactoredTransportMap):
+        # The low-rank approximation can have small negative entries, which are not sampled
+        tmap = np.maximum(tmap.toarray(), 0)
     if p0.shape[1] != p1.shape[1]:
         raise ValueError("Unable to interpolate. Number of genes do not match")
     if p0.shape[0] != tmap.shape[0] or p1.shape[0] != tmap.shape[1]:
@@ -140,6 +146,15 @@ def interpolate_with_ot(p0, p1, tmap, interp_frac, size):
                          .format(tmap.shape, (len(p0), len(p1))))
     I = len(p0);
     J = len(p1)
+    if scipy.sparse.issparse(tmap):
+        # Only the stored entries of a sparse transport map can be sampled
+        tmap = scipy.sparse.coo_matrix(tmap, dtype=np.float64)
+        col_sums = np.asarray(tmap.sum(axis=0)).ravel()
+        p = tmap.data / np.power(col_sums[tmap.col], 1. - interp_frac)
+        p = p / p.sum()
+        choices = np.random.choice(len(p), p=p, size=size)
+        return p0[tmap.row[choices]] * (1 - interp_frac) + p1[tmap.col[choices]] * interp_frac
+    tmap = np.asarray(tmap, dtype=np.float64)
     # Assume growth is exponential and retrieve growth rate at t_interpolate
     p = tmap / np.power(tmap.sum(axis=0), 1. - interp_frac)
     p = p.flatten(order='C')
@@ -238,6 +253,31 @@ def earth_mover_distance(cloud1, cloud2, eigenvals=None, weights1=None, weights2
 
 
 def compute_pca(m1, m2, n_components):
+    """
+    Local PCA of the cells of two timepoints, as used to compute the cost matrix between them.
+
+    The cells are the features of a PCA fitted on the genes x cells matrix, after centering the genes.
+    Sparse inputs are never densified: the centering is implicit and a randomized SVD is used, so that
+    memory usage is proportional to the number of non-zeros plus cells x n_components.
+
+    Parameters
+    ----------
+    m1, m2 : 2-D ndarray or scipy.sparse matrix
+        Expression matrices, with cells on rows, at both timepoints
+    n_components : int
+        Number of principal components
+
+    Returns
+    -------
+    pca_1, pca_2 : 2-D ndarray
+        Normalized coordinates of the cells of m1 and m2. Multiply by diag(pca.singular_values_) to scale them.
+    pca : sklearn.decomposition.PCA or types.SimpleNamespace
+        Fitted PCA, with components_ and singular_values_
+    mean_shift : 1-D ndarray
+        Mean expression of each gene
+    """
+    if scipy.sparse.issparse(m1) or scipy.sparse.issparse(m2):
+        return _sparse_pca(m1, m2, n_components)
     matrices = list()
     matrices.append(m1 if not scipy.sparse.isspmatrix(m1) else m1.toarray())
     matrices.append(m2 if not scipy.sparse.isspmatrix(m2) else m2.toarray())
@@ -255,6 +295,140 @@ def compute_pca(m1, m2, n_components):
     return pca_1, pca_2, pca, mean_shift
 
 
+def _sparse_pca(m1, m2, n_components, n_oversamples=10, n_iter=7, random_state=58951):
+    """compute_pca on sparse matrices, with implicit centering and a randomized SVD (Halko et al. 2011)"""
+    x = scipy.sparse.vstack([scipy.sparse.csr_matrix(m1), scipy.sparse.csr_matrix(m2)], format='csr',
+                            dtype=np.float64)
+    comp, singular_values, _, gene_shift = _randomized_pca(x, n_components, n_oversamples=n_oversamples,
+                                                           n_iter=n_iter, random_state=random_state)
+    pca = types.SimpleNamespace(components_=comp.T, singular_values_=singular_values,
+                                n_components_=len(singular_values))
+    m1_len = m1.shape[0]
+    return comp[:m1_len], comp[m1_len:], pca, gene_shift
+
+
+def _randomized_pca(x, n_components, n_oversamples=10, n_iter=7, random_state=58951):
+    """
+    Randomized SVD (Halko et al. 2011) of the cells x genes matrix x, with the centering of compute_pca done
+    implicitly so that sparse matrices are never densified.
+
+    Returns
+    -------
+    comp : 2-D ndarray
+        Left singular vectors, i.e. the normalized coordinates of the cells
+    singular_values : 1-D ndarray
+    gene_axes : 2-D ndarray
+        Right singular vectors, genes x n_components
+    gene_shift : 1-D ndarray
+        Mean expression of each gene
+    """
+    n_cells, n_genes = x.shape
+    n_components = min(n_components, n_cells, n_genes)
+    # The centered matrix is z = x - 1.gene_shift^T - cell_shift.1^T: genes are centered, then each cell
+    # is centered over genes, as PCA does on the genes x cells matrix.
+    gene_shift = np.asarray(x.mean(axis=0), dtype=np.float64).ravel()
+    cell_shift = (np.asarray(x.sum(axis=1), dtype=np.float64).ravel() - gene_shift.sum()) / n_genes
+
+    def z_dot(v):
+        return x.dot(v) - gene_shift.dot(v)[np.newaxis, :] - np.outer(cell_shift, v.sum(axis=0))
+
+    def z_t_dot(w):
+        return x.T.dot(w) - np.outer(gene_shift, w.sum(axis=0)) - cell_shift.dot(w)[np.newaxis, :]
+
+    random_state = np.random.RandomState(random_state)
+    n_samples = min(n_components + n_oversamples, n_cells, n_genes)
+    q = z_dot(random_state.normal(size=(n_genes, n_samples)))
+    for i in range(n_iter):
+        q = z_dot(z_t_dot(np.linalg.qr(q)[0]))
+    q = np.linalg.qr(q)[0]
+    u, singular_values, vt = np.linalg.svd(z_t_dot(q).T, full_matrices=False)
+    comp = q.dot(u[:, :n_components])
+    gene_axes = vt[:n_components].T
+    # Deterministic signs: the largest coordinate of each component is positive
+    signs = np.sign(comp[np.abs(comp).argmax(axis=0), np.arange(n_components)])
+    return comp * signs, singular_values[:n_components], gene_axes * signs, gene_shift
+
+
+def compute_pca_embedding(x, n_components, fit_indices=None):
+    """
+    Global PCA embedding of all cells, fitted once instead of for each pair of timepoints.
+
+    The embedding is the one compute_pca computes on two timepoints, computed on all cells. When fit_indices
+    is given, the principal axes are fitted on these cells only, and all cells are projected onto them.
+
+    Parameters
+    ----------
+    x : 2-D ndarray or scipy.sparse matrix
+        Expression matrix, with cells on rows
+    n_components : int
+        Number of principal components
+    fit_indices : 1-D array of int, optional
+        Rows of x to fit the principal axes on. All rows by default.
+
+    Returns
+    -------
+    embedding : 2-D ndarray
+        Coordinates of all cells, scaled by the singular values, cells x n_components
+    """
+    if not scipy.sparse.issparse(x):
+        x = np.asarray(x, dtype=np.float64)
+    fit_x = x if fit_indices is None else x[fit_indices]
+    comp, singular_values, gene_axes, gene_shift = _randomized_pca(fit_x, n_components)
+    if fit_indices is None:
+        return comp * singular_values
+    # Center each cell as the fitted ones, then project onto the principal axes
+    cell_shift = (np.asarray(x.sum(axis=1), dtype=np.float64).ravel() - gene_shift.sum()) / x.shape[1]
+    return np.asarray(x.dot(gene_axes)) - gene_shift.dot(gene_axes)[np.newaxis, :] \
+           - np.outer(cell_shift, gene_axes.sum(axis=0))
+
+
+def downsample_counts(x, ncounts, random_state=None):
+    """
+    Downsamples the cells with more than ncounts counts to about ncounts counts, by binomial thinning.
+
+    Each count of such a cell is kept with probability ncounts / total, independently, so that the expected
+    number of counts is ncounts. Sparse matrices are thinned on their stored values, without densifying.
+
+    Parameters
+    ----------
+    x : 2-D ndarray or scipy.sparse matrix
+        Counts, with cells on rows. Non-integer values of downsampled cells are rounded.
+    ncounts : int
+        Target number of counts per cell
+    random_state : int or numpy.random.RandomState, optional
+        Seed or random generator. Defaults to the global numpy generator.
+
+    Returns
+    -------
+    x : 2-D ndarray or scipy.sparse.csr_matrix
+        The downsampled counts, in the dtype of x
+    """
+    rng = _random_generator(random_state)
+    totals = np.asarray(x.sum(axis=1), dtype=np.float64).ravel()
+    downsampled = totals > ncounts
+    keep_fraction = np.ones(len(totals))
+    keep_fraction[downsampled] = ncounts / totals[downsampled]
+    if scipy.sparse.issparse(x):
+        x = scipy.sparse.csr_matrix(x, copy=True)
+        entries = np.repeat(downsampled, np.diff(x.indptr))
+        x.data[entries] = rng.binomial(np.rint(x.data[entries]).astype(np.int64),
+                                       np.repeat(keep_fraction[downsampled], np.diff(x.indptr)[downsampled]))
+        x.eliminate_zeros()
+        return x
+    x = np.array(x)
+    x[downsampled] = rng.binomial(np.rint(x[downsampled]).astype(np.int64), keep_fraction[downsampled, np.newaxis])
+    return x
+
+
+def _random_generator(random_state):
+    """The numpy random generator of a seed, or None for the global generator. Generators are returned as is."""
+    if random_state is None:
+        return np.random
+    if isinstance(random_state, (int, np.integer)):
+        return np.random.RandomState(random_state)
+    return random_state
+
+
 def get_pca(dim, *args):
     """
     Get a PCA projector for the arguments.
@@ -286,7 +286,7 @@ class TransportMapModel:
             t0 = self.timepoints[i]
             t1 = self.timepoints[i + 1]
             tmap = self.get_coupling(t0, t1)
-            p = p @ tmap.X
+            p = p @ wot.tmap.coupling_matrix(tmap)
             if normalize:
                 p = (p.T / np.sum(p, axis=1)).T
             i += 1
@@ -352,7 +352,7 @@ class TransportMapModel:
             t1 = self.timepoints[i]
             t0 = self.timepoints[i - 1]
             tmap = self.get_coupling(t0, t1)
-            p = (tmap.X @ p.T).T
+            p = (wot.tmap.coupling_matrix(tmap) @ p.T).T
             if normalize:
                 p = (p.T / np.sum(p, axis=1)).T
             i -= 1
@@ -5,6 +5,8 @@ import numpy as np
 import pandas as pd
 import scipy.sparse
 
+import wot
+
 
 def generate_comparisons(comparison_names, compare, days, delta_days=0, reference_day='start'):
     if compare != 'within':  # within, match, all, or trajectory name
@@ -90,10 +92,30 @@ def glue_transport_maps(tmap_0, tmap_1):
     # FIXME: Column sum normalization is needed before gluing. Can be skipped only if lambda2 is high enough
     cells_at_intermediate_tpt = tmap_0.var.index
     cait_index = tmap_1.obs.index.get_indexer_for(cells_at_intermediate_tpt)
-    result_x = np.dot(tmap_0.X, tmap_1.X[cait_index, :])
+    result_x = coupling_matrix(tmap_0) @ coupling_matrix(tmap_1)[cait_index]
+    if isinstance(result_x, wot.ot.FactoredTransportMap):
+        return result_x.to_anndata(tmap_0.obs.copy(), tmap_1.var.copy())
     return anndata.AnnData(result_x, tmap_0.obs.copy(), tmap_1.var.copy())
 
 
+def coupling_matrix(tmap):
+    """
+    The coupling of a transport map, to be multiplied with populations
+
+    Parameters
+    ----------
+    tmap : anndata.AnnData
+        The transport map
+
+    Returns
+    -------
+    coupling : 2-D ndarray, scipy.sparse matrix or wot.ot.FactoredTransportMap
+        tmap.X, or the low-rank factors of tmap if it was computed by the lowrank solver
+    """
+    factored = wot.ot.FactoredTransportMap.from_anndata(tmap)
+    return tmap.X if factored is None else factored
+
+
 def trajectory_trends_from_trajectory(trajectory_ds, expression_ds, day_field='day'):
     """
     Computes the mean and variance of each gene over time for the given trajectories